@@ -34,7 +34,10 @@ from watchdog.observers import Observer
 from combox.config import config_cb, get_nodedirs
 from combox.events import ComboxDirMonitor, NodeDirMonitor
 from combox.gui import ComboxConfigDialog
+from combox.locks import PathLocks
 from combox.log import log_i, log_e
+from combox.scheduler import job_queue
+from combox.silo import ComboxSilo
 
 ## Function adapted from Watchdog's docs:
 ## http://pythonhosted.org/watchdog/quickstart.html#quickstart
@@ -42,6 +45,13 @@ from combox.log import log_i, log_e
 def run_cb(config):
     """Runs combox.
 
+    - Creates an instance of :class:`.ComboxSilo`, which is shared by
+      all the monitors.
+
+    - Creates a :class:`~combox.scheduler.JobQueue`, which is shared
+      by all the monitors; the metrics of the queue are logged when
+      combox exits.
+
     - Creates an instance of :class:`.ComboxDirMonitor` to monitor the
       combox directory.
 
@@ -56,17 +66,16 @@ def run_cb(config):
 
     """
     db_lock = Lock()
-    monitor_lock = Lock()
+    path_locks = PathLocks()
+    silo = ComboxSilo(config, db_lock)
+    jobs = job_queue(config)
 
-    # start combox directory (cd) monitor (cdm)
+    # create combox directory (cd) monitor (cdm)
     combox_dir = path.abspath(config['combox_dir'])
-    cd_monitor = ComboxDirMonitor(config, db_lock, monitor_lock)
-
-    cd_observer = Observer()
-    cd_observer.schedule(cd_monitor, combox_dir, recursive=True)
-    cd_observer.start()
+    cd_monitor = ComboxDirMonitor(config, db_lock, path_locks, silo,
+                                  jobs)
 
-    # start a node directory monitor for each of the node directories.
+    # create a node directory monitor for each of the node directories.
     node_dirs =  get_nodedirs(config)
     num_nodes =  len(get_nodedirs(config))
 
@@ -75,17 +84,25 @@ def run_cb(config):
 
     for node in node_dirs:
         nd_monitor = NodeDirMonitor(config, db_lock,
-                                    monitor_lock)
+                                    path_locks, silo, jobs)
         nd_observer = Observer()
         nd_observer.schedule(nd_monitor, node, recursive=True)
-        nd_observer.start()
 
         nd_monitors.append(nd_monitor)
         nd_observers.append(nd_observer)
 
-    # Make the first node monitor do the housekeeping.
+    # Make the first node monitor do the housekeeping; it forks a
+    # pool of processes (see combox.engine.glue_files), so it is done
+    # before the observers and their threads are started.
     nd_monitors[0].housekeep()
 
+    cd_observer = Observer()
+    cd_observer.schedule(cd_monitor, combox_dir, recursive=True)
+    cd_observer.start()
+
+    for nd_observer in nd_observers:
+        nd_observer.start()
+
     log_i("Hit Ctrl-C to quit")
     try:
         while True:
@@ -97,6 +114,13 @@ def run_cb(config):
             nd_observers[i].join()
     cd_observer.join()
 
+    # let the running jobs finish.
+    jobs.stop()
+    log_i("Job queue metrics: %r" % jobs.metrics())
+
+    # commit the changes to the silo that are not committed yet.
+    silo.flush()
+
     log_i("combox exiting. Bye!")
 
 
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+import errno
+import hmac
+import struct
+
+from binascii import hexlify, unhexlify
+from hashlib import sha256, sha512
+from os import path, sep
+
+
+STORAGE_MODES = ['shards', 'chunks']
+"""Modes in which files are stored in the node directories.
+
+In `shards` mode, each file is split into as many shards as there are
+node directories; a modified file is read, encrypted and written whole
+again. In `chunks` mode, each file is split into content-defined
+chunks (see :func:`chunk_ranges`); each chunk is stored once, split
+into shards, under :data:`CHUNK_DIR` and the file's shards hold its
+manifest -- the list of its chunks. Only in this mode, a modified file
+is cut again from its first changed chunk (see
+:func:`~combox.crypto.store_chunks`).
+
+"""
+
+CHUNK_DIR = '.combox-chunks'
+"""Directory under each node directory where the chunks are stored.
+
+"""
+
+CHUNK_SIZE = 1048576
+"""Default average size of a chunk, in bytes.
+
+"""
+
+WINDOW = 32
+"""No. of bytes the rolling hash of :func:`chunk_ranges` depends on.
+
+"""
+
+SCAN_SIZE = 65536
+"""No. of bytes :func:`chunk_ranges` copies and hashes at a time.
+
+"""
+
+GEAR = [struct.unpack('>I', sha512(chr(i)).digest()[:4])[0]
+        for i in range(256)]
+"""Random 32-bit integer for each byte value, used by the rolling hash.
+
+It's derived from a fixed seed, so that files are cut into the same
+chunks on every computer.
+
+"""
+
+MANIFEST_ENTRY = struct.Struct('>32sQ')
+"""An entry in a file's manifest.
+
+Fields: the chunk's id (see :func:`chunk_id`) and its length.
+
+"""
+
+
+def storage_mode(config):
+    """Returns the mode in which files are stored in the node directories.
+
+    It is the value of the optional `storage_mode` key in `config`;
+    defaults to `shards`. See :data:`STORAGE_MODES`.
+
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :rtype: str
+
+    :raises ValueError:
+        If the mode is not in :data:`STORAGE_MODES`.
+
+    """
+    mode = config.get('storage_mode', STORAGE_MODES[0])
+    if mode not in STORAGE_MODES:
+        raise ValueError, "unknown storage mode '%s'" % mode
+
+    return mode
+
+
+def chunk_size(config):
+    """Returns the average size of a chunk.
+
+    It is the value of the optional `chunk_size` key in `config`;
+    defaults to :data:`CHUNK_SIZE`. All the computers sharing the
+    node directories must use the same size, for identical chunks to
+    be stored once.
+
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :rtype: int
+
+    :raises ValueError:
+        If the size is not a power of 2 greater than :data:`WINDOW`.
+
+    """
+    size = int(config.get('chunk_size', CHUNK_SIZE))
+    if size <= WINDOW or size & (size - 1):
+        raise ValueError, "chunk size must be a power of 2 > %d" % WINDOW
+
+    return size
+
+
+def _cut(data, start, end, avg_size):
+    """Returns the offset at which the chunk of `data` that starts at `start` ends.
+
+    See :func:`chunk_ranges`; `end` is the offset after the last byte
+    the chunk can have.
+
+    """
+    min_size = avg_size / 2
+    # top bits of the 32-bit hash; a cut point is found once every
+    # min_size bytes, on average, after the first min_size bytes.
+    bits = min_size.bit_length() - 1
+    mask = ((1 << bits) - 1) << (32 - bits)
+    gear = GEAR
+
+    # cut at the end, unless a cut point is found; the bytes are
+    # hashed SCAN_SIZE at a time.
+    h = 0
+    scan = start + min_size
+    while scan < end:
+        size = min(SCAN_SIZE, end - scan)
+        for i, b in enumerate(bytearray(buffer(data, scan, size))):
+            h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+            if not h & mask:
+                return scan + i + 1
+        scan += size
+
+    return end
+
+
+def chunk_ranges(data, avg_size=CHUNK_SIZE):
+    """Returns the byte ranges of the content-defined chunks `data` is cut into.
+
+    A chunk ends where a rolling hash of the last :data:`WINDOW`
+    bytes has its top bits all zero. As the cut points depend only on
+    the content around them, an insertion or deletion in `data` only
+    changes the chunks around it; the rest are cut exactly as before.
+
+    No chunk is smaller than half of `avg_size`, the bytes of which
+    are not hashed, or larger than 8 times `avg_size`; the last chunk
+    may be smaller.
+
+    The rolling hash is computed in Python, a byte at a time; data is
+    cut at only 10 to 20 MB/s. So, :func:`~combox.crypto.store_chunks`
+    cuts a file again only from its first chunk that changed.
+
+    :param data:
+        A string or a :func:`buffer`.
+    :param int avg_size:
+        The average size of a chunk; a power of 2.
+    :returns:
+        Generator that yields `(start, end)` tuples.
+    :rtype: generator
+
+    """
+    max_size = avg_size * 8
+
+    data_size = len(data)
+    start = 0
+    while start < data_size:
+        end = _cut(data, start, min(start + max_size, data_size), avg_size)
+        yield start, end
+        start = end
+
+
+def cut_chunks(file_, size, avg_size=CHUNK_SIZE):
+    """Read `size` bytes from file object `file_`, cut into content-defined chunks.
+
+    The chunks are the same as the ones :func:`chunk_ranges` cuts the
+    bytes into; but no more than the largest chunk, 8 times
+    `avg_size`, is read into memory at a time. Reading starts at the
+    current position of `file_`.
+
+    :param file file_:
+        File object opened for reading.
+    :param int size:
+        Number of bytes to read.
+    :param int avg_size:
+        The average size of a chunk; a power of 2.
+    :returns:
+        Generator that yields the chunks.
+    :rtype: generator
+
+    :raises IOError:
+        If there are fewer than `size` bytes left in `file_`; the
+        file was truncated while it was read, for instance.
+
+    """
+    max_size = avg_size * 8
+
+    data = ''
+    while size or data:
+        if size and len(data) < max_size:
+            more = file_.read(min(max_size - len(data), size))
+            if not more:
+                raise IOError(errno.EIO,
+                              "%s was truncated while it was read" %
+                              getattr(file_, 'name', 'file'))
+            size -= len(more)
+            data += more
+            if size and len(data) < max_size:
+                continue
+
+        end = _cut(data, 0, len(data), avg_size)
+        yield data[:end]
+        data = data[end:]
+
+
+def chunk_id(data, secret):
+    """Returns the id of the chunk `data`.
+
+    The id is an HMAC-SHA256 of the chunk keyed with `secret`; so,
+    identical chunks have the same id but the id doesn't reveal the
+    hash of their content.
+
+    :param data:
+        The chunk; a string or a :func:`buffer`.
+    :param str secret:
+        The passphrase.
+    :returns:
+        The hexdigest of the HMAC.
+    :rtype: str
+
+    """
+    return hmac.new(secret, data, sha256).hexdigest()
+
+
+def chunk_basename(cid):
+    """Returns the base name for the shards of the chunk `cid`.
+
+    :param str cid:
+        Id of the chunk; see :func:`chunk_id`.
+    :returns:
+        Path of the chunk relative to the node directories.
+    :rtype: str
+
+    """
+    return path.join(CHUNK_DIR, cid[:2], cid)
+
+
+def chunkp(p):
+    """Checks if `p` is a path in the chunk store of a node directory.
+
+    :param str p:
+        Path under a node directory.
+    :rtype: bool
+
+    """
+    return ('%s%s%s' % (sep, CHUNK_DIR, sep)) in ('%s%s' % (p, sep))
+
+
+def pack_manifest(chunks):
+    """Returns the manifest of a file made up of `chunks`.
+
+    :param list chunks:
+        List of `(cid, length)` tuples of the chunks of the file, in
+        order.
+    :rtype: str
+
+    """
+    return ''.join([MANIFEST_ENTRY.pack(unhexlify(cid), length)
+                    for cid, length in chunks])
+
+
+def unpack_manifest(manifest):
+    """Returns the list of chunks in `manifest`.
+
+    :param str manifest:
+        A manifest returned by :func:`pack_manifest`.
+    :returns:
+        List of `(cid, length)` tuples.
+    :rtype: list
+
+    :raises ValueError:
+        If `manifest` is truncated.
+
+    """
+    if len(manifest) % MANIFEST_ENTRY.size:
+        raise ValueError, "truncated manifest"
+
+    chunks = []
+    for offset in xrange(0, len(manifest), MANIFEST_ENTRY.size):
+        cid, length = MANIFEST_ENTRY.unpack_from(manifest, offset)
+        chunks.append((hexlify(cid), length))
+
+    return chunks
@@ -40,8 +40,24 @@
 ##      size: 3000
 ##      available: 1500
 ##
+## housekeep_workers: 4 # optional; defaults to the no. of CPUs
+## silo_flush_interval: 2 # optional; in seconds, defaults to 0 (see silo.py)
+## silo_max_dirty: 1000 # optional; defaults to 1000
+## silo_paranoid: false # optional; if true, always rehash files
+## digest: sha512 # optional; or md5, blake2b, xxh64
+## hash_cache_size: 4096 # optional; defaults to 4096
+## hash_cache_persist: false # optional; if true, saved in silo_dir
+## storage_mode: shards # optional; or chunks. In shards mode, a modified
+##                      # file is encrypted whole again; in chunks mode
+##                      # (cut at 10-20 MB/s), only from its first changed
+##                      # chunk on
+## chunk_size: 1048576 # optional; average chunk size, a power of 2
+## queue_workers: 4 # optional; defaults to the no. of CPUs
+## queue_size: 1024 # optional; defaults to 1024
+##
 ##################################################
 
+import errno
 import os
 import yaml
 import getpass
@@ -51,6 +67,18 @@ import stat
 
 from os import path
 from os.path import expanduser
+from threading import Lock
+
+SALT_SIZE = 16
+"""Size of the salt that the encryption key is derived with.
+
+"""
+
+_salt_lock = Lock()
+
+# maps the salt files read by this process to their salts; see
+# get_salt.
+_salts = {}
 
 
 def get_secret():
@@ -176,3 +204,52 @@ def get_nodedirs(config):
         nodes.append(node_path)
 
     return sorted(nodes)
+
+
+def get_salt(config):
+    """Returns the salt that the encryption key is derived with.
+
+    The salt is randomly generated the first time it is asked for and
+    stored in the `kdf.salt` file under the silo directory; it is read
+    from there after that, once per process, and kept in memory.
+
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :returns:
+        The salt; :data:`SALT_SIZE` bytes long.
+    :rtype: str
+
+    """
+    salt_file = path.join(config['silo_dir'], 'kdf.salt')
+
+    salt = _salts.get(salt_file)
+    if salt:
+        return salt
+
+    with _salt_lock:
+        if not path.exists(salt_file):
+            # the salt is written to a file of its own first, so that
+            # other processes never read a partly written salt.
+            tmp_file = '%s.%d' % (salt_file, os.getpid())
+            fd = os.open(tmp_file, os.O_WRONLY|os.O_CREAT|os.O_TRUNC,
+                         0600)
+            try:
+                os.write(fd, os.urandom(SALT_SIZE))
+            finally:
+                os.close(fd)
+
+            try:
+                # fails if another process got there first.
+                os.link(tmp_file, salt_file)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.remove(tmp_file)
+
+        with open(salt_file, 'rb') as f:
+            salt = f.read()
+
+        _salts[salt_file] = salt
+        return salt
@@ -21,18 +21,35 @@
 ## Adapted from https://gist.github.com/sekondus/4322469
 
 import base64
+import errno
 import os
+import struct
+import time
 
-from combox.config import get_nodedirs
-from combox.file import (read_file, write_file,
-                         read_shards, write_shards,
+from combox.chunk import (CHUNK_DIR, storage_mode, chunk_size,
+                          cut_chunks, chunk_id, chunk_basename,
+                          pack_manifest, unpack_manifest)
+from combox.config import get_nodedirs, get_salt
+from combox.file import (read_shards, write_shards,
                          split_data, glue_data,
-                         relative_path)
-from combox.log import log_i
+                         relative_path, shard_ranges,
+                         shard_path, shard_paths,
+                         read_chunks, write_chunks,
+                         hash_file, hash_chunks, node_pool, node_map,
+                         node_call, node_results,
+                         get_digest, new_hash, hexdigest,
+                         read_file,
+                         cb_path)
+from combox.log import log_i, log_e
 
 from Crypto.Cipher import AES
+from cStringIO import StringIO
 from datetime import datetime
+from hashlib import pbkdf2_hmac
+from itertools import chain
+from Queue import Queue
 from os import path
+from threading import Lock
 
 BLOCK_SIZE = 32
 """Specifies the block size of the data that is given to crypto functions.
@@ -42,8 +59,97 @@ BLOCK_SIZE = 32
 PAD_CHAR = '#'
 """Character for padding data to make it a multiple of :data:`BLOCK_SIZE`.
 
+The padding of binary shards is cut off using the length in their
+header (see :data:`SHARD_HEADER`); it is stripped off only from the
+legacy :mod:`base64` encoded shards.
+
+"""
+
+CHUNK_SIZE = BLOCK_SIZE * 3 * 32768
+"""Number of bytes of a file that are read and encrypted at a time.
+
+It is a multiple of both :data:`BLOCK_SIZE` and 3, so that
+:mod:`base64` encoded legacy shards can also be decoded a chunk at a
+time.
+
+"""
+
+QUEUED_CHUNKS = 4
+"""No. of chunks read for a shard that wait to be encrypted at a time.
+
+See :func:`split_and_encrypt`.
+
+"""
+
+SHARD_MAGIC = '\x89CBX'
+"""Magic bytes at the start of every binary shard.
+
+The first byte is not in the :mod:`base64` alphabet, which is how
+binary shards are told apart from the legacy base64 encoded shards.
+
+"""
+
+SHARD_VERSION = 2
+"""Version of the binary shard format written by :func:`encrypt`.
+
+Version 1 shards are encrypted with the padded passphrase as the key;
+version 2 shards with a key derived from the passphrase and the salt
+stored in their header (see :func:`get_cipher`).
+
+"""
+
+SHARD_PREFIX = struct.Struct('>4sB')
+"""Start of the header of every binary shard.
+
+Fields: :data:`SHARD_MAGIC`, format version.
+
+"""
+
+SHARD_HEADERS = {
+    1: struct.Struct('>4sBQHH'),
+    2: struct.Struct('>4sBQHH16s'),
+    3: struct.Struct('>4sBQHH16sB'),
+}
+"""Headers of the binary shard formats, by version.
+
+Fields: :data:`SHARD_MAGIC`, format version, length of the
+unencrypted shard, shard number, total no. of shards, from version 2
+on, the salt the key was derived with and, from version 3 on, flags
+(see :data:`FLAG_MANIFEST`).
+
+Version 3 is written only for shards that have flags set.
+
+"""
+
+FLAG_MANIFEST = 0x01
+"""Flag set in the header of the shards of a file's manifest.
+
+See :func:`store_chunks`.
+
 """
 
+CHUNK_GRACE = 86400
+"""No. of seconds an unreferenced chunk is kept for; see :func:`sweep_chunks`.
+
+"""
+
+SHARD_HEADER = SHARD_HEADERS[SHARD_VERSION]
+"""Header of the binary shards written by :func:`encrypt`.
+
+"""
+
+KDF_ITERATIONS = 100000
+"""No. of PBKDF2-HMAC-SHA256 iterations done to derive a key.
+
+"""
+
+_ciphers = {}
+"""Cipher objects, keyed on `(secret, salt)`; see :func:`get_cipher`.
+
+"""
+
+_ciphers_lock = Lock()
+
 def pad(data):
     """Pad `data` such that its length is a multiple of :data:`BLOCK_SIZE`.
 
@@ -61,58 +167,325 @@ def pad(data):
     return data
 
 
-def encrypt(data, secret):
+def get_cipher(secret, salt=None):
+    """Returns the AES cipher object for `secret` and `salt`.
+
+    The key is derived from `secret` and `salt` only the first time;
+    the cipher object is cached and reused after that, for the life of
+    the process.
+
+    :param str secret:
+        The passphrase.
+    :param str salt:
+        Salt to derive the key with, using PBKDF2-HMAC-SHA256 (see
+        :func:`~combox.config.get_salt`). If `None`, the key is the
+        padded `secret`; this is how legacy and version 1 shards are
+        encrypted.
+    :returns:
+        AES cipher object.
+
+    """
+    with _ciphers_lock:
+        aes = _ciphers.get((secret, salt))
+        if aes is None:
+            if salt is None:
+                key = pad(secret)
+            else:
+                key = pbkdf2_hmac('sha256', secret, salt,
+                                  KDF_ITERATIONS, 32)
+            aes = AES.new(key)
+            _ciphers[(secret, salt)] = aes
+
+    return aes
+
+
+def shard_header(length, shard_no=0, shards=1, salt=None, flags=0):
+    """Returns the header of a binary shard.
+
+    :param int length:
+        Length of the unencrypted shard.
+    :param int shard_no:
+        The shard number.
+    :param int shards:
+        Total no. of shards of the file.
+    :param str salt:
+        Salt the key of the shard is derived with. If `None`, a
+        version 1 header is returned.
+    :param int flags:
+        Flags of the shard (see :data:`FLAG_MANIFEST`). If set, a
+        version 3 header is returned; `salt` must not be `None`.
+    :returns:
+        The packed header.
+    :rtype: str
+
+    """
+    if salt is None:
+        return SHARD_HEADERS[1].pack(SHARD_MAGIC, 1, length,
+                                     shard_no, shards)
+
+    if flags:
+        return SHARD_HEADERS[3].pack(SHARD_MAGIC, 3, length,
+                                     shard_no, shards, salt, flags)
+
+    return SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION, length,
+                             shard_no, shards, salt)
+
+
+def header_size(head):
+    """Returns the size of the header of the shard that starts with `head`.
+
+    :param str head:
+        The first few bytes of a ciphered shard.
+    :returns:
+        `None` if `head` is too short to tell; `0` if it is a legacy
+        :mod:`base64` encoded shard; otherwise the size of the header
+        of the binary shard.
+    :rtype: int
+    :raises ValueError:
+        If the shard format version is not supported.
+
+    """
+    if len(head) < SHARD_PREFIX.size:
+        return None
+
+    magic, version = SHARD_PREFIX.unpack(
+        str(buffer(head, 0, SHARD_PREFIX.size)))
+    if magic != SHARD_MAGIC:
+        return 0
+
+    if version not in SHARD_HEADERS:
+        err_msg = "unsupported shard format version %d" % version
+        raise ValueError, err_msg
+
+    return SHARD_HEADERS[version].size
+
+
+def shard_info(cipher):
+    """Returns information stored in the header of the binary shard `cipher`.
+
+    :param str cipher:
+        A ciphered shard or its header.
+    :returns:
+        `None` if `cipher` is a legacy :mod:`base64` encoded shard;
+        otherwise a dict with keys `version`, `length`, `shard_no`,
+        `shards`, `salt` (`None` for version 1 shards), `flags` (`0`
+        for version 1 and 2 shards) and `header_size`.
+    :rtype: dict
+    :raises ValueError:
+        If the shard format version is not supported.
+
+    """
+    size = header_size(cipher)
+    if not size:
+        return None
+
+    version = ord(cipher[len(SHARD_MAGIC)])
+    fields = SHARD_HEADERS[version].unpack(str(buffer(cipher, 0, size)))
+
+    info = {'version': version, 'length': fields[2],
+            'shard_no': fields[3], 'shards': fields[4],
+            'salt': None, 'flags': 0, 'header_size': size}
+    if version >= 2:
+        info['salt'] = fields[5]
+    if version >= 3:
+        info['flags'] = fields[6]
+
+    return info
+
+
+def encrypt(data, secret, shard_no=0, shards=1, salt=None, flags=0):
     """Encrypt `data` and return cipher.
 
     :param str data:
-        Data to encrypt.
+        Data to encrypt; a string or a :func:`buffer`.
     :param str secret:
         The key to encrypt the `data` with.
+    :param int shard_no:
+        The shard number of `data`; stored in the shard header.
+    :param int shards:
+        Total no. of shards of the file `data` is part of; stored in
+        the shard header.
+    :param str salt:
+        Salt to derive the key from `secret` with; stored in the
+        shard header. See :func:`get_cipher`.
+    :param int flags:
+        Flags stored in the shard header; see :func:`shard_header`.
     :returns:
-       Encrypted `data` as :mod:`base64` encoded string.
+       Encrypted `data` as a binary shard; :func:`shard_header`
+       followed by the cipher.
     :rtype: str
 
     """
-    aes = AES.new(pad(secret))
-    cipher = base64.b64encode(aes.encrypt(pad(data)))
-
-    return cipher
+    header = shard_header(len(data), shard_no, shards, salt, flags)
+    return ''.join(chain([header], encrypt_chunks([data], secret, salt)))
 
 
 def decrypt(cipher, secret):
     """Decrypt `cipher` and return data.
 
     :param str cipher:
-        Encrypted data to decrypt.
+        Encrypted data to decrypt; a binary shard or a legacy
+        :mod:`base64` encoded shard.
     :param str secret:
         The key to decrypt the `cipher` with.
     :returns:
-        Decrypted data.
-    :rtype: str
+        Decrypted data. For a binary shard, it is a :func:`buffer` of
+        the exact length of the data in the decrypted cipher; the
+        padding is not scanned or copied.
+    :rtype: buffer or str
 
     """
-    aes = AES.new(pad(secret))
-    data = aes.decrypt(base64.b64decode(cipher)).rstrip(PAD_CHAR)
+    info = shard_info(cipher)
+    if info:
+        aes = get_cipher(secret, info['salt'])
+        data = aes.decrypt(buffer(cipher, info['header_size']))
+        return buffer(data, 0, info['length'])
 
-    return data
+    aes = get_cipher(secret)
+    data = aes.decrypt(base64.b64decode(cipher))
+
+    return data.rstrip(PAD_CHAR)
+
+
+def encrypt_chunks(chunks, secret, salt=None):
+    """Encrypt a shard that is given as a sequence of chunks.
+
+    The ciphers yielded do not include the header of the shard (see
+    :func:`shard_header`).
+
+    :param chunks:
+        Iterable of strings or buffers that together make up the
+        shard.
+    :param str secret:
+        The key to encrypt the `chunks` with.
+    :param str salt:
+        Salt to derive the key from `secret` with. See
+        :func:`get_cipher`.
+    :returns:
+        Generator that yields the cipher of the shard, piece by
+        piece.
+    :rtype: generator
+
+    """
+    aes = get_cipher(secret, salt)
+
+    # bytes that could not be encrypted yet, as they don't make a
+    # multiple of BLOCK_SIZE.
+    rem = ''
+    for chunk in chunks:
+        if rem:
+            data = rem + str(chunk)
+        else:
+            data = chunk
+        n = len(data) - (len(data) % BLOCK_SIZE)
+        yield aes.encrypt(buffer(data, 0, n))
+        rem = str(buffer(data, n))
+
+    yield aes.encrypt(pad(rem))
+
+
+def decrypt_chunks(chunks, secret):
+    """Decrypt a ciphered shard that is given as a sequence of chunks.
+
+    The concatenation of the data yielded is the same as the data
+    :func:`decrypt` returns for the whole ciphered shard.
+
+    :param chunks:
+        Iterable of strings that together make up the ciphered
+        shard; a binary shard or a legacy :mod:`base64` encoded
+        shard.
+    :param str secret:
+        The key to decrypt the `chunks` with.
+    :returns:
+        Generator that yields the decrypted shard, piece by piece, as
+        strings or buffers.
+    :rtype: generator
+
+    """
+    # look at the start of the shard to find its format.
+    chunks = iter(chunks)
+    head = ''
+    for chunk in chunks:
+        head += chunk
+        size = header_size(head)
+        if size is not None and len(head) >= size:
+            break
+
+    info = shard_info(head)
+    if info:
+        aes = get_cipher(secret, info['salt'])
+        chunks = chain([head[info['header_size']:]], chunks)
+        # raw cipher.
+        decode = str
+        align = BLOCK_SIZE
+        # no. of bytes of data yet to be decrypted; whatever comes
+        # after them is padding.
+        length = info['length']
+    else:
+        aes = get_cipher(secret)
+        chunks = chain([head], chunks)
+        decode = base64.b64decode
+        # no. of base64 characters that encode 3 blocks.
+        align = 4 * BLOCK_SIZE
+        length = None
 
+    # part of the cipher that could not be decrypted yet, as it
+    # doesn't make a multiple of `align'.
+    rem = ''
+    # PAD_CHARs at the end of the data decrypted so far from a legacy
+    # shard; they are held back until it is known whether they are
+    # padding.
+    pad_chars = ''
+    for chunk in chain(chunks, ['']):
+        cipher = rem + chunk
+        if chunk:
+            n = len(cipher) - (len(cipher) % align)
+        else:
+            # end of the shard.
+            n = len(cipher)
 
-def encrypt_shards(shards, secret):
+        data = aes.decrypt(decode(cipher[:n]))
+        rem = cipher[n:]
+
+        if length is not None:
+            if len(data) > length:
+                data = buffer(data, 0, length)
+            length -= len(data)
+            yield data
+            continue
+
+        data = pad_chars + data
+        data_stripped = data.rstrip(PAD_CHAR)
+        pad_chars = data[len(data_stripped):]
+
+        yield data_stripped
+
+
+def encrypt_shards(shards, secret, salt=None, flags=0):
     """Encrypt the `shards` of data and return a list of ciphers.
 
     :param list shards:
-        List of shards (strings).
+        List of shards (strings or buffers).
     :param str secret:
         The key to encrypt each shard.
+    :param str salt:
+        Salt to derive the key from `secret` with. See
+        :func:`get_cipher`.
+    :param int flags:
+        Flags stored in the header of each shard; see
+        :func:`shard_header`.
     :returns:
         List containing the encrypted shards.
     :rtype: list
 
     """
     ciphers = []
+    shard_no = 0
     for shard in shards:
-        cipher = encrypt(shard, secret)
+        cipher = encrypt(shard, secret, shard_no, len(shards), salt,
+                         flags)
         ciphers.append(cipher)
+        shard_no += 1
 
     return ciphers
 
@@ -137,7 +510,7 @@ def decrypt_shards(ciphers, secret):
     return shards
 
 
-def split_and_encrypt(fpath, config, fcontent=None):
+def split_and_encrypt(fpath, config, fcontent=None, fhash=None):
     """Splits file `fpath` into shards, encrypts the shards and spreads the shards across the node directories.
 
     Information about the node directories must be contained with the
@@ -169,8 +542,24 @@ def split_and_encrypt(fpath, config, fcontent=None):
         combox.
     :param str fcontent:
         Contents of the file at `fpath` (optional). When `None`, the
-        content of the file is read from disk; otherwise it just
-        assumes `fcontent` is the content of the file.
+        file is read once, in order, :data:`CHUNK_SIZE` bytes at a
+        time; each chunk is hashed and handed to the thread that
+        encrypts and writes its shard, so the file is never copied
+        into memory as a whole. Otherwise it just assumes `fcontent`
+        is the content of the file.
+    :param str fhash:
+        Hash of the content of the file when it was last split
+        (optional); see :func:`store_chunks`.
+    :returns:
+        Hash of the content of the file, computed while it is split;
+        the same as what :func:`~combox.file.hash_file` returns.
+    :rtype: str
+
+    If the storage mode is `chunks` (see
+    :func:`~combox.chunk.storage_mode`), the file is stored with
+    :func:`store_chunks` instead; given `fhash`, the hash of the file
+    when it was last stored, the file is cut again only from the first
+    chunk that changed since.
 
     """
     start = datetime.now()
@@ -182,28 +571,422 @@ def split_and_encrypt(fpath, config, fcontent=None):
 
     f = path.join(config['combox_dir'], rel_path)
 
-    if not fcontent:
-        fcontent = read_file(f)
+    f_basename =  rel_path
+    # gets the list of node' directories.
+    nodes = get_nodedirs(config)
 
-    f_shards = split_data(fcontent, SHARDS)
+    salt = get_salt(config)
+    digest = get_digest(config)
 
-    # encrypt shards
-    ciphered_shards = encrypt_shards(f_shards, config['topsecret'])
+    if storage_mode(config) == 'chunks':
+        fhash = store_chunks(fpath, config, fcontent, fhash)
+    elif fcontent is None:
+        with open(f, 'rb') as f_content:
+            f_size = os.fstat(f_content.fileno()).st_size
+            ranges = shard_ranges(f_size, SHARDS)
 
+            # the chunks of each shard, until None.
+            queues = [Queue(QUEUED_CHUNKS) for shard_no in range(SHARDS)]
 
-    # write ciphered shards to disk
-    f_basename =  rel_path
-    # gets the list of node' directories.
-    nodes = get_nodedirs(config)
+            def write_shard(shard_no):
+                chunks = iter(queues[shard_no].get, None)
+                try:
+                    # encrypt the shard and write it to its node
+                    # directory as it is read.
+                    s_start, s_end = ranges[shard_no]
+                    shard = shard_path(nodes[shard_no], f_basename,
+                                       shard_no)
+                    header = shard_header(s_end - s_start, shard_no,
+                                          SHARDS, salt)
+                    write_chunks(shard, chain([header], encrypt_chunks(
+                        chunks, config['topsecret'], salt)))
+                finally:
+                    # the reader must not block on a full queue.
+                    for chunk in chunks:
+                        pass
 
-    write_shards(ciphered_shards, nodes, f_basename)
+            # a thread for each node directory encrypts and writes a
+            # shard while the file is read and hashed, once and in
+            # order, here.
+            result = node_pool(SHARDS).map_async(node_call(write_shard),
+                                                 range(SHARDS))
+            try:
+                f_hash = new_hash(digest)
+                for shard_no, (s_start, s_end) in enumerate(ranges):
+                    size = s_end - s_start
+                    for chunk in read_chunks(f_content, size, CHUNK_SIZE):
+                        size -= len(chunk)
+                        f_hash.update(chunk)
+                        queues[shard_no].put(chunk)
+                    if size:
+                        raise IOError(errno.EIO, "%s was truncated while "
+                                      "it was read" % f, f)
+            finally:
+                for queue in queues:
+                    queue.put(None)
+                # all the shards are written, or failed.
+                results = result.get()
+            node_results(results)
+
+        fhash = hexdigest(f_hash, digest)
+    else:
+        f_shards = split_data(fcontent, SHARDS)
+
+        # encrypt shards
+        ciphered_shards = encrypt_shards(f_shards, config['topsecret'],
+                                         salt)
+
+        # write ciphered shards to disk
+        write_shards(ciphered_shards, nodes, f_basename)
+
+        fhash = hash_file(f, fcontent, digest)
 
     end = datetime.now()
     duration = (end - start).total_seconds() * pow(10, 3)
     log_i('Took %f ms  to split and encrypt %s' % (duration, fpath))
 
+    return fhash
+
+
+def store_chunks(fpath, config, fcontent=None, fhash=None):
+    """Cuts file `fpath` into chunks and stores the ones that are not in the node directories yet.
+
+    The file is cut into content-defined chunks (see
+    :func:`~combox.chunk.cut_chunks`). Each chunk is split into
+    shards, encrypted and written to the chunk store of the node
+    directories (see :data:`~combox.chunk.CHUNK_DIR`), unless a chunk
+    with the same id is already there; so, after a small change to a
+    file, only the chunks around the change are written, and identical
+    chunks of different files are stored once.
+
+    The manifest of the file -- the ids of its chunks, in order (see
+    :func:`~combox.chunk.pack_manifest`) -- is split, encrypted with
+    :data:`FLAG_MANIFEST` set and written to the node directories in
+    place of the file's shards.
+
+    Cutting a file is much slower than reading it (see
+    :func:`~combox.chunk.chunk_ranges`); so, if the file was stored
+    before (`fhash` is given), it is read along the chunks in its old
+    manifest and the chunks that are still the same -- the ones before
+    the first chunk whose id differs -- are kept; the file is cut only
+    from the first chunk that changed. The last chunk is always cut
+    again, as it was cut at the end of the file and not at a cut
+    point; so, a file that was appended to is cut from its old last
+    chunk on.
+
+    :param str fpath:
+        Path to an existent file.
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :param str fcontent:
+        Contents of the file at `fpath` (optional). When `None`, the
+        file is read a chunk at a time (see
+        :func:`~combox.chunk.cut_chunks`).
+    :param str fhash:
+        Hash of the content of the file when it was last stored
+        (optional); for instance, the hash stored in the silo. It only
+        tells that the file was stored before, whatever algorithm it
+        was computed with.
+    :returns:
+        Hash of the content of the file, computed while it is cut,
+        with the configured algorithm (see
+        :func:`~combox.file.get_digest`); the same as what
+        :func:`~combox.file.hash_file` returns.
+    :rtype: str
+
+    """
+    rel_path = relative_path(fpath, config)
+    f = path.join(config['combox_dir'], rel_path)
+    nodes = get_nodedirs(config)
+    SHARDS = len(nodes)
+    secret = config['topsecret']
+    salt = get_salt(config)
+    digest = get_digest(config)
+    avg_size = chunk_size(config)
+
+    def store(f_content, f_size):
+        # the unchanged chunks are read, and hashed, all the same.
+        f_hash = new_hash(digest)
+
+        chunks = unchanged_chunks(f_content, f_size, f_hash)
+        offset = sum([length for cid, length in chunks])
+        if chunks:
+            log_i("%s is unchanged up to byte %d; cutting it from there" %
+                  (fpath, offset))
+
+        f_content.seek(offset)
+        for chunk in cut_chunks(f_content, f_size - offset, avg_size):
+            f_hash.update(chunk)
+            cid = chunk_id(chunk, secret)
+            chunks.append((cid, len(chunk)))
+            write_chunk(cid, chunk)
+
+        manifest = pack_manifest(chunks)
+        write_shards(encrypt_shards(split_data(manifest, SHARDS), secret,
+                                    salt, FLAG_MANIFEST),
+                     nodes, rel_path)
+
+        return hexdigest(f_hash, digest)
+
+    def unchanged_chunks(f_content, f_size, f_hash):
+        if fhash is None:
+            return []
 
-def decrypt_and_glue(fpath, config, write=True):
+        try:
+            old_chunks = read_manifest(f, config)
+        except (IOError, OSError, IndexError, ValueError):
+            # not stored yet.
+            return []
+
+        if not old_chunks:
+            return []
+
+        # a chunk whose bytes are the same is cut at the same point;
+        # the cut point depends on the bytes of the chunk alone. The
+        # unchanged chunks are hashed on the way.
+        chunks = []
+        offset = 0
+        f_content.seek(0)
+        for cid, length in old_chunks[:-1]:
+            if offset + length > f_size:
+                break
+            chunk = f_content.read(length)
+            if len(chunk) != length or chunk_id(chunk, secret) != cid:
+                break
+            f_hash.update(chunk)
+            chunks.append((cid, length))
+            offset += length
+
+        return chunks
+
+    def write_chunk(cid, chunk):
+        basename = chunk_basename(cid)
+        c_shards = [shard_path(nodes[shard_no], basename, shard_no)
+                    for shard_no in range(SHARDS)]
+        if all([path.exists(c_shard) for c_shard in c_shards]):
+            # already stored.
+            return
+
+        for c_shard in c_shards:
+            try:
+                os.makedirs(path.dirname(c_shard))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        ciphers = encrypt_shards(split_data(chunk, SHARDS), secret, salt)
+
+        # written atomically; a chunk shard that exists is never
+        # written again.
+        def write_shard(shard_no):
+            write_chunks(c_shards[shard_no], [ciphers[shard_no]],
+                         atomic=True)
+
+        node_map(write_shard, range(SHARDS))
+
+    if fcontent is None:
+        with open(f, 'rb') as f_content:
+            return store(f_content, os.fstat(f_content.fileno()).st_size)
+
+    return store(StringIO(fcontent), len(fcontent))
+
+
+def read_manifest(fpath, config):
+    """Reads the manifest of `fpath` from the node directories.
+
+    :param str fpath:
+        The path to a file under the combox directory.
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :returns:
+        List of `(cid, length)` tuples of the chunks of the file (see
+        :func:`~combox.chunk.unpack_manifest`); `None` if the shards
+        of the file are not a manifest (see :func:`store_chunks`).
+    :rtype: list
+
+    """
+    f_shards = shard_paths(get_nodedirs(config), relative_path(fpath, config))
+
+    # only the header of the first shard is read to tell.
+    with open(f_shards[0], 'rb') as shard:
+        head = shard.read(SHARD_PREFIX.size)
+        size = header_size(head)
+        if not size:
+            return None
+        head += shard.read(size - len(head))
+
+    info = shard_info(head)
+    if not info or not info['flags'] & FLAG_MANIFEST:
+        return None
+
+    ciphers = node_map(read_file, f_shards)
+    return unpack_manifest(glue_data(decrypt_shards(ciphers,
+                                                    config['topsecret'])))
+
+
+def missing_chunks(fpath, config):
+    """Returns the ids of the chunks of `fpath` that are not in the node directories yet.
+
+    Sync clients do not sync files in any given order; the manifest of
+    a file (see :func:`store_chunks`) may arrive before its chunks.
+
+    :param str fpath:
+        The path to a file under the combox directory.
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :returns:
+        List of the ids of the chunks, some shard of which is not in
+        the node directories; empty if the shards of the file are not
+        a manifest.
+    :rtype: list
+
+    """
+    chunks = read_manifest(fpath, config)
+    if not chunks:
+        return []
+
+    nodes = get_nodedirs(config)
+
+    missing = []
+    for cid, length in chunks:
+        basename = chunk_basename(cid)
+        for shard_no, node in enumerate(nodes):
+            if not path.exists(shard_path(node, basename, shard_no)):
+                missing.append(cid)
+                break
+
+    return missing
+
+
+def glue_chunks(chunks, config):
+    """Reads the `chunks` from the chunk store of the node directories and decrypts them.
+
+    :param list chunks:
+        List of `(cid, length)` tuples; see :func:`read_manifest`.
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :returns:
+        Generator that yields the content of the chunks, in order.
+    :rtype: generator
+
+    :raises ValueError:
+        If a chunk's content does not match its id.
+
+    """
+    nodes = get_nodedirs(config)
+    secret = config['topsecret']
+
+    for cid, length in chunks:
+        ciphers = read_shards(nodes, chunk_basename(cid))
+        data = glue_data(decrypt_shards(ciphers, secret))
+        if len(data) != length or chunk_id(data, secret) != cid:
+            raise ValueError, "chunk %s is corrupt" % cid
+
+        yield data
+
+
+def sweep_chunks(config, grace=CHUNK_GRACE):
+    """Removes the chunks that are not in the manifest of any file.
+
+    The manifests of all the files are read from the first node
+    directory. Chunks younger than `grace` seconds are kept, as they
+    may belong to a file whose manifest has not reached this computer
+    yet; nothing is removed if a manifest cannot be read.
+
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :param int grace:
+        Minimum age, in seconds, of a chunk that is removed.
+    :returns:
+        No. of chunk shards removed.
+    :rtype: int
+
+    """
+    nodes = get_nodedirs(config)
+
+    used = set()
+    for root, dirs, files in os.walk(nodes[0]):
+        if CHUNK_DIR in dirs:
+            dirs.remove(CHUNK_DIR)
+
+        for f in files:
+            shard = path.join(root, f)
+            if not shard[:-1].endswith('.shard'):
+                continue
+
+            try:
+                chunks = read_manifest(cb_path(shard, config), config)
+            except (IOError, OSError, IndexError, ValueError), e:
+                log_e("Unable to read manifest %s, not sweeping chunks: %s"
+                      % (shard, e))
+                return 0
+
+            if chunks:
+                used.update([cid for cid, length in chunks])
+
+    removed = 0
+    now = time.time()
+    for node in nodes:
+        for root, dirs, files in os.walk(path.join(node, CHUNK_DIR)):
+            for f in files:
+                c_shard = path.join(root, f)
+                cid = f.partition('.shard')[0]
+                try:
+                    if (cid in used or
+                        now - os.stat(c_shard).st_mtime < grace):
+                        continue
+                    os.remove(c_shard)
+                    removed += 1
+                except OSError, e:
+                    log_e("Unable to remove chunk %s: %s" % (c_shard, e))
+
+    if removed:
+        log_i("Removed %d chunk shards no longer used" % removed)
+
+    return removed
+
+
+def glue_shards(f_shards, secret):
+    """Decrypt the shards at paths `f_shards` and glue them, a chunk at a time.
+
+    :param list f_shards:
+        Paths of the ciphered shards of a file, in order.
+    :param str secret:
+        The key to decrypt the shards with.
+    :returns:
+        Generator that yields the content of the file, piece by
+        piece.
+    :rtype: generator
+
+    """
+    for f_shard in f_shards:
+        with open(f_shard, 'rb') as shard:
+            shard_size = os.fstat(shard.fileno()).st_size
+
+            # the header is read on its own so that the chunks that
+            # follow it are aligned to BLOCK_SIZE.
+            head = shard.read(SHARD_PREFIX.size)
+            size = header_size(head)
+            if size:
+                head += shard.read(size - len(head))
+                chunks = chain([head], read_chunks(
+                    shard, shard_size - len(head), CHUNK_SIZE))
+            else:
+                # legacy shard.
+                shard.seek(0)
+                chunks = read_chunks(shard, shard_size, CHUNK_SIZE)
+
+            for data in decrypt_chunks(chunks, secret):
+                yield data
+
+
+def decrypt_and_glue(fpath, config, write=True, hash_only=False,
+                     digest=None, fhash=None):
     """Reads encrypted shards from the node directories, decrypts and reconstructs `fpath`.
 
     :param str fpath:
@@ -213,11 +996,33 @@ def decrypt_and_glue(fpath, config, write=True):
         A dictionary that contains configuration information about
         combox.
     :param bool write:
-        If `True`, writes the reconstructed content to disk.
+        If `True`, the shards are read, decrypted and written to disk
+        :data:`CHUNK_SIZE` bytes at a time, one shard after the
+        other; the reconstructed file is renamed to `fpath` only
+        after it is completely written.
+    :param bool hash_only:
+        If `True`, the shards are read and decrypted
+        :data:`CHUNK_SIZE` bytes at a time, as when `write` is `True`,
+        but only hashed; nothing is written and the content is never
+        held in memory as a whole.
+    :param str digest:
+        Name of the digest algorithm to hash the content with (see
+        :data:`~combox.file.DIGESTS`); the configured algorithm (see
+        :func:`~combox.file.get_digest`) if `None`.
+    :param str fhash:
+        If not `None`, it is assumed to be the hash of the content,
+        computed with `digest`; the file is written without being
+        hashed and `fhash` is returned.
     :returns:
-        The glued content.
+        The glued content if `write` and `hash_only` are `False`;
+        otherwise, hash of the content of the file, computed while it
+        is glued; the same as what :func:`~combox.file.hash_file`
+        returns.
     :rtype: str
 
+    If the shards of the file are a manifest, the file is glued from
+    its chunks (see :func:`store_chunks`).
+
     """
     rel_path = relative_path(fpath, config)
 
@@ -226,6 +1031,31 @@ def decrypt_and_glue(fpath, config, write=True):
     # gets the list of node' directories.
     nodes = get_nodedirs(config)
 
+    f_chunks = read_manifest(fpath, config)
+
+    if write or hash_only:
+        if f_chunks is None:
+            f_shards = shard_paths(nodes, f_basename)
+            data = glue_shards(f_shards, config['topsecret'])
+        else:
+            data = glue_chunks(f_chunks, config)
+        if fhash is not None and not hash_only:
+            # hashed already.
+            write_chunks(f, data, atomic=True)
+            return fhash
+        digest = digest or get_digest(config)
+        f_hash = new_hash(digest)
+        chunks = hash_chunks(data, f_hash)
+        if hash_only:
+            for chunk in chunks:
+                pass
+        else:
+            write_chunks(f, chunks, atomic=True)
+        return hexdigest(f_hash, digest)
+
+    if f_chunks is not None:
+        return glue_data(glue_chunks(f_chunks, config))
+
     ciphered_shards = read_shards(nodes, f_basename)
 
     # decrypt shards
@@ -234,8 +1064,4 @@ def decrypt_and_glue(fpath, config, write=True):
     # glue them together
     f_content = glue_data(f_parts)
 
-    if write:
-        # write the glued content to fpath
-        write_file(f, f_content)
-
     return f_content
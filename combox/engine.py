@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+import logging
+
+import combox.config
+import combox.crypto
+import combox.file
+
+from itertools import chain
+from multiprocessing import Pool, cpu_count
+from threading import Lock, RLock
+
+from combox.crypto import split_and_encrypt, decrypt_and_glue
+from combox.file import file_stat, hash_digest, stat_hash
+from combox.log import log_i, log_e
+
+
+BATCH_SIZE = 256
+"""No. of files whose info is written to the silo at a time.
+
+"""
+
+PROGRESS_STEP = 100
+"""No. of files after which the progress of :func:`glue_files` is logged.
+
+"""
+
+def housekeep_workers(config):
+    """Returns the no. of processes to shard or glue files with, while housekeeping.
+
+    It is the value of the optional `housekeep_workers` key in
+    `config`; defaults to the no. of CPUs.
+
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :rtype: int
+
+    """
+    workers = config.get('housekeep_workers')
+    if not workers:
+        workers = cpu_count()
+
+    return max(int(workers), 1)
+
+
+def _init_worker():
+    """Initializes a process in the pool of :func:`run_jobs`.
+
+    The locks and thread pools inherited from the parent process may
+    have been in use by its other threads when it forked; they're
+    replaced by fresh ones. That includes the locks of :mod:`logging`
+    and of its handlers, which every :func:`~combox.log.log_i` takes.
+
+    """
+    combox.file._node_pools = {}
+    combox.file._node_pools_lock = Lock()
+    combox.crypto._ciphers_lock = Lock()
+    combox.config._salt_lock = Lock()
+
+    logging._lock = RLock()
+    for handler in logging.getLogger().handlers:
+        handler.createLock()
+
+
+def shard_file(job):
+    """Shards the file in `job`, if it is new or was modified.
+
+    This is what the processes in the pool of :func:`shard_files`
+    run.
+
+    :param tuple job:
+        `(fpath, fhash_in_silo, config)`; `fhash_in_silo` is the hash
+        of the file stored in the silo, or `None` if the file is not
+        tracked yet.
+    :returns:
+        `(fpath, fhash, fstat)`; `fhash` is the hash of the file, or
+        `None` if the file could not be read; `fstat` is the stats of
+        the file (see :func:`~combox.file.file_stat`) taken before it
+        was hashed.
+    :rtype: tuple
+
+    """
+    fpath, fhash_in_silo, config = job
+
+    try:
+        if fhash_in_silo is not None:
+            # hashed with the same algorithm as the hash in the silo.
+            fhash, fstat = stat_hash(fpath,
+                                     digest=hash_digest(fhash_in_silo))
+            if fhash == fhash_in_silo:
+                # only the stats changed.
+                return fpath, fhash, fstat
+            log_i("%s was modified. Updating DB and shards..." % fpath)
+        else:
+            log_i("Adding new file %s..." % fpath)
+
+        fhash, fstat = stat_hash(fpath, split_and_encrypt, config,
+                                 fhash=fhash_in_silo)
+        return fpath, fhash, fstat
+    except (IOError, OSError), e:
+        # file was probably removed or moved since.
+        log_e("Unable to shard %s: %s" % (fpath, e))
+        return fpath, None, None
+
+
+def glue_file(job):
+    """Reconstructs the file in `job` from its shards.
+
+    This is what the processes in the pool of :func:`glue_files` run.
+
+    :param tuple job:
+        `(fpath, config)`.
+    :returns:
+        `(fpath, fhash, fstat)`; `fhash` is the hash of the
+        reconstructed file, or `None` if it could not be
+        reconstructed; `fstat` is the stats of the reconstructed file
+        (see :func:`~combox.file.file_stat`).
+    :rtype: tuple
+
+    """
+    fpath, config = job
+
+    try:
+        log_i("%s was created remotely. Creating it locally now..." %
+              fpath)
+        fhash = decrypt_and_glue(fpath, config)
+        return fpath, fhash, file_stat(fpath)
+    except (IOError, OSError, IndexError, ValueError), e:
+        # shards were probably removed or moved since.
+        log_e("Unable to reconstruct %s: %s" % (fpath, e))
+        return fpath, None, None
+
+
+def run_jobs(func, jobs, workers):
+    """Runs `func` on each of the `jobs` on a pool of processes.
+
+    :param function func:
+        A function defined at the top-level of a module; it is given
+        a job and must return a picklable result.
+    :param list jobs:
+        List of picklable jobs.
+    :param int workers:
+        Maximum no. of processes in the pool. If there's only one
+        process to run, `func` is run in this process.
+    :returns:
+        Generator that yields the results of `func`, in the order the
+        jobs finish.
+    :rtype: generator
+
+    """
+    workers = min(workers, len(jobs))
+    if workers < 2:
+        for job in jobs:
+            yield func(job)
+        return
+
+    pool = Pool(workers, _init_worker)
+    try:
+        for result in pool.imap_unordered(func, jobs):
+            yield result
+    finally:
+        # all the results are in, unless something went wrong.
+        pool.terminate()
+        pool.join()
+
+
+def shard_files(files, config, silo):
+    """Shards the `files` that are new or modified on a pool of processes.
+
+    The no. of processes is given by :func:`housekeep_workers`. A
+    tracked file whose hash is in the silo's
+    :class:`~combox.hashcache.HashCache` is not hashed again. The
+    hashes and stats of the files are written to `silo`
+    :data:`BATCH_SIZE` files at a time; the stats of files that were
+    not modified are refreshed too.
+
+    :param list files:
+        List of `(fpath, fhash_in_silo)` tuples; see
+        :func:`shard_file`.
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :param silo:
+        The :class:`~combox.silo.ComboxSilo` object to update.
+    :returns:
+        No. of files that were sharded.
+    :rtype: int
+
+    """
+    cached = []
+    jobs = []
+    for fpath, fhash in files:
+        fstat = None
+        if fhash is not None:
+            try:
+                fstat = file_stat(fpath)
+            except OSError:
+                # see shard_file.
+                pass
+
+        if fstat is not None and silo.hashes.get(fpath, fstat) == fhash:
+            # only the stats changed.
+            cached.append((fpath, fhash, fstat))
+        else:
+            jobs.append((fpath, fhash, config))
+
+    fhashes_in_silo = dict(files)
+    results = run_jobs(shard_file, jobs, housekeep_workers(config))
+
+    sharded = 0
+    batch = {}
+    stats = {}
+    try:
+        for fpath, fhash, fstat in chain(cached, results):
+            if fhash is None:
+                continue
+
+            if fhash != fhashes_in_silo[fpath]:
+                sharded += 1
+            batch[fpath] = fhash
+            stats[fpath] = fstat
+            if len(batch) >= BATCH_SIZE:
+                silo.update_many(batch, stats)
+                batch = {}
+                stats = {}
+    finally:
+        results.close()
+        if batch:
+            silo.update_many(batch, stats)
+
+    return sharded
+
+
+def glue_files(fpaths, config, silo):
+    """Reconstructs the files at `fpaths` from their shards on a pool of processes.
+
+    The no. of processes is given by :func:`housekeep_workers`. Each
+    process reconstructs one file at a time and writes it
+    :data:`~combox.crypto.CHUNK_SIZE` bytes at a time (see
+    :func:`~combox.crypto.decrypt_and_glue`); so, the memory used does
+    not depend on the size or the no. of the files. The progress is
+    logged every :data:`PROGRESS_STEP` files.
+
+    The hashes and stats of the reconstructed files are written to `silo`
+    :data:`BATCH_SIZE` files at a time and the files are removed from
+    its `file_created` dictionary.
+
+    :param list fpaths:
+        Paths of files under the combox directory whose shards are
+        all in the node directories.
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :param silo:
+        The :class:`~combox.silo.ComboxSilo` object to update.
+    :returns:
+        No. of files that were reconstructed.
+    :rtype: int
+
+    """
+    def update_silo(batch, stats):
+        with silo.batch():
+            silo.update_many(batch, stats)
+            for fpath in batch:
+                silo.node_rem('file_created', fpath)
+
+    jobs = [(fpath, config) for fpath in fpaths]
+    results = run_jobs(glue_file, jobs, housekeep_workers(config))
+
+    done = 0
+    glued = 0
+    batch = {}
+    stats = {}
+    try:
+        for fpath, fhash, fstat in results:
+            done += 1
+            if done % PROGRESS_STEP == 0:
+                log_i("Reconstructing files: %d of %d done" %
+                      (done, len(jobs)))
+
+            if fhash is None:
+                continue
+
+            batch[fpath] = fhash
+            stats[fpath] = fstat
+            glued += 1
+            if len(batch) >= BATCH_SIZE:
+                update_silo(batch, stats)
+                batch = {}
+                stats = {}
+    finally:
+        results.close()
+        if batch:
+            update_silo(batch, stats)
+
+    if jobs:
+        log_i("Reconstructed %d of %d files" % (glued, len(jobs)))
+
+    return glued
@@ -21,24 +21,36 @@
 import os
 import platform
 import logging
-import time
 
 from os import path
 from threading import Lock
-from threading import Timer
 
 from watchdog.events import LoggingEventHandler
 
+from combox.chunk import CHUNK_DIR, chunkp, storage_mode
 from combox.config import get_nodedirs
-from combox.crypto import split_and_encrypt, decrypt_and_glue
+from combox.crypto import (split_and_encrypt, decrypt_and_glue,
+                           missing_chunks, sweep_chunks)
+from combox.engine import shard_files, glue_files
 from combox.file import (mk_nodedir, rm_nodedir, rm_shards,
                          relative_path, move_shards, move_nodedir,
-                         cb_path, node_path, hash_file, rm_path,
-                         node_paths, no_of_shards)
+                         cb_path, node_path, file_stat, rm_path,
+                         node_paths, no_of_shards, stat_hash,
+                         hash_digest)
 from combox.log import log_i, log_e
+from combox.scheduler import (QUIET_PERIOD, Debouncer, DelayedScheduler,
+                              job_queue, quiet_period)
 from combox.silo import ComboxSilo
 
 
+CHUNK_WAIT = 30
+"""No. of seconds after which the files whose chunks are awaited are looked at again.
+
+See :meth:`NodeDirMonitor.glue_awaited`.
+
+"""
+
+
 class ComboxDirMonitor(LoggingEventHandler):
     """Monitors combox directory for changes and makes corresponding changes in node directories.
 
@@ -63,13 +75,26 @@ class ComboxDirMonitor(LoggingEventHandler):
         combox.
     :param threading.Lock dblock:
         Lock to access the :class:`.ComboxSilo`. object.
-    :param threading.Lock monitor_lock:
-        Lock shared by :class:`.ComboxDirMonitor` and all the
-        :class:`.NodeDirMonitor` objects.
+    :param locks:
+        The :class:`.PathLocks` object shared by
+        :class:`.ComboxDirMonitor` and all the
+        :class:`.NodeDirMonitor` objects; the paths under the combox
+        directory are held with it while they are being worked on.
+    :param silo:
+        The :class:`.ComboxSilo` object shared by
+        :class:`.ComboxDirMonitor` and all the
+        :class:`.NodeDirMonitor` objects. If `None`, a new one is
+        created with `dblock`.
+    :param jobs:
+        The :class:`~combox.scheduler.JobQueue` shared by
+        :class:`.ComboxDirMonitor` and all the
+        :class:`.NodeDirMonitor` objects; the event handlers put the
+        work to be done in it. If `None`, a new one is created (see
+        :func:`~combox.scheduler.job_queue`).
 
     """
 
-    def __init__(self, config, dblock, monitor_lock):
+    def __init__(self, config, dblock, locks, silo=None, jobs=None):
         """Initialize :class:`.ComboxDirMonitor`.
 
         """
@@ -80,12 +105,16 @@ class ComboxDirMonitor(LoggingEventHandler):
                             datefmt='%Y-%m-%d %H:%M:%S')
 
         self.config = config
-        self.silo = ComboxSilo(self.config, dblock)
-        self.lock = monitor_lock
+        self.silo = silo if silo else ComboxSilo(self.config, dblock)
+        self.locks = locks
+        self.jobs = jobs if jobs else job_queue(self.config)
 
         # tracks files that are created during the course of this run.
         self.just_created = {}
 
+        # runs the jobs of modified files once they are left alone.
+        self.debouncer = Debouncer()
+
         self.housekeep()
 
 
@@ -110,6 +139,21 @@ class ComboxDirMonitor(LoggingEventHandler):
             return False
 
 
+    def untracked_tmp_file(self, file_path):
+        """Returns `True` if `file_path` is a temporary file that is not in the silo.
+
+        Events of such files are dropped before they are put in the
+        :attr:`jobs` queue, where they would hold up the later jobs of
+        their paths; there are no shards to move or remove.
+
+        :param str file_path:
+            Path of a file.
+        :rtype: bool
+
+        """
+        return self.tmp_file(file_path) and not self.silo.exists(file_path)
+
+
     def housekeep(self):
         """Recursively traverses combox directory, discovers changes and updates silo and node directories. This method must **never** be called directly.
 
@@ -129,42 +173,51 @@ class ComboxDirMonitor(LoggingEventHandler):
           it creates their respective encrypted shards and spreads
           them across the node directories.
 
+        The modified and new files are sharded on a pool of processes
+        (see :func:`~combox.engine.shard_files`).
+
         """
         log_i("combox monitor is housekeeping")
         log_i("Please don't make any changes to combox directory now")
 
         # Remove information about files that were deleted.
-        fpath_filter = lambda x: x not in self.silo.nodedicts()
-        fpaths = filter(fpath_filter, self.silo.keys())
-
-        for fpath in fpaths:
-            if not path.exists(fpath):
-                # remove this file's info from silo.
-                log_i("%s was deleted. Removing it from DB" % fpath)
-                self.silo.remove(fpath)
-                # also purge the file's shards in node directories.
-                rm_shards(fpath, self.config)
+        fpaths = self.silo.keys()
+
+        # the silo is updated in a single transaction.
+        with self.silo.batch():
+            for fpath in fpaths:
+                if not path.exists(fpath):
+                    # remove this file's info from silo.
+                    log_i("%s was deleted. Removing it from DB" % fpath)
+                    self.silo.remove(fpath)
+                    # also purge the file's shards in node directories.
+                    rm_shards(fpath, self.config)
 
         # Add/update information about files that were created/modded.
-        # Also do split_and_encrypt on files that were created/modded.
+        # Also do split_and_encrypt on files that were created/modded;
+        # on a pool of processes.
+        fpaths = []
         for root, dirs, files in os.walk(self.config['combox_dir']):
 
             for f in files:
                 fpath = path.join(root, f)
+                fhash = self.silo.get(fpath)
+
+                if fhash is None and self.tmp_file(fpath):
+                    # untracked temporary file.
+                    continue
+
+                if fhash is not None and self.silo.unchanged(fpath):
+                    # not modified since it was last hashed.
+                    continue
+
+                fpaths.append((fpath, fhash))
 
-                if (self.silo.exists(fpath) and
-                    self.silo.stale(fpath)):
-                    # file was modified
-                    log_i("%s was modified. Updating DB and shards..." % fpath)
-                    split_and_encrypt(fpath, self.config)
-                    self.silo.update(fpath)
-                elif (not self.silo.exists(fpath)
-                      and not self.tmp_file(fpath)):
-                    # new file
-                    log_i("Adding new file %s..." % fpath)
-                    split_and_encrypt(fpath, self.config)
-                    self.silo.update(fpath)
+        shard_files(fpaths, self.config, self.silo)
 
+        if storage_mode(self.config) == 'chunks':
+            # chunks of files that were deleted or modified.
+            sweep_chunks(self.config)
 
         log_i("combox monitor is done with housekeeping")
         log_i("Do what you want to the combox directory")
@@ -179,6 +232,15 @@ class ComboxDirMonitor(LoggingEventHandler):
         If a file is renamed/moved, it renames/moves the shards of the
         file in all the node directories and updates the DB.
 
+        This is done by :meth:`moved`, on the :attr:`jobs` queue.
+
+        A temporary file that is not tracked (see
+        :meth:`untracked_tmp_file`) and is renamed into place -- by an
+        editor or by :func:`~combox.file.write_chunks` -- has no
+        shards to move; it is a modification of the file it is renamed
+        to (see :meth:`on_modified`), or is ignored if that is a
+        temporary file too.
+
         :param event:
             The event object representing the file system event.
         :type event:
@@ -187,12 +249,34 @@ class ComboxDirMonitor(LoggingEventHandler):
         """
         super(ComboxDirMonitor, self).on_moved(event)
 
+        if (not event.is_directory and
+            self.untracked_tmp_file(event.src_path)):
+            if self.tmp_file(event.dest_path):
+                log_i("Moved tmp file %s...ignoring" % event.src_path)
+            else:
+                log_i("Moved tmp file %s to %s; %s was modified" %
+                      (event.src_path, event.dest_path, event.dest_path))
+                self.schedule_reshard(event.dest_path)
+            return
+
+        kind = 'directory' if event.is_directory else 'move'
+        self.jobs.put(kind, [event.src_path, event.dest_path], self.moved,
+                      event)
+
+
+    def moved(self, event):
+        """Does the work of :meth:`on_moved`.
+
+        :param event:
+            The event object representing the file system event.
+
+        """
         if event.is_directory:
-            with self.lock:
+            with self.locks.hold(event.src_path, event.dest_path):
                 # creates a corresponding directory at the node dirs.
                 move_nodedir(event.src_path, event.dest_path, self.config)
         else:
-            with self.lock:
+            with self.locks.hold(event.src_path, event.dest_path):
                 # file moved
                 move_shards(event.src_path, event.dest_path, self.config)
                 # update file info in silo.
@@ -214,6 +298,8 @@ class ComboxDirMonitor(LoggingEventHandler):
               directories.
             - Store hash of the file in DB.
 
+        This is done by :meth:`created`, on the :attr:`jobs` queue.
+
         :param event:
             The event object representing the file system event.
         :type event:
@@ -232,20 +318,32 @@ class ComboxDirMonitor(LoggingEventHandler):
         # on_modified is called after this file creatiion.
         self.just_created[event.src_path] = True
 
+        kind = 'directory' if event.is_directory else 'shard'
+        self.jobs.put(kind, [event.src_path], self.created, event)
+
+
+    def created(self, event):
+        """Does the work of :meth:`on_created`.
+
+        :param event:
+            The event object representing the file system event.
+
+        """
         file_node_path = node_path(event.src_path, self.config,
                                    not event.is_directory)
 
         if event.is_directory and (not path.exists(file_node_path)):
-            with self.lock:
+            with self.locks.hold(event.src_path):
                 # creates a corresponding directory at the node dirs.
                 mk_nodedir(event.src_path, self.config)
         elif (not event.is_directory) and (not path.exists(
                 file_node_path)):
-            with self.lock:
-                # file was created
-                split_and_encrypt(event.src_path, self.config)
+            with self.locks.hold(event.src_path):
+                # file was created.
+                fhash, fstat = stat_hash(event.src_path,
+                                         split_and_encrypt, self.config)
                 # store file info in silo.
-                self.silo.update(event.src_path)
+                self.silo.update(event.src_path, fhash, fstat)
 
 
     def on_deleted(self, event):
@@ -258,6 +356,10 @@ class ComboxDirMonitor(LoggingEventHandler):
         the node directories and removes information about the file in
         the DB.
 
+        This is done by :meth:`deleted`, on the :attr:`jobs` queue. A
+        temporary file that is not tracked (see
+        :meth:`untracked_tmp_file`) is ignored.
+
         :param event:
             The event object representing the file system event.
         :type event:
@@ -266,15 +368,32 @@ class ComboxDirMonitor(LoggingEventHandler):
         """
         super(ComboxDirMonitor, self).on_deleted(event)
 
+        if (not event.is_directory and
+            self.untracked_tmp_file(event.src_path)):
+            # ignore tmp files.
+            log_i("Deleted tmp file %s...ignoring" % event.src_path)
+            return
+
+        kind = 'directory' if event.is_directory else 'delete'
+        self.jobs.put(kind, [event.src_path], self.deleted, event)
+
+
+    def deleted(self, event):
+        """Does the work of :meth:`on_deleted`.
+
+        :param event:
+            The event object representing the file system event.
+
+        """
         file_node_path = node_path(event.src_path, self.config,
                                    not event.is_directory)
 
         if event.is_directory and (path.exists(file_node_path)):
             # Delete corresponding directory in the nodes.
-            with self.lock:
+            with self.locks.hold(event.src_path):
                 rm_nodedir(event.src_path, self.config)
         elif(not event.is_directory) and (path.exists(file_node_path)):
-            with self.lock:
+            with self.locks.hold(event.src_path):
                 # remove the corresponding file shards in the node
                 # directories.
                 rm_shards(event.src_path, self.config)
@@ -295,6 +414,16 @@ class ComboxDirMonitor(LoggingEventHandler):
               directories, replacing the ol' shards.
             - Update the hash of the file stored in the DB.
 
+        In the `chunks` storage mode, if the file was only appended
+        to, only the appended bytes are stored (see
+        :func:`~combox.crypto.store_chunks`).
+
+        The file is not sharded right away; it is sharded by
+        :meth:`reshard`, on the :attr:`jobs` queue, once it is left
+        alone for a while (see :class:`~combox.scheduler.Debouncer`).
+        So, a burst of modifications to the file is sharded once and
+        the thread that dispatches the events does not wait.
+
         :param event:
             The event object representing the file system event.
         :type event:
@@ -314,39 +443,66 @@ class ComboxDirMonitor(LoggingEventHandler):
             pass
         else:
             # file was modified
-            with self.lock:
-                f_size_MiB = path.getsize(event.src_path) / 1048576.0
-                log_i('%s modified %f' % (event.src_path, f_size_MiB))
-
-                # introduce delay to prevent multiple "file modified"
-                # events from being generated.
-                if f_size_MiB >= 30:
-                    sleep_time = (f_size_MiB / 30.0)
-                    log_i("waiting on_modified combox monitor %f" % sleep_time)
-                    time.sleep(sleep_time)
-                    log_i("end waiting on_modified combox monitor")
-                else:
-                    time.sleep(1)
 
-                # watchdog's weirdness
-                # --------------------
-                #
-                # On GNU/Linux, when a file is created, watchdog
-                # generates a 'file created' and a 'file modified'
-                # event; we're tracking this behaviour and ignoring
-                # the 'file modified' event.
-                #
-                if (self.just_created.has_key(event.src_path) and
-                    self.just_created[event.src_path] and
-                    platform.system() == 'Linux'):
-                    self.just_created[event.src_path] = False
-                    log_i("Just created file %s. So ignoring on_modified call." % (
-                        event.src_path))
-                    return
+            # watchdog's weirdness
+            # --------------------
+            #
+            # On GNU/Linux, when a file is created, watchdog
+            # generates a 'file created' and a 'file modified'
+            # event; we're tracking this behaviour and ignoring
+            # the 'file modified' event.
+            #
+            if (self.just_created.has_key(event.src_path) and
+                self.just_created[event.src_path] and
+                platform.system() == 'Linux'):
+                self.just_created[event.src_path] = False
+                log_i("Just created file %s. So ignoring on_modified call." % (
+                    event.src_path))
+                return
 
-                split_and_encrypt(event.src_path, self.config)
-                # update file info in silo.
-                self.silo.update(event.src_path)
+            self.schedule_reshard(event.src_path)
+
+
+    def schedule_reshard(self, fpath):
+        """Schedules :meth:`reshard` of the modified file `fpath`.
+
+        It waits for the "file modified" events of the file to stop
+        coming; see :meth:`on_modified`.
+
+        :param str fpath:
+            Path of a file under the combox directory.
+
+        """
+        delay = quiet_period(fpath)
+        log_i('%s modified; resharding it in %f s' % (fpath, delay))
+        self.debouncer.schedule(fpath, delay, self.jobs.put, 'shard',
+                                [fpath], self.reshard, fpath)
+
+
+    def reshard(self, fpath):
+        """Shards the modified file `fpath` again and updates its info in the silo.
+
+        Put in the :attr:`jobs` queue by the :attr:`debouncer`; see
+        :meth:`on_modified`. Nothing is done if the stats of the file
+        are the same as the ones in the silo; for instance, if the
+        file was reconstructed from its shards by the
+        :class:`NodeDirMonitor`.
+
+        :param str fpath:
+            Path of a file under the combox directory.
+
+        """
+        with self.locks.hold(fpath):
+            if self.silo.unchanged(fpath):
+                log_i("%s is unchanged; not resharding it" % fpath)
+                return
+
+            # if the file was only appended to, only the appended
+            # bytes are stored (in the chunks storage mode).
+            fhash, fstat = stat_hash(fpath, split_and_encrypt, self.config,
+                                     fhash=self.silo.get(fpath))
+            # update file info in silo.
+            self.silo.update(fpath, fhash, fstat)
 
 
 class NodeDirMonitor(LoggingEventHandler):
@@ -387,43 +543,68 @@ class NodeDirMonitor(LoggingEventHandler):
         combox.
     :param threading.Lock dblock:
         Lock to access the :class:`.ComboxSilo`. object.
-    :param threading.Lock monitor_lock:
-        Lock shared by :class:`.ComboxDirMonitor` and all the
-        :class:`.NodeDirMonitor` objects.
+    :param locks:
+        The :class:`.PathLocks` object shared by
+        :class:`.ComboxDirMonitor` and all the
+        :class:`.NodeDirMonitor` objects; the paths under the combox
+        directory are held with it while they are being worked on.
+    :param silo:
+        The :class:`.ComboxSilo` object shared by
+        :class:`.ComboxDirMonitor` and all the
+        :class:`.NodeDirMonitor` objects. If `None`, a new one is
+        created with `dblock`.
+    :param jobs:
+        The :class:`~combox.scheduler.JobQueue` shared by
+        :class:`.ComboxDirMonitor` and all the
+        :class:`.NodeDirMonitor` objects; the event handlers put the
+        work to be done in it. If `None`, a new one is created (see
+        :func:`~combox.scheduler.job_queue`).
 
     """
 
-    def __init__(self, config, dblock, monitor_lock):
+    def __init__(self, config, dblock, locks, silo=None, jobs=None):
         """Initialize :class:`.NodeDirMonitor`.
 
         """
         super(NodeDirMonitor, self).__init__()
 
-        self.lock = monitor_lock
+        self.locks = locks
         logging.basicConfig(level=logging.INFO,
                             format='%(asctime)s - %(message)s',
                             datefmt='%Y-%m-%d %H:%M:%S')
 
         self.config = config
-        self.silo = ComboxSilo(self.config, dblock)
+        self.silo = silo if silo else ComboxSilo(self.config, dblock)
+        self.jobs = jobs if jobs else job_queue(self.config)
 
         self.num_nodes = len(get_nodedirs(self.config))
 
         # track file shards that are just created during this run.
         self.just_created = {}
 
+        # runs the jobs of modified shards once they are left alone.
+        self.debouncer = Debouncer()
+
+        # runs the deletions that wait to see if the shard comes back,
+        # and the look out for awaited chunks.
+        self.delayed = DelayedScheduler()
+
 
     def shardp(self, path):
         """Checks if `path` is a shard.
 
-        Shards end with `.shardN` where `N` is a natural number.
+        Shards end with `.shardN` where `N` is a natural number. The
+        shards of chunks (see :func:`~combox.chunk.chunkp`) are not
+        counted.
 
         :returns:
             Returns `True` if `path` is a shard; `False` otherwise.
         :rtype: bool
 
         """
-        if path[:-1].endswith('.shard'):
+        if chunkp(path):
+            return False
+        elif path[:-1].endswith('.shard'):
             return True
         else:
             return False
@@ -432,12 +613,14 @@ class NodeDirMonitor(LoggingEventHandler):
     def delete_later(self, file_cb_path):
         """Delete `file_cb_path` if its  still under 'file_deleted' dictionary in DB.
 
-        This is used by the :meth:`~.NodeDirMonitor.on_deleted` method.
+        This is scheduled by the :meth:`~.NodeDirMonitor.deleted`
+        method, on the :attr:`delayed` scheduler, which puts it in the
+        :attr:`jobs` queue when it is due.
 
         This is a workaround to make combox predict official Google
         Drive client's behavior.
         """
-        with self.lock:
+        with self.locks.hold(file_cb_path):
             num = self.silo.node_get('file_deleted', file_cb_path)
 
             if num == self.num_nodes:
@@ -450,6 +633,233 @@ class NodeDirMonitor(LoggingEventHandler):
                 self.silo.node_rem('file_deleted', file_cb_path)
 
 
+    def glue(self, file_cb_path, silo_node_dict):
+        """Reconstructs `file_cb_path` from its shards and updates its info in the silo.
+
+        The file is removed from the `silo_node_dict` dictionary in the
+        silo. The caller must hold `file_cb_path` (see
+        :class:`~combox.locks.PathLocks`).
+
+        If the shards of the file are a manifest, some of the chunks
+        of which are not in the node directories yet (see
+        :func:`~combox.crypto.missing_chunks`), the file is left in
+        the `silo_node_dict` dictionary instead; it is glued once its
+        chunks arrive (see :meth:`glue_awaited`).
+
+        :param str file_cb_path:
+            Path of a file under the combox directory.
+        :param str silo_node_dict:
+            The name of a dictionary in the silo; `file_created` or
+            `file_modified`.
+
+        """
+        if missing_chunks(file_cb_path, self.config):
+            log_i("Chunks of %s are yet to arrive; gluing it later" %
+                  file_cb_path)
+            self.await_chunks()
+            return
+
+        # the hash is not computed again if shard_modified cached it.
+        fhash = decrypt_and_glue(file_cb_path, self.config,
+                                 fhash=self.remote_hash(file_cb_path,
+                                                        self.silo.digest,
+                                                        True))
+        # update db.
+        self.silo.update(file_cb_path, fhash, file_stat(file_cb_path))
+        self.silo.node_rem(silo_node_dict, file_cb_path)
+
+
+    def remote_hash(self, file_cb_path, digest, cached=False):
+        """Returns the hash of the content in the shards of `file_cb_path`, from the cache if possible.
+
+        The hash is cached in the silo's
+        :class:`~combox.hashcache.HashCache` under the path and the
+        stats of each of the shards; so, it is no longer found once
+        one of the shards is modified.
+
+        :param str file_cb_path:
+            Path of a file under the combox directory.
+        :param str digest:
+            Name of the digest algorithm to use; see
+            :data:`~combox.file.DIGESTS`.
+        :param bool cached:
+            If `True`, `None` is returned when the hash is not in the
+            cache; otherwise, the shards are decrypted and hashed (see
+            :func:`~combox.crypto.decrypt_and_glue`).
+        :rtype: str
+
+        """
+        shard_stats = [(shard, file_stat(shard)) for shard in
+                       node_paths(file_cb_path, self.config, True)]
+        fhashes = set([self.silo.hashes.get(shard, fstat)
+                       for shard, fstat in shard_stats])
+
+        fhash = fhashes.pop() if len(fhashes) == 1 else None
+        if fhash is not None and hash_digest(fhash) == digest:
+            return fhash
+        elif cached:
+            return None
+
+        fhash = decrypt_and_glue(file_cb_path, self.config,
+                                 hash_only=True, digest=digest)
+        for shard, fstat in shard_stats:
+            self.silo.hashes.put(shard, fhash, fstat)
+
+        return fhash
+
+
+    def glue_awaited(self):
+        """Puts a job in the :attr:`jobs` queue to glue each file whose chunks were awaited and arrived.
+
+        The files whose chunks are awaited are the ones whose shards
+        were created, or modified, in all the node directories but are
+        still in the `file_created`, or `file_modified`, dictionary in
+        the silo (see :meth:`glue`); the silo is shared by the node
+        monitors, so the chunks may arrive in any node directory.
+
+        This is run by the :attr:`delayed` scheduler a while after a
+        chunk arrives in the node directory, and every
+        :data:`CHUNK_WAIT` seconds while there are files whose chunks
+        are awaited.
+
+        """
+        awaited = False
+        for silo_node_dict in ['file_created', 'file_modified']:
+            for file_cb_path in self.silo.node_files(silo_node_dict,
+                                                     self.num_nodes):
+                if not path.exists(node_path(file_cb_path, self.config,
+                                             True)):
+                    # the file was removed meanwhile.
+                    self.silo.node_rem(silo_node_dict, file_cb_path)
+                    continue
+
+                try:
+                    if missing_chunks(file_cb_path, self.config):
+                        awaited = True
+                        continue
+                except (IOError, OSError, IndexError, ValueError), e:
+                    log_e("Unable to read manifest of %s: %s" %
+                          (file_cb_path, e))
+                    awaited = True
+                    continue
+
+                self.jobs.put('glue', [file_cb_path], self.glue_locked,
+                              file_cb_path, silo_node_dict)
+
+        if awaited:
+            self.await_chunks()
+
+
+    def glue_locked(self, file_cb_path, silo_node_dict):
+        """Holds `file_cb_path` and calls :meth:`glue`, unless the file was glued already.
+
+        """
+        with self.locks.hold(file_cb_path):
+            num = self.silo.node_get(silo_node_dict, file_cb_path)
+            if (num or 0) >= self.num_nodes:
+                self.glue(file_cb_path, silo_node_dict)
+
+
+    def await_chunks(self):
+        """Makes the :attr:`delayed` scheduler run :meth:`glue_awaited` in :data:`CHUNK_WAIT` seconds, unless it is to run already.
+
+        """
+        if CHUNK_DIR not in self.delayed.keys():
+            self.delayed.schedule(CHUNK_DIR, CHUNK_WAIT, self.glue_awaited)
+
+
+    def chunk_arrived(self, chunk_path):
+        """Called when a chunk shard is created or moved in the node directory.
+
+        The files whose chunks are awaited are looked at once the
+        chunks stop arriving for a while (see :meth:`glue_awaited`).
+
+        :param str chunk_path:
+            Path of a chunk shard, or a directory in the chunk store,
+            under the node directory.
+
+        """
+        self.delayed.schedule(CHUNK_DIR, QUIET_PERIOD, self.glue_awaited)
+
+
+    def removed_tree(self, dir_cb_path):
+        """Returns the topmost of `dir_cb_path` and the directories above it that are gone from all the node directories.
+
+        :param str dir_cb_path:
+            Path of a directory under the combox directory.
+        :returns:
+            Path of the directory under the combox directory; `None` if
+            `dir_cb_path` is in any of the node directories.
+        :rtype: str
+
+        """
+        combox_dir = path.abspath(self.config['combox_dir'])
+
+        tree = None
+        while dir_cb_path.startswith(path.join(combox_dir, '')):
+            for dir_node_path in node_paths(dir_cb_path, self.config, False):
+                if path.exists(dir_node_path):
+                    return tree
+
+            tree = dir_cb_path
+            dir_cb_path = path.dirname(dir_cb_path)
+
+        return tree
+
+
+    def delete_tree_later(self, dir_cb_path):
+        """Schedules the deletion of `dir_cb_path` and everything under it.
+
+        A directory tree removed on another computer comes as an event
+        for each of its shards and directories in each node directory;
+        the :meth:`delete_tree` job is put in the :attr:`jobs` queue once
+        these events stop coming for a while (see
+        :data:`~combox.scheduler.QUIET_PERIOD`). The pending deletions
+        under `dir_cb_path` are cancelled, as they are part of it; if
+        the deletion of a directory above it is pending, nothing is
+        done.
+
+        :param str dir_cb_path:
+            Path of a directory under the combox directory.
+
+        """
+        prefix = path.join(dir_cb_path, '')
+
+        for key in self.delayed.keys():
+            if key.startswith(prefix):
+                self.delayed.cancel(key)
+            elif prefix.startswith(path.join(key, '')):
+                return
+
+        log_i("Marking %s and everything under it for deletion" %
+              dir_cb_path)
+        self.delayed.schedule(dir_cb_path, QUIET_PERIOD, self.jobs.put,
+                              'directory', [dir_cb_path], self.delete_tree,
+                              dir_cb_path)
+
+
+    def delete_tree(self, dir_cb_path):
+        """Deletes `dir_cb_path` and everything under it, if it is still gone from all the node directories.
+
+        The information about the files under `dir_cb_path` is removed
+        from the silo in one go (see
+        :meth:`~combox.silo.ComboxSilo.remove_tree`).
+
+        :param str dir_cb_path:
+            Path of a directory under the combox directory.
+
+        """
+        with self.locks.hold(dir_cb_path):
+            if self.removed_tree(dir_cb_path) is None:
+                log_i("%s is back; not deleting it" % dir_cb_path)
+                return
+
+            log_i("Deleting %s and everything under it..." % dir_cb_path)
+            rm_path(dir_cb_path)
+            num = self.silo.remove_tree(dir_cb_path)
+            log_i("Removed %d files under %s from DB" % (num, dir_cb_path))
+
+
     def housekeep(self):
         """Recursively traverses node directory, discovers changes and updates silo and combox directory. This method must **never** be called directly.
 
@@ -466,7 +876,9 @@ class NodeDirMonitor(LoggingEventHandler):
           the node directory, it resurrects the file from the shards,
           writes it to the combox directory, and stores the file's
           information in the DB, iff all of the shards of this file
-          are found in the node directories.
+          are found in the node directories. The files are resurrected
+          on a pool of processes (see
+          :func:`~combox.engine.glue_files`).
 
         """
         log_i("combox node monitor is housekeeping")
@@ -475,30 +887,31 @@ class NodeDirMonitor(LoggingEventHandler):
         # Remove files from the combox directory whose shards were
         # deleted.
         # Remove information about files that were deleted.
-        fpath_filter = lambda x: x not in self.silo.nodedicts()
-        fpaths = filter(fpath_filter, self.silo.keys())
-
-        for fpath in fpaths:
-            del_num = 0
-            fshards = node_paths(fpath, self.config, True)
-
-            for fshard in fshards:
-                if not path.exists(fshard):
-                    del_num += 1
-
-            if del_num == self.num_nodes:
-                # remove the file from combox directory.
-                rm_path(fpath)
-                log_i("%s was deleted on another computer. Removing it" %
-                      fpath)
-                # update silo.
-                self.silo.remove(fpath)
-                self.silo.node_rem('file_deleted', fpath)
-            elif del_num > 0:
-                # means, all the shards of the file have not been
-                # deleted yet, so, we store the no. of shards was
-                # deleted in the 'file_deleted' dict inside the silo.
-                self.silo.node_set('file_deleted', fpath, del_num)
+        fpaths = self.silo.keys()
+
+        # the silo is updated in a single transaction.
+        with self.silo.batch():
+            for fpath in fpaths:
+                del_num = 0
+                fshards = node_paths(fpath, self.config, True)
+
+                for fshard in fshards:
+                    if not path.exists(fshard):
+                        del_num += 1
+
+                if del_num == self.num_nodes:
+                    # remove the file from combox directory.
+                    rm_path(fpath)
+                    log_i("%s was deleted on another computer. Removing it" %
+                          fpath)
+                    # update silo.
+                    self.silo.remove(fpath)
+                    self.silo.node_rem('file_deleted', fpath)
+                elif del_num > 0:
+                    # means, all the shards of the file have not been
+                    # deleted yet, so, we store the no. of shards was
+                    # deleted in the 'file_deleted' dict inside the silo.
+                    self.silo.node_set('file_deleted', fpath, del_num)
 
         # Re-construct files created on another computer when combox
         # was switched off. Only files who's all the shards have made
@@ -522,19 +935,21 @@ class NodeDirMonitor(LoggingEventHandler):
                         else:
                             files_created[file_cb_path] += 1
 
-        for f_cb_path, crt_num in files_created.items():
-            if crt_num == self.num_nodes:
-                log_i("%s was created remotely. Creating it locally now..." %
-                      f_cb_path)
-                decrypt_and_glue(f_cb_path, self.config)
-                # update silo.
-                self.silo.update(f_cb_path)
-                self.silo.node_rem('file_created', f_cb_path)
-            elif crt_num > 0:
-                # means, all the shards of the file have not arrived
-                # yet, so, we store the no. of shards that did arrive
-                # in the 'file_created' dict inside the silo.
-                self.silo.node_set('file_created', f_cb_path, crt_num)
+        # the silo is updated in a single transaction.
+        with self.silo.batch():
+            f_cb_paths = []
+            for f_cb_path, crt_num in files_created.items():
+                if crt_num == self.num_nodes:
+                    f_cb_paths.append(f_cb_path)
+                elif crt_num > 0:
+                    # means, all the shards of the file have not arrived
+                    # yet, so, we store the no. of shards that did arrive
+                    # in the 'file_created' dict inside the silo.
+                    self.silo.node_set('file_created', f_cb_path, crt_num)
+
+        # re-construct the files on a pool of processes; also updates
+        # the silo.
+        glue_files(f_cb_paths, self.config, self.silo)
 
         log_i("combox node monitor with housekeeping")
         log_i("Do what you want to the combox directory")
@@ -543,6 +958,9 @@ class NodeDirMonitor(LoggingEventHandler):
     def on_moved(self, event):
         """Called when a shard/directory is moved/renamed in the node directory.
 
+        The shard/directory is dealt with by :meth:`moved`, on the
+        :attr:`jobs` queue.
+
         :param event:
             The event object representing the file system event.
         :type event:
@@ -550,6 +968,32 @@ class NodeDirMonitor(LoggingEventHandler):
         """
         super(NodeDirMonitor, self).on_moved(event)
 
+        if chunkp(event.src_path) or chunkp(event.dest_path):
+            # the chunk store is not mirrored in the combox directory.
+            if chunkp(event.dest_path):
+                self.chunk_arrived(event.dest_path)
+            return
+
+        if (not self.shardp(event.src_path) and
+            not self.shardp(event.dest_path) and
+            not event.is_directory):
+            # The file moved is of no importance.
+            return
+
+        src_cb_path = cb_path(event.src_path, self.config)
+        dest_cb_path = cb_path(event.dest_path, self.config)
+
+        kind = 'directory' if event.is_directory else 'move'
+        self.jobs.put(kind, [src_cb_path, dest_cb_path], self.moved, event)
+
+
+    def moved(self, event):
+        """Does the work of :meth:`on_moved`.
+
+        :param event:
+            The event object representing the file system event.
+
+        """
         src_cb_path = cb_path(event.src_path, self.config)
         dest_cb_path = cb_path(event.dest_path, self.config)
 
@@ -557,13 +1001,8 @@ class NodeDirMonitor(LoggingEventHandler):
         cb_filename = src_cb_path
 
         if (not self.shardp(event.src_path) and
-            not self.shardp(event.dest_path) and
-            not event.is_directory):
-            # The file moved is of no importance.
-            return
-        elif (not self.shardp(event.src_path) and
-              self.shardp(event.dest_path) and
-              not path.exists(dest_cb_path) and
+            self.shardp(event.dest_path) and
+            not path.exists(dest_cb_path) and
               not event.is_directory):
             # This is Dropbox specific.
             #
@@ -592,7 +1031,7 @@ class NodeDirMonitor(LoggingEventHandler):
             # ('.dropbox.cache/' directory under the Dropox
             # directory); this we catch in the next 'elif' statement.
             silo_node_dict = 'file_deleted'
-            with self.lock:
+            with self.locks.hold(cb_filename):
                 # [1]: Store the assumption in silo.
                 log_i("Assuming %s (%s) is deleted" %
                       (cb_filename, event.src_path))
@@ -617,7 +1056,7 @@ class NodeDirMonitor(LoggingEventHandler):
             # deleted was wrong, so we remove that information from
             # the silo.
             cb_filename = dest_cb_path
-            with self.lock:
+            with self.locks.hold(cb_filename):
                 log_i("Okay, %s (%s) was actually modified" %
                       (cb_filename, event.dest_path))
                 self.silo.node_rem('file_deleted', cb_filename)
@@ -636,17 +1075,14 @@ class NodeDirMonitor(LoggingEventHandler):
                     self.silo.node_set('file_modified', cb_filename)
                     num = self.silo.node_get('file_modified', cb_filename)
                     if num == self.num_nodes:
-                        decrypt_and_glue(cb_filename, self.config)
-                        # update db.
-                        self.silo.update(cb_filename)
-                        self.silo.node_rem('file_modified', cb_filename)
+                        self.glue(cb_filename, 'file_modified')
             return
 
 
         if not path.exists(dest_cb_path):
             # means this path was moved on another computer that is
             # running combox.
-            with self.lock:
+            with self.locks.hold(src_cb_path, dest_cb_path):
                 self.silo.node_set(silo_node_dict, cb_filename)
                 num = self.silo.node_get(silo_node_dict, cb_filename)
                 if num != self.num_nodes:
@@ -655,10 +1091,7 @@ class NodeDirMonitor(LoggingEventHandler):
                     # This is Dropbox specific :|
                     # create file in cb directory.
                     log_i("Creating %s..." % cb_filename)
-                    decrypt_and_glue(cb_filename, self.config)
-                    # update db.
-                    self.silo.update(cb_filename)
-                    self.silo.node_rem('file_created', cb_filename)
+                    self.glue(cb_filename, 'file_created')
                     return
                 else:
                     try:
@@ -675,6 +1108,9 @@ class NodeDirMonitor(LoggingEventHandler):
     def on_created(self, event):
         """Called when a shard/directory is created in the node directory.
 
+        The shard/directory is dealt with by :meth:`created`, on the
+        :attr:`jobs` queue.
+
         :param event:
             The event object representing the file system event.
         :type event:
@@ -682,6 +1118,11 @@ class NodeDirMonitor(LoggingEventHandler):
         """
         super(NodeDirMonitor, self).on_created(event)
 
+        if chunkp(event.src_path):
+            # the chunk store is not mirrored in the combox directory.
+            self.chunk_arrived(event.src_path)
+            return
+
         if not self.shardp(event.src_path) and not event.is_directory:
             # the file created can be ignored as it is not a shard or
             # a directory.
@@ -694,11 +1135,30 @@ class NodeDirMonitor(LoggingEventHandler):
 
         file_cb_path = cb_path(event.src_path, self.config)
 
+        kind = 'directory' if event.is_directory else 'glue'
+        self.jobs.put(kind, [file_cb_path], self.created, event)
+
+
+    def created(self, event):
+        """Does the work of :meth:`on_created`.
+
+        A pending deletion of the file/directory (see :meth:`deleted`)
+        is cancelled.
+
+        :param event:
+            The event object representing the file system event.
+
+        """
+        file_cb_path = cb_path(event.src_path, self.config)
+
+        if self.delayed.cancel(file_cb_path):
+            log_i("%s is back; not deleting it" % file_cb_path)
+
         if event.is_directory and (not path.exists(file_cb_path)):
             # means, the directory was created on another computer
             # (also running combox). so, create this directory
             # under the combox directory
-            with self.lock:
+            with self.locks.hold(file_cb_path):
                 self.silo.node_set('file_created', file_cb_path)
                 num = self.silo.node_get('file_created', file_cb_path)
 
@@ -716,7 +1176,7 @@ class NodeDirMonitor(LoggingEventHandler):
             #
             # - First it deletes the file.
             # - Creates the latest version the file.
-            with self.lock:
+            with self.locks.hold(file_cb_path):
                 num = self.silo.node_get('file_deleted', file_cb_path)
                 if num:
                     log_i("Looks like %s was actually modified!" %
@@ -730,29 +1190,26 @@ class NodeDirMonitor(LoggingEventHandler):
                     num = self.silo.node_get('file_modified', file_cb_path)
                     if num == self.num_nodes:
                         log_i("Updating %s ...." % file_cb_path)
-                        decrypt_and_glue(file_cb_path, self.config)
-                        # update db.
-                        self.silo.update(file_cb_path)
-                        self.silo.node_rem('file_modified', file_cb_path)
+                        self.glue(file_cb_path, 'file_modified')
         elif (not event.is_directory) and (not path.exists(file_cb_path)):
             # shard created.
 
             # means, file was created on another computer (also
             # running combox). so, reconstruct the file and put it
             # in the combox directory.
-            with self.lock:
+            with self.locks.hold(file_cb_path):
                 self.silo.node_set('file_created', file_cb_path)
                 num = self.silo.node_get('file_created', file_cb_path)
                 if num == self.num_nodes:
-                    decrypt_and_glue(file_cb_path, self.config)
-                    # update db.
-                    self.silo.update(file_cb_path)
-                    self.silo.node_rem('file_created', file_cb_path)
+                    self.glue(file_cb_path, 'file_created')
 
 
     def on_deleted(self, event):
         """Called when a shard/directory is deleted in the node directory.
 
+        The shard/directory is dealt with by :meth:`deleted`, on the
+        :attr:`jobs` queue.
+
         :param event:
             The event object representing the file system event.
         :type event:
@@ -760,6 +1217,10 @@ class NodeDirMonitor(LoggingEventHandler):
         """
         super(NodeDirMonitor, self).on_deleted(event)
 
+        if chunkp(event.src_path):
+            # the chunk store is not mirrored in the combox directory.
+            return
+
         if not self.shardp(event.src_path) and not event.is_directory:
             # the file created can be ignored as it is not a shard or
             # a directory.
@@ -767,31 +1228,44 @@ class NodeDirMonitor(LoggingEventHandler):
 
         file_cb_path = cb_path(event.src_path, self.config)
 
-        if event.is_directory and path.exists(file_cb_path):
+        kind = 'directory' if event.is_directory else 'delete'
+        self.jobs.put(kind, [file_cb_path], self.deleted, event)
+
+
+    def deleted(self, event):
+        """Does the work of :meth:`on_deleted`.
+
+        A directory, or the directory of a shard, that is gone from
+        all the node directories was removed along with everything
+        under it; it is removed from the combox directory and the silo
+        in one go, by :meth:`delete_tree` (see
+        :meth:`delete_tree_later`).
+
+        Otherwise, files are deleted a while later by
+        :meth:`delete_later`, unless they come back (see
+        :meth:`created` and :meth:`shard_modified`); this waiting is
+        done by the :attr:`delayed` scheduler, so no thread is started
+        per deletion.
+
+        :param event:
+            The event object representing the file system event.
+
+        """
+        file_cb_path = cb_path(event.src_path, self.config)
+
+        if event.is_directory:
+            tree = self.removed_tree(file_cb_path)
+        else:
+            tree = self.removed_tree(path.dirname(file_cb_path))
+
+        if tree is not None:
             # This means the directory was deleted on a remote
             # computer.
-            with self.lock:
-                self.silo.node_set('file_deleted', file_cb_path)
-                num = self.silo.node_get('file_deleted', file_cb_path)
-
-                if num == self.num_nodes:
-                    # Delete corresponding directory under the combox
-                    # directory.
-                    if os.listdir(file_cb_path):
-                        # There are files under this directory that
-                        # are not deleted yet, so we got to delay
-                        # deletion :|
-                        log_i("Marking %s for later deletion" % file_cb_path)
-                        delayed_thread = Timer(15, self.delete_later,
-                                               [file_cb_path])
-                        delayed_thread.start()
-                    else:
-                        rm_path(file_cb_path)
-                        self.silo.node_rem('file_deleted', file_cb_path)
+            self.delete_tree_later(tree)
         elif not event.is_directory and path.exists(file_cb_path):
             log_i("%s must have been deleted on another computer" %
                   event.src_path)
-            with self.lock:
+            with self.locks.hold(file_cb_path):
                 self.silo.node_set('file_deleted', file_cb_path)
                 num = self.silo.node_get('file_deleted', file_cb_path)
                 # If we are in a Google Drive node directory and
@@ -804,14 +1278,19 @@ class NodeDirMonitor(LoggingEventHandler):
                 # file_cb_path iff the file_cb_path was really
                 # removed on the another computer.
                 log_i("Marking %s for later deletion" % file_cb_path)
-                delayed_thread = Timer(3, self.delete_later,
-                                       [file_cb_path])
-                delayed_thread.start()
+                self.delayed.schedule(file_cb_path, 3, self.jobs.put,
+                                      'delete', [file_cb_path],
+                                      self.delete_later, file_cb_path)
 
 
     def on_modified(self, event):
         """Called when a shard/directory is modified in the node directory.
 
+        The modified shard is dealt with by :meth:`shard_modified`, on
+        the :attr:`jobs` queue, once it is left alone for a while (see
+        :class:`~combox.scheduler.Debouncer`); so, the thread that
+        dispatches the events does not wait.
+
         :param event:
             The event object representing the file system event.
         :type event:
@@ -819,6 +1298,11 @@ class NodeDirMonitor(LoggingEventHandler):
         """
         super(NodeDirMonitor, self).on_modified(event)
 
+        if chunkp(event.src_path):
+            # the chunk store is not mirrored in the combox directory.
+            self.chunk_arrived(event.src_path)
+            return
+
         if not self.shardp(event.src_path) and not event.is_directory:
             # the file created can be ignored as it is not a shard or
             # a directory.
@@ -837,20 +1321,6 @@ class NodeDirMonitor(LoggingEventHandler):
             # do nothing
             pass
         elif (not event.is_directory):
-            # get file size first
-            f_size_MiB = path.getsize(event.src_path) / 1048576.0
-            log_i('%s modified %f' % (event.src_path, f_size_MiB))
-
-            # introduce delay to prevent multiple "file modified"
-            # events from being generated.
-            if f_size_MiB >= 30:
-                sleep_time = (f_size_MiB / 30.0)
-                log_i("waiting on_modified node monitor %f" % sleep_time)
-                time.sleep(sleep_time)
-                log_i("end waiting on_modified node monitor")
-            else:
-                time.sleep(1)
-
             # watchdog's weirdness
             # --------------------
             #
@@ -867,25 +1337,56 @@ class NodeDirMonitor(LoggingEventHandler):
                     event.src_path))
                 return
 
-            file_content = decrypt_and_glue(file_cb_path,
-                                            self.config,
-                                            write=False)
-            file_content_hash = hash_file(file_cb_path, file_content)
+            # wait for the "file modified" events of the shard to
+            # stop coming.
+            delay = quiet_period(event.src_path)
+            log_i('%s modified; checking it in %f s' % (event.src_path,
+                                                      delay))
+            self.debouncer.schedule(event.src_path, delay, self.jobs.put,
+                                    'glue', [file_cb_path],
+                                    self.shard_modified, event.src_path)
 
-            if self.silo.stale(file_cb_path, file_content_hash) == True:
-                log_i("Found %s stale. Updating it..." % file_cb_path)
-                # shard modified
 
-                # means, file was modified on another computer (also
-                # running combox). so, reconstruct the file and put it
-                # in the combox directory.
-                with self.lock:
-                    self.silo.node_set('file_modified', file_cb_path)
-                    num = self.silo.node_get('file_modified', file_cb_path)
-                    if num == self.num_nodes:
-                        decrypt_and_glue(file_cb_path, self.config)
-                        # update db.
-                        self.silo.update(file_cb_path)
-                        self.silo.node_rem('file_modified', file_cb_path)
-            else:
-                log_i("Local modification of %s" % file_cb_path)
+    def shard_modified(self, shard):
+        """Reconstructs the file of the modified `shard`, if all of its shards were modified.
+
+        Put in the :attr:`jobs` queue by the :attr:`debouncer`; see
+        :meth:`on_modified`. A pending deletion of the file (see
+        :meth:`deleted`) is cancelled.
+
+        :param str shard:
+            Path of a shard under the node directory.
+
+        """
+        file_cb_path = cb_path(shard, self.config)
+
+        if self.delayed.cancel(file_cb_path):
+            log_i("%s was modified; not deleting it" % file_cb_path)
+
+        if no_of_shards(file_cb_path, self.config) != self.num_nodes:
+            # shards were removed since.
+            return
+
+        if missing_chunks(file_cb_path, self.config):
+            # can't tell before the chunks arrive; see glue.
+            stale = True
+        else:
+            # hashed with the same algorithm as the hash in the silo.
+            file_content_hash = self.remote_hash(
+                file_cb_path, self.silo.hash_digest(file_cb_path))
+            stale = self.silo.stale(file_cb_path, file_content_hash)
+
+        if stale == True:
+            log_i("Found %s stale. Updating it..." % file_cb_path)
+            # shard modified
+
+            # means, file was modified on another computer (also
+            # running combox). so, reconstruct the file and put it
+            # in the combox directory.
+            with self.locks.hold(file_cb_path):
+                self.silo.node_set('file_modified', file_cb_path)
+                num = self.silo.node_get('file_modified', file_cb_path)
+                if num == self.num_nodes:
+                    self.glue(file_cb_path, 'file_modified')
+        else:
+            log_i("Local modification of %s" % file_cb_path)
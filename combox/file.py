@@ -18,16 +18,71 @@
 #   along with Combox (see COPYING).  If not, see
 #   <http://www.gnu.org/licenses/>.
 
+import errno
 import os
+import sys
 
-from hashlib import sha512
+from binascii import hexlify
+from hashlib import md5, sha512
+from multiprocessing.pool import ThreadPool
 from os import path
-from sys import exit
 from glob import glob
+from threading import Lock
 
 from combox.config import get_nodedirs
 from combox.log import log_e
 
+try:
+    from pyblake2 import blake2b
+except ImportError:
+    blake2b = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DIGEST = 'sha512'
+"""Default digest algorithm used to hash files' content.
+
+"""
+
+DIGESTS = {'sha512': sha512, 'md5': md5}
+"""Digest algorithms available to hash files' content, keyed by name.
+
+`blake2b` and `xxh64` are available only if the optional `pyblake2`
+and `xxhash` packages are installed.
+
+"""
+if blake2b:
+    DIGESTS['blake2b'] = blake2b
+if xxhash:
+    DIGESTS['xxh64'] = xxhash.xxh64
+
+READ_SIZE = 1048576
+"""No. of bytes :func:`hash_file` reads at a time.
+
+Files in the combox directory are read, never memory-mapped: they are
+live user files, and touching the pages of a mapped file that was
+truncated meanwhile raises SIGBUS, which kills the process; a size or
+stat check before mapping cannot rule that out, and Python cannot
+recover from the signal. A truncated file that is read only comes up
+short (see :func:`read_range`).
+
+"""
+
+WRITE_BUFFER_SIZE = 4 * 1048576
+"""Size of the buffer used by :func:`write_chunks`.
+
+"""
+
+_node_pools = {}
+"""Thread pools used to do I/O on node directories, keyed on their size.
+
+"""
+
+_node_pools_lock = Lock()
+
 
 def relative_path(p, config, comboxd=True):
     """Returns the relative path to the `p` w. r. t combox or node directory.
@@ -354,37 +409,51 @@ def purge_dir(p):
             os.rmdir(f_path)
 
 
+def shard_ranges(data_size, n):
+    """Returns the byte ranges of the `n` parts data of size `data_size` is split into.
+
+    :param int data_size:
+        Size of the data in bytes.
+    :param int n:
+        Number of parts the data has to be split.
+    :returns:
+        List of `(start, end)` tuples, one for each part. The last
+        part also gets the remaining bytes when `data_size` is not
+        divisible by `n`.
+    :rtype: list
+
+    """
+    # No. of bytes for each data part.
+    part_size = data_size / n
+
+    ranges = []
+    for part in range(n):
+        ranges.append((part * part_size, (part + 1) * part_size))
+
+    # the remaining bytes go into the last data part.
+    ranges[n-1] = (ranges[n-1][0], data_size)
+
+    return ranges
+
+
 def split_data(data, n):
     """Split `data` into `n` parts and return them as a list.
 
+    The parts are :func:`buffer` objects -- read-only views into
+    `data` -- so splitting does not copy any of the `data`.
+
     :param str data:
         Stream of bytes or string.
     :param int n:
         Number of parts the `data` has to be split.
     :returns:
-        List of strings -- the `data` divided into `n` parts.
+        List of buffers -- the `data` divided into `n` parts.
     :rtype: list
 
     """
     d_parts = []
-    # File size in bytes.
-    data_size = len(data)
-    # No. of bytes for each data part.
-    part_size =  data_size / n
-    # Take note of remaining bytes; this is non-zero when data_size is
-    # not divisible by `n'.
-    rem_bytes = data_size % n
-
-    start = 0
-    end = part_size
-    while end <= data_size:
-        d_parts.append(data[start:end])
-        start = end
-        end = end + part_size
-
-    # read the remaining bytes into the last data part.
-    end += start + rem_bytes
-    d_parts[n-1] += data[start:end]
+    for start, end in shard_ranges(len(data), n):
+        d_parts.append(buffer(data, start, end - start))
 
     return d_parts
 
@@ -394,17 +463,15 @@ def glue_data(d_parts):
 
     :param list d_parts:
         List containing different parts of the `data`. Each part is a
-        sequence of bytes.
+        sequence of bytes; either a string or a :func:`buffer`.
     :returns:
         The `data` glued into a single whole.
     :rtype: str
 
     """
-    data = ''
-    for part in d_parts:
-        data += part
-
-    return data
+    # a single join computes the total size first and copies each
+    # part once; str() returns string parts as they are.
+    return ''.join([str(part) for part in d_parts])
 
 
 def read_file(filename):
@@ -417,38 +484,235 @@ def read_file(filename):
     :rtype: str
 
     """
-    file_ = None
-    content = ''
-
     with open(filename, 'rb') as f:
-        for line in f:
-            content = content + line
+        # read() sizes its buffer from the file size, so the content
+        # is read in one go into a single string.
+        return f.read()
+
+
+def read_chunks(file_, size, chunk_size):
+    """Read `size` bytes from file object `file_`, `chunk_size` bytes at a time.
+
+    Reading starts at the current position of `file_`.
+
+    :param file file_:
+        File object opened for reading.
+    :param int size:
+        Number of bytes to read.
+    :param int chunk_size:
+        Maximum number of bytes in each chunk.
+    :returns:
+        Generator that yields the chunks read from `file_`.
+    :rtype: generator
 
-    return content
+    """
+    while size > 0:
+        chunk = file_.read(min(chunk_size, size))
+        if not chunk:
+            # reached end of file.
+            break
+        size -= len(chunk)
+        yield chunk
 
 
-def hash_file(filename, file_content=None):
-    """Does a SHA512 hash on the contents of file.
+def read_range(filename, start, end, chunk_size):
+    """Read the bytes `start` to `end` of file `filename`, `chunk_size` bytes at a time.
 
-    Returns the hexdigest of the file content's hash.
+    The file is opened when the first chunk is asked for and closed
+    once the last one is read; only a chunk is in memory at a time.
+
+    :param str filename:
+        Absolute pathname of the file.
+    :param int start:
+        Offset of the first byte.
+    :param int end:
+        Offset after the last byte.
+    :param int chunk_size:
+        Maximum number of bytes in each chunk.
+    :returns:
+        Generator that yields the chunks read from `filename`.
+    :rtype: generator
+
+    :raises IOError:
+        If the file is shorter than `end` bytes; it was truncated
+        while it was read, for instance.
+
+    """
+    with open(filename, 'rb') as file_:
+        file_.seek(start)
+        size = end - start
+        for chunk in read_chunks(file_, size, chunk_size):
+            size -= len(chunk)
+            yield chunk
+
+    if size:
+        raise IOError(errno.EIO, "%s was truncated while it was read"
+                      % filename, filename)
+
+
+def hash_chunks(chunks, f_hash):
+    """Update hash object `f_hash` with each of the `chunks` as it is consumed.
+
+    :param chunks:
+        Iterable of strings or buffers.
+    :param f_hash:
+        A :mod:`hashlib` hash object.
+    :returns:
+        Generator that yields the `chunks` as they are.
+    :rtype: generator
+
+    """
+    for chunk in chunks:
+        f_hash.update(chunk)
+        yield chunk
+
+
+def get_digest(config):
+    """Returns the name of the digest algorithm to hash files' content with.
+
+    It is the value of the optional `digest` key in `config`;
+    defaults to :data:`DIGEST`.
+
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :rtype: str
+
+    :raises ValueError:
+        If the digest algorithm is not in :data:`DIGESTS`.
+
+    """
+    digest = config.get('digest', DIGEST)
+    if digest not in DIGESTS:
+        raise ValueError, "unknown or unavailable digest '%s'" % digest
+
+    return digest
+
+
+def new_hash(digest=DIGEST):
+    """Returns a new hash object of the `digest` algorithm.
+
+    :param str digest:
+        Name of a digest algorithm in :data:`DIGESTS`.
+    :raises ValueError:
+        If the digest algorithm is not in :data:`DIGESTS`.
+
+    """
+    if digest not in DIGESTS:
+        raise ValueError, "unknown or unavailable digest '%s'" % digest
+
+    return DIGESTS[digest]()
+
+
+def hexdigest(f_hash, digest=DIGEST):
+    """Returns the hexdigest of hash object `f_hash`, tagged with its algorithm.
+
+    The hexdigest is prefixed with `digest` and a colon, unless it is
+    :data:`DIGEST`; so, hashes stored by older versions of combox,
+    which are all SHA512 hexdigests, are still understood (see
+    :func:`hash_digest`).
+
+    :param f_hash:
+        Hash object returned by :func:`new_hash`.
+    :param str digest:
+        Name of `f_hash`'s digest algorithm.
+    :rtype: str
+
+    """
+    if digest == DIGEST:
+        return f_hash.hexdigest()
+
+    return '%s:%s' % (digest, f_hash.hexdigest())
+
+
+def hash_digest(fhash):
+    """Returns the name of the digest algorithm `fhash` was computed with.
+
+    :param str fhash:
+        A hash returned by :func:`hexdigest`.
+    :rtype: str
+
+    """
+    if ':' in fhash:
+        return fhash.split(':', 1)[0]
+
+    return DIGEST
+
+
+def hash_file(filename, file_content=None, digest=DIGEST):
+    """Hashes the contents of file.
+
+    Returns the hexdigest of the file content's hash (see
+    :func:`hexdigest`).
 
     :param str filename:
         Absolute pathname of the file.
     :param str file_content:
-        If not ``None``, SHA512 hash of `file_content` is returned.
+        If not ``None``, hash of `file_content` is returned; it can
+        also be a :func:`buffer`. Otherwise, the file is read
+        :data:`READ_SIZE` bytes at a time.
+    :param str digest:
+        Name of the digest algorithm to use; see :data:`DIGESTS`.
     :returns:
-        If `file_content` is ``None``, returns the SHA512 hash of
-        contents of file `filename`.
+        If `file_content` is ``None``, returns the hash of contents of
+        file `filename`.
 
-        If `file_content` is not ``None``, returns the SHA512 hash of
+        If `file_content` is not ``None``, returns the hash of
         `file_content`.
     :rtype: str
     """
+    f_hash = new_hash(digest)
 
     if not file_content:
-        file_content = read_file(filename)
+        with open(filename, 'rb') as file_:
+            for chunk in iter(lambda: file_.read(READ_SIZE), ''):
+                f_hash.update(chunk)
+    else:
+        f_hash.update(file_content)
+
+    return hexdigest(f_hash, digest)
+
+
+def file_stat(filename):
+    """Returns the size, modification time and inode number of `filename`.
+
+    :param str filename:
+        Absolute pathname of the file.
+    :returns:
+        `(size, mtime_ns, inode)`; the modification time is in
+        nanoseconds.
+    :rtype: tuple
+
+    """
+    f_stat = os.stat(filename)
+
+    return (f_stat.st_size, int(f_stat.st_mtime * 1e9), f_stat.st_ino)
+
+
+def stat_hash(filename, func=hash_file, *args, **kwargs):
+    """Returns the hash of `filename`'s content along with its stats.
+
+    The file is stat-ed (see :func:`file_stat`) *before* it is hashed:
+    if it is changed while it is hashed, its stats change after the
+    ones stored with its hash; so, the change does not go unnoticed
+    the next time the stats are compared.
+
+    :param str filename:
+        Absolute pathname of the file.
+    :param func:
+        Function that hashes the file; it is called with `filename`,
+        `args` and `kwargs`. :func:`hash_file` by default; or, for
+        instance, :func:`~combox.crypto.split_and_encrypt`, which
+        returns the hash of the file it shards.
+    :returns:
+        `(fhash, fstat)`; `fhash` is what `func` returns, `fstat` is
+        the stats of the file.
+    :rtype: tuple
 
-    return sha512(file_content).hexdigest()
+    """
+    fstat = file_stat(filename)
+
+    return func(filename, *args, **kwargs), fstat
 
 
 def write_file(filename, filecontent):
@@ -457,65 +721,238 @@ def write_file(filename, filecontent):
     :param str filename:
         Absolute pathname of the file.
     :param str filecontent:
-        Data to write to `filename`.
+        Data to write to `filename`; a string or a :func:`buffer`.
+    :raises IOError:
+        If `filename` could not be created or written.
 
     """
-    file_ = None
     try:
-      file_   = open(filename, 'wb')
-      file_.write(filecontent)
-      file_.close()
+        with open(filename, 'wb') as file_:
+            file_.write(filecontent)
     except IOError:
         log_e("Error creating and writing content to %s" % filename)
-        exit(1)
+        raise
+
+
+def write_chunks(filename, chunks, atomic=False):
+    """Write `chunks` one after the other to `filename`.
+
+    The chunks are buffered up to :data:`WRITE_BUFFER_SIZE` bytes, so
+    that small chunks, like the header of a shard, don't cost a write
+    of their own; each write to a node directory is seen as a "file
+    modified" event by the :class:`~combox.events.NodeDirMonitor`.
+
+    :param str filename:
+        Absolute pathname of the file.
+    :param chunks:
+        Iterable of strings (data).
+    :param bool atomic:
+        If `True`, the `chunks` are written to a temporary file in the
+        directory of `filename`, which is renamed to `filename` after
+        all the chunks are written; so `filename` is never seen half
+        written. The name of the temporary file starts with `.#` and
+        ends with `~`.
+    :raises IOError:
+        If `filename` could not be created, written or renamed into
+        place. The temporary file is removed on any error, including
+        the ones raised by `chunks`, which are re-raised as they are.
+
+    """
+    if atomic:
+        tmp_name = '.#%s.%s~' % (path.basename(filename),
+                                 hexlify(os.urandom(4)))
+        f_path = path.join(path.dirname(filename), tmp_name)
+    else:
+        f_path = filename
+
+    try:
+        with open(f_path, 'wb', WRITE_BUFFER_SIZE) as file_:
+            for chunk in chunks:
+                file_.write(chunk)
+        if atomic:
+            os.rename(f_path, filename)
+    except (IOError, OSError), e:
+        log_e("Error creating and writing content to %s" % filename)
+        raise IOError(e.errno, e.strerror, filename)
+    finally:
+        # the temporary file is left behind only if it was not renamed;
+        # whatever went wrong, `chunks` included.
+        if atomic and path.exists(f_path):
+            os.remove(f_path)
+
+
+def shard_path(directory, shard_basename, shard_no):
+    """Returns path to the shard number `shard_no` under `directory`.
+
+    :param str directory:
+        Path of the node directory.
+    :param str shard_basename:
+        Base name for the shard.
+    :param int shard_no:
+        The shard number.
+    :returns:
+        Path to the shard.
+    :rtype: str
+
+    """
+    return "%s.shard%s" % (path.join(directory, shard_basename), shard_no)
+
+
+def node_pool(nodes):
+    """Returns a thread pool with a worker for each of the `nodes`.
+
+    Each node directory is usually on a different disk or mount; doing
+    I/O on all of them at once takes only as long as the slowest
+    node. The pool is created the first time it is asked for and
+    reused after that.
+
+    :param int nodes:
+        No. of node directories.
+    :returns:
+        Thread pool with `nodes` workers.
+    :rtype: :class:`multiprocessing.pool.ThreadPool`
+
+    """
+    with _node_pools_lock:
+        pool = _node_pools.get(nodes)
+        if pool is None:
+            pool = ThreadPool(nodes)
+            _node_pools[nodes] = pool
+
+    return pool
+
+
+def node_call(func):
+    """Returns a function that calls `func` and returns what happened, instead of raising.
+
+    A pool's map is done as soon as a call raises, while the other
+    calls may still be running; calls wrapped by this function don't
+    raise, so the map is done only when all the calls are done. See
+    :func:`node_results`.
+
+    :param function func:
+        Function that does I/O on a node directory.
+    :returns:
+        Function that returns `(True, value)`, where `value` is the
+        value returned by `func`, or `(False, exc_info)` if `func`
+        raised an exception (see :func:`sys.exc_info`).
+    :rtype: function
+
+    """
+    def call(arg):
+        try:
+            return True, func(arg)
+        except Exception:
+            return False, sys.exc_info()
+
+    return call
+
+
+def node_results(results):
+    """Returns the values in `results` returned by functions wrapped by :func:`node_call`.
+
+    :param list results:
+        List of values returned by functions wrapped by
+        :func:`node_call`.
+    :returns:
+        List of values returned by the wrapped functions.
+    :rtype: list
+    :raises Exception:
+        The first exception raised by the wrapped functions, if any.
+
+    """
+    for done, value in results:
+        if not done:
+            raise value[0], value[1], value[2]
+
+    return [value for done, value in results]
+
+
+def node_map(func, args):
+    """Calls `func` with each item of `args`, in parallel.
+
+    All the calls are done before it returns, even if one of them
+    raises an exception.
+
+    :param function func:
+        Function that does I/O on a node directory.
+    :param list args:
+        List of arguments to call `func` with; one for each node
+        directory.
+    :returns:
+        List of values returned by `func`, in the order of `args`.
+    :rtype: list
+    :raises Exception:
+        The first exception raised by `func`, if any.
+
+    """
+    if len(args) < 2:
+        return map(func, args)
+
+    return node_results(node_pool(len(args)).map(node_call(func), args))
 
 
 def write_shards(shards, directories, shard_basename):
     """Write shards to node directories.
 
+    The shards are written at the same time, a thread for each node
+    directory (see :func:`node_map`).
+
     :param list shards:
-        List of strings (data).
+        List of strings or buffers (data).
     :param list directories:
         List of paths of node directories.
     :param str shard_basename:
         Base name for the shards.
 
     """
-    shard_no = 0
-    for directory in directories:
-        # partial filename of the shard
-        p_filename =  path.join(directory, shard_basename)
-        shard_name =  "%s.shard%s" % (p_filename, shard_no)
+    def write_shard(shard_no):
+        shard_name = shard_path(directories[shard_no], shard_basename,
+                                shard_no)
         write_file(shard_name, shards[shard_no])
-        shard_no += 1
 
+    node_map(write_shard, range(len(directories)))
 
-def read_shards(directories, shard_basename):
-    """Read the shards of a file from node directories and return it as a list.
+
+def shard_paths(directories, shard_basename):
+    """Returns the paths of the shards of a file in the node directories.
 
     :param list directories:
-        List of paths of node directories from which to read the
-        shards.
+        List of paths of node directories in which the shards are.
     :param str shard_basename:
         Base name for the shards; the canonical file name.
     :returns:
-        List of contents of the shards of the file with basename
+        Sorted list of paths of the shards of the file with basename
         `shard_basename`.
+    :rtype: list
 
     """
-    # get the names of the file shards
     file_shards = []
     for directory in directories:
         filename_glob = "%s.shard*" % path.join(directory, shard_basename)
         file_shard = glob(filename_glob)[0]
         file_shards.append(file_shard)
 
-    shards = []
-    for file_shard in sorted(file_shards):
-        shard_content = read_file(file_shard)
-        shards.append(shard_content)
+    return sorted(file_shards)
+
+
+def read_shards(directories, shard_basename):
+    """Read the shards of a file from node directories and return it as a list.
 
-    return shards
+    The shards are read at the same time, a thread for each node
+    directory (see :func:`node_map`).
+
+    :param list directories:
+        List of paths of node directories from which to read the
+        shards.
+    :param str shard_basename:
+        Base name for the shards; the canonical file name.
+    :returns:
+        List of contents of the shards of the file with basename
+        `shard_basename`.
+
+    """
+    return node_map(read_file, shard_paths(directories, shard_basename))
 
 
 def no_of_shards(cb_path, config):
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+from collections import OrderedDict
+from os import path
+from threading import Lock
+
+from combox.file import (DIGEST, file_stat, hash_digest, hash_file,
+                         stat_hash)
+from combox.log import log_e
+
+
+CACHE_SIZE = 4096
+"""Default maximum no. of hashes kept in a :class:`HashCache`.
+
+"""
+
+
+class HashCache(object):
+    """Cache of the hashes of files' content.
+
+    A hash is keyed by the path of the file along with its size and
+    modification time (see :func:`~combox.file.file_stat`); so, it is
+    no longer found once the file is modified. When the cache is full,
+    the least recently used hash is evicted.
+
+    If `cache_file` is not `None`, the cache is loaded from it when
+    the :class:`HashCache` object is created and is written to it by
+    :meth:`save`.
+
+    :param int size:
+        Maximum no. of hashes kept in the cache.
+    :param str cache_file:
+        Path of the file the cache persists in; `None` if it must not
+        persist.
+
+    """
+
+    def __init__(self, size=CACHE_SIZE, cache_file=None):
+        self.size = max(int(size), 1)
+        self.cache_file = cache_file
+        self.lock = Lock()
+
+        self.hashes = OrderedDict()
+        """Ordered dictionary that maps `(path, size, mtime_ns)` to
+           the hash; least recently used first.
+
+        """
+
+        if cache_file:
+            self.load()
+
+
+    def key(self, filename, fstat=None):
+        """Returns the key of `filename`'s hash in the cache.
+
+        :param str filename:
+            Absolute pathname of the file.
+        :param tuple fstat:
+            filename's stats as returned by
+            :func:`~combox.file.file_stat`; if `None`, filename is
+            stat'ed.
+        :rtype: tuple
+
+        """
+        if fstat is None:
+            fstat = file_stat(filename)
+
+        return (filename, fstat[0], fstat[1])
+
+
+    def get(self, filename, fstat=None):
+        """Returns the cached hash of `filename`.
+
+        :param str filename:
+            Absolute pathname of the file.
+        :param tuple fstat:
+            See :meth:`key`.
+        :returns:
+            The hash or `None` if it is not in the cache.
+        :rtype: str
+
+        """
+        key = self.key(filename, fstat)
+
+        with self.lock:
+            fhash = self.hashes.pop(key, None)
+            if fhash is not None:
+                # most recently used.
+                self.hashes[key] = fhash
+
+        return fhash
+
+
+    def put(self, filename, fhash, fstat=None):
+        """Caches `fhash` as the hash of `filename`.
+
+        :param str filename:
+            Absolute pathname of the file.
+        :param str fhash:
+            Hash of filename's content when its stats were `fstat`.
+        :param tuple fstat:
+            See :meth:`key`.
+
+        """
+        key = self.key(filename, fstat)
+
+        with self.lock:
+            self.hashes.pop(key, None)
+            self.hashes[key] = fhash
+            while len(self.hashes) > self.size:
+                self.hashes.popitem(last=False)
+
+
+    def hash_file(self, filename, file_content=None, digest=DIGEST):
+        """Returns the hash of `filename`'s content, from the cache if possible.
+
+        Same as :func:`~combox.file.hash_file`, which is called if the
+        hash is not in the cache or was computed with another digest
+        algorithm; the hash is then cached.
+
+        :param str filename:
+            Absolute pathname of the file.
+        :param str file_content:
+            If not ``None``, its hash is returned; content that is not
+            on disk is never cached.
+        :param str digest:
+            Name of the digest algorithm to use; see
+            :data:`~combox.file.DIGESTS`.
+        :rtype: str
+
+        """
+        if file_content:
+            return hash_file(filename, file_content, digest)
+
+        return self.hash_stat(filename, digest)[0]
+
+
+    def hash_stat(self, filename, digest=DIGEST):
+        """Returns the hash of `filename`'s content and its stats, from the cache if possible.
+
+        If the hash is not in the cache, or was computed with another
+        digest algorithm, the file is hashed with
+        :func:`~combox.file.stat_hash` and its hash is cached.
+
+        :param str filename:
+            Absolute pathname of the file.
+        :param str digest:
+            Name of the digest algorithm to use; see
+            :data:`~combox.file.DIGESTS`.
+        :returns:
+            `(fhash, fstat)`; see :func:`~combox.file.stat_hash`.
+        :rtype: tuple
+
+        """
+        fstat = file_stat(filename)
+        fhash = self.get(filename, fstat)
+        if fhash is None or hash_digest(fhash) != digest:
+            fhash, fstat = stat_hash(filename, digest=digest)
+            self.put(filename, fhash, fstat)
+
+        return fhash, fstat
+
+
+    def load(self):
+        """Loads the cache from :attr:`cache_file`.
+
+        A cache file that cannot be read is ignored.
+
+        """
+        try:
+            with open(self.cache_file, 'rb') as f:
+                entries = json.load(f)
+        except (IOError, ValueError), e:
+            if path.exists(self.cache_file):
+                log_e("Unable to load hash cache %s: %s" %
+                      (self.cache_file, e))
+            return
+
+        with self.lock:
+            for filename, size, mtime_ns, fhash in entries[-self.size:]:
+                key = (filename.encode('utf-8'), size, mtime_ns)
+                self.hashes[key] = fhash.encode('utf-8')
+
+
+    def save(self):
+        """Writes the cache to :attr:`cache_file`, if it must persist.
+
+        """
+        if not self.cache_file:
+            return
+
+        with self.lock:
+            entries = [[filename, size, mtime_ns, fhash] for
+                       (filename, size, mtime_ns), fhash in
+                       self.hashes.iteritems()]
+
+        tmp_file = '%s.%d' % (self.cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                json.dump(entries, f)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError, ValueError), e:
+            log_e("Unable to save hash cache %s: %s" % (self.cache_file, e))
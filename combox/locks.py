@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+from contextlib import contextmanager
+from os import path, sep
+from thread import get_ident
+from threading import Condition
+
+
+def related(p, q):
+    """Checks if paths `p` and `q` are the same or one of them is under the other.
+
+    :param str p:
+        A normalized path.
+    :param str q:
+        A normalized path.
+    :rtype: bool
+
+    """
+    return (p == q or p.startswith(q.rstrip(sep) + sep) or
+            q.startswith(p.rstrip(sep) + sep))
+
+
+class PathLocks(object):
+    """Locks paths, so that only the operations on related paths wait for each other.
+
+    A path that is held (see :meth:`hold`) by a thread cannot be
+    held by another thread, nor can any path under it, if it is a
+    directory, or any directory above it; so, operations on the same
+    file are done one after the other and an operation on a directory
+    waits for the operations on the paths under it, and the other way
+    round, while operations on unrelated paths are done at the same
+    time.
+
+    A thread can hold a path again, or a path related to the ones it
+    already holds.
+
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+
+        self.held = {}
+        """Dictionary that maps the held paths to the id of the thread
+           that holds them and the no. of times they are held.
+
+        """
+
+
+    def conflicts(self, p, me):
+        """Checks if `p` is related to a path held by a thread other than `me`.
+
+        The caller must hold :attr:`cond`.
+
+        :param str p:
+            A normalized path.
+        :param int me:
+            Id of the thread that wants to hold `p`.
+        :rtype: bool
+
+        """
+        for q, (owner, count) in self.held.iteritems():
+            if owner != me and related(p, q):
+                return True
+
+        return False
+
+
+    @contextmanager
+    def hold(self, *paths):
+        """Holds `paths` while in the context.
+
+        The paths are held all at once, after the threads that hold
+        paths related to them let go of them; so, threads that hold
+        several paths cannot deadlock.
+
+        :param paths:
+            Paths of files or directories.
+        :returns:
+            Context manager.
+
+        """
+        paths = [path.normpath(p) for p in paths]
+        me = get_ident()
+
+        with self.cond:
+            while [p for p in paths if self.conflicts(p, me)]:
+                self.cond.wait()
+
+            for p in paths:
+                self.held.setdefault(p, [me, 0])[1] += 1
+
+        try:
+            yield
+        finally:
+            with self.cond:
+                for p in paths:
+                    self.held[p][1] -= 1
+                    if not self.held[p][1]:
+                        del self.held[p]
+                self.cond.notify_all()
@@ -0,0 +1,713 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+import time
+
+from bisect import insort
+from heapq import heappop, heappush
+from itertools import count
+from multiprocessing import cpu_count
+from os import path
+from threading import Condition, Thread
+
+from combox.file import file_stat
+from combox.log import log_e
+
+
+QUIET_PERIOD = 1.0
+"""Minimum no. of seconds a file must be left alone before its job is run.
+
+"""
+
+LARGE_FILE_SIZE = 30
+"""Size, in MiB, from which a file is given a longer quiet period.
+
+See :func:`quiet_period`.
+
+"""
+
+QUEUE_SIZE = 1024
+"""Default maximum no. of jobs waiting in a :class:`JobQueue`.
+
+"""
+
+JOB_PRIORITIES = {
+    'directory': 0,
+    'move': 0,
+    'delete': 0,
+    'shard': 1,
+    'glue': 1,
+    }
+"""Priorities of the kinds of jobs in a :class:`JobQueue`; lower is sooner.
+
+Jobs that only move or remove things, or deal with directories, are
+quick; they are done before the jobs that encrypt or decrypt files.
+
+"""
+
+def quiet_period(fpath):
+    """Returns the no. of seconds `fpath` must be left alone before its job is run.
+
+    It is :data:`QUIET_PERIOD`, or a second for every
+    :data:`LARGE_FILE_SIZE` MiB of `fpath`, whichever is larger; a
+    sync client may pause for a while between writes to a large file.
+
+    :param str fpath:
+        Path of a file.
+    :rtype: float
+
+    """
+    try:
+        f_size_MiB = path.getsize(fpath) / 1048576.0
+    except OSError:
+        return QUIET_PERIOD
+
+    return max(QUIET_PERIOD, f_size_MiB / LARGE_FILE_SIZE)
+
+
+def _stat(fpath):
+    """Returns the stats of `fpath`, or `None` if it does not exist.
+
+    """
+    try:
+        return file_stat(fpath)
+    except OSError:
+        return None
+
+
+class Debouncer(object):
+    """Runs a job for a path once the file at the path is left alone for a while.
+
+    Jobs are scheduled with :meth:`schedule`, keyed by path. A job
+    scheduled for a path that already has a job pending replaces it
+    and restarts the wait; so, a burst of events for a file collapses
+    into a single job.
+
+    When the wait is over, the job is run, on the debouncer's own
+    thread, only if the size, modification time and inode of the file
+    did not change since the job was scheduled (see
+    :func:`~combox.file.file_stat`); otherwise, it waits once more. The
+    job of a file that no longer exists is dropped.
+
+    The thread is started when the first job is scheduled; it is a
+    daemon thread.
+
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+
+        self.jobs = {}
+        """Dictionary that maps paths to their pending job; a list of
+           the time it is due, the quiet period, the file's stats,
+           the function and its arguments.
+
+        """
+
+        self.running = 0
+        self.thread = None
+        self.stopped = False
+
+
+    def schedule(self, fpath, delay, func, *args):
+        """Schedules `func(*args)` to run once `fpath` is left alone for `delay` seconds.
+
+        :param str fpath:
+            Path of a file.
+        :param float delay:
+            The quiet period, in seconds; see :func:`quiet_period`.
+        :param function func:
+            Function to call.
+
+        """
+        with self.cond:
+            self.jobs[fpath] = [time.time() + delay, delay, _stat(fpath),
+                                func, args]
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+
+
+    def pending(self):
+        """Returns the no. of jobs that are pending or running.
+
+        :rtype: int
+
+        """
+        with self.cond:
+            return len(self.jobs) + self.running
+
+
+    def stop(self):
+        """Stops the thread; the pending jobs are dropped.
+
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+        if self.thread is not None:
+            self.thread.join()
+
+
+    def run(self):
+        """Runs the jobs as they are due; this is what the thread runs.
+
+        """
+        while True:
+            with self.cond:
+                ready = self.due()
+                while not ready and not self.stopped:
+                    if self.jobs:
+                        timeout = min([job[0] for job in
+                                       self.jobs.itervalues()])
+                        self.cond.wait(max(timeout - time.time(), 0))
+                    else:
+                        self.cond.wait()
+                    ready = self.due()
+
+                if self.stopped:
+                    return
+                self.running = len(ready)
+
+            for fpath, func, args in ready:
+                try:
+                    func(*args)
+                except Exception, e:
+                    log_e("Job for %s failed: %s" % (fpath, e))
+
+            with self.cond:
+                self.running = 0
+
+
+    def due(self):
+        """Takes the jobs that are due and whose files are left alone off the queue.
+
+        The caller must hold :attr:`cond`.
+
+        :returns:
+            List of `(fpath, func, args)` tuples.
+        :rtype: list
+
+        """
+        now = time.time()
+
+        ready = []
+        for fpath, job in self.jobs.items():
+            if job[0] > now:
+                continue
+
+            fstat = _stat(fpath)
+            if fstat is None:
+                # the file is gone.
+                del self.jobs[fpath]
+            elif fstat != job[2]:
+                # the file is still being written; wait some more.
+                job[0] = now + job[1]
+                job[2] = fstat
+            else:
+                del self.jobs[fpath]
+                ready.append((fpath, job[3], job[4]))
+
+        return ready
+
+
+class DelayedScheduler(object):
+    """Runs jobs after a delay, on a single thread; the jobs can be cancelled.
+
+    Jobs are scheduled with :meth:`schedule`, keyed; a job scheduled
+    with a key that already has a job pending replaces it. A pending
+    job is cancelled with :meth:`cancel`.
+
+    The jobs are kept in a heap ordered by the time they are due; so,
+    any no. of jobs is run by the scheduler's own thread, which is
+    started when the first job is scheduled; it is a daemon thread.
+
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+
+        self.heap = []
+        """Heap of the time the jobs are due, their sequence no. and
+           key; it may have jobs that were cancelled or replaced.
+
+        """
+
+        self.jobs = {}
+        """Dictionary that maps keys to their pending job; a tuple of
+           the sequence no. of the job, the function and its arguments.
+
+        """
+
+        self.seq = count()
+        self.running = 0
+        self.thread = None
+        self.stopped = False
+
+
+    def schedule(self, key, delay, func, *args):
+        """Schedules `func(*args)` to run in `delay` seconds.
+
+        :param key:
+            Key of the job; a path, usually.
+        :param float delay:
+            No. of seconds to wait before the job is run.
+        :param function func:
+            Function to call.
+
+        """
+        with self.cond:
+            seq = next(self.seq)
+            self.jobs[key] = (seq, func, args)
+            heappush(self.heap, (time.time() + delay, seq, key))
+
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+
+
+    def cancel(self, key):
+        """Cancels the pending job of `key`.
+
+        :param key:
+            Key of the job.
+        :returns:
+            `True` if a job was pending; `False` otherwise.
+        :rtype: bool
+
+        """
+        with self.cond:
+            return self.jobs.pop(key, None) is not None
+
+
+    def keys(self):
+        """Returns the keys of the pending jobs.
+
+        :rtype: list
+
+        """
+        with self.cond:
+            return self.jobs.keys()
+
+
+    def pending(self):
+        """Returns the no. of jobs that are pending or running.
+
+        :rtype: int
+
+        """
+        with self.cond:
+            return len(self.jobs) + self.running
+
+
+    def stop(self):
+        """Stops the thread; the pending jobs are dropped.
+
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+        if self.thread is not None:
+            self.thread.join()
+
+
+    def run(self):
+        """Runs the jobs as they are due; this is what the thread runs.
+
+        """
+        while True:
+            with self.cond:
+                job = self.due()
+                while job is None and not self.stopped:
+                    if self.heap:
+                        self.cond.wait(max(self.heap[0][0] - time.time(), 0))
+                    else:
+                        self.cond.wait()
+                    job = self.due()
+
+                if self.stopped:
+                    return
+                self.running = 1
+
+            key, func, args = job
+            try:
+                func(*args)
+            except Exception, e:
+                log_e("Job for %s failed: %s" % (key, e))
+
+            with self.cond:
+                self.running = 0
+
+
+    def due(self):
+        """Takes the job that is due first off the heap, if it is due.
+
+        The jobs that were cancelled or replaced are dropped from the
+        top of the heap. The caller must hold :attr:`cond`.
+
+        :returns:
+            `(key, func, args)`, or `None` if no job is due.
+        :rtype: tuple
+
+        """
+        while self.heap:
+            due, seq, key = self.heap[0]
+            job = self.jobs.get(key)
+            if job is None or job[0] != seq:
+                # cancelled or replaced.
+                heappop(self.heap)
+            elif due > time.time():
+                return None
+            else:
+                heappop(self.heap)
+                del self.jobs[key]
+                return key, job[1], job[2]
+
+        return None
+
+
+def parents(p):
+    """Yields the directories above path `p`, the nearest first.
+
+    :param str p:
+        A normalized path.
+
+    """
+    parent = path.dirname(p)
+    while parent and parent != p:
+        yield parent
+        p, parent = parent, path.dirname(parent)
+
+
+def job_queue(config):
+    """Returns a :class:`JobQueue` set up as per `config`.
+
+    The no. of workers is the value of the optional `queue_workers`
+    key in `config`, which defaults to the no. of CPUs; the maximum
+    no. of jobs waiting is the value of the optional `queue_size` key,
+    which defaults to :data:`QUEUE_SIZE`.
+
+    :param dict config:
+        A dictionary that contains configuration information about
+        combox.
+    :rtype: :class:`JobQueue`
+
+    """
+    workers = config.get('queue_workers')
+    if not workers:
+        workers = cpu_count()
+
+    size = config.get('queue_size') or QUEUE_SIZE
+
+    return JobQueue(max(int(workers), 1), max(int(size), 1))
+
+
+class JobQueue(object):
+    """Runs jobs on a pool of threads, the most urgent first.
+
+    Jobs are put in the queue with :meth:`put`; each job is of a kind
+    (see :data:`JOB_PRIORITIES`) and is about some paths. The workers
+    take the job of the lowest priority that was put first, but a job
+    is not taken while a job about the same paths, or paths under or
+    above them (see :func:`~combox.locks.related`), is running or was
+    put before it; so, the jobs about a file, or a directory and the
+    paths under it, are done in the order they were put.
+
+    :meth:`put` waits while there are `size` jobs waiting; so, the
+    threads that put jobs are held back when the workers can't keep up.
+
+    The no. of jobs waiting, how long they waited and how long they
+    ran are kept track of; see :meth:`metrics`.
+
+    The workers are started when the first job is put; they are daemon
+    threads.
+
+    :param int workers:
+        No. of threads that run the jobs.
+    :param int size:
+        Maximum no. of jobs waiting.
+
+    """
+
+    def __init__(self, workers=1, size=QUEUE_SIZE):
+        self.cond = Condition()
+        self.workers = workers
+        self.size = size
+
+        self.jobs = []
+        """Sorted list of the jobs waiting; each a tuple of the
+           priority, the sequence no., the kind, the normalized paths,
+           the time it was put, the function and its arguments.
+
+        """
+
+        self.running = {}
+        """Dictionary that maps the sequence no. of the running jobs
+           to their normalized paths.
+
+        """
+
+        self.at = {}
+        """Dictionary that maps normalized paths to the sequence nos.
+           of the jobs, waiting or running, that are about them; in
+           the order they were put.
+
+        """
+
+        self.under = {}
+        """Dictionary that maps normalized paths of directories to
+           the sequence nos. of the jobs, waiting or running, that are
+           about paths under them; in the order they were put.
+
+        """
+
+        self.seq = count()
+        self.threads = []
+        self.stopped = False
+
+        self.stats = {
+            'put': 0,
+            'done': 0,
+            'failed': 0,
+            'max_depth': 0,
+            'wait_time': 0.0,
+            'service_time': 0.0,
+            }
+        """Dictionary of the counters reported by :meth:`metrics`.
+
+        """
+
+
+    def put(self, kind, paths, func, *args):
+        """Puts a job that calls `func(*args)` in the queue.
+
+        Waits while the queue is full.
+
+        :param str kind:
+            Kind of job; a key of :data:`JOB_PRIORITIES`.
+        :param list paths:
+            Paths the job is about.
+        :param function func:
+            Function to call.
+
+        """
+        paths = tuple(path.normpath(p) for p in paths)
+
+        with self.cond:
+            while len(self.jobs) >= self.size and not self.stopped:
+                self.cond.wait()
+
+            if self.stopped:
+                return
+
+            seq = next(self.seq)
+            insort(self.jobs, (JOB_PRIORITIES[kind], seq, kind, paths,
+                               time.time(), func, args))
+            self.index(seq, paths)
+            self.stats['put'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'],
+                                          len(self.jobs))
+
+            if not self.threads:
+                for i in range(self.workers):
+                    thread = Thread(target=self.run)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+            self.cond.notify_all()
+
+
+    def pending(self):
+        """Returns the no. of jobs that are waiting or running.
+
+        :rtype: int
+
+        """
+        with self.cond:
+            return len(self.jobs) + len(self.running)
+
+
+    def metrics(self):
+        """Returns the metrics of the queue.
+
+        :returns:
+            Dictionary with the no. of jobs waiting (`depth`) and
+            running (`running`), the most jobs ever waiting
+            (`max_depth`), the no. of jobs put (`put`), done (`done`)
+            and failed (`failed`), and the average no. of seconds the
+            finished jobs waited (`wait_time`) and ran
+            (`service_time`).
+        :rtype: dict
+
+        """
+        with self.cond:
+            metrics = dict(self.stats)
+            metrics['depth'] = len(self.jobs)
+            metrics['running'] = len(self.running)
+
+        finished = max(metrics['done'] + metrics['failed'], 1)
+        metrics['wait_time'] /= finished
+        metrics['service_time'] /= finished
+
+        return metrics
+
+
+    def stop(self):
+        """Stops the workers once the running jobs are done; the waiting jobs are dropped.
+
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+
+
+    def run(self):
+        """Runs the jobs; this is what the workers run.
+
+        """
+        while True:
+            with self.cond:
+                job = self.take()
+                while job is None and not self.stopped:
+                    self.cond.wait()
+                    job = self.take()
+
+                if self.stopped:
+                    return
+
+            priority, seq, kind, paths, put_at, func, args = job
+            started = time.time()
+            failed = False
+            try:
+                func(*args)
+            except Exception, e:
+                failed = True
+                log_e("%s job for %s failed: %s" % (kind, ', '.join(paths),
+                                                    e))
+
+            with self.cond:
+                self.unindex(seq, self.running.pop(seq))
+                self.stats['failed' if failed else 'done'] += 1
+                self.stats['wait_time'] += started - put_at
+                self.stats['service_time'] += time.time() - started
+                self.cond.notify_all()
+
+
+    def take(self):
+        """Takes the next job that can be run off the queue.
+
+        The caller must hold :attr:`cond`.
+
+        :returns:
+            The job, or `None` if no job can be run now.
+        :rtype: tuple
+
+        """
+        for i, job in enumerate(self.jobs):
+            if self.blocked(job):
+                continue
+
+            del self.jobs[i]
+            self.running[job[1]] = job[3]
+            # there's room for one more job.
+            self.cond.notify_all()
+            return job
+
+        return None
+
+
+    def blocked(self, job):
+        """Checks if `job` must wait for a running job or a job put before it.
+
+        The jobs about the paths of `job`, the paths under them and
+        the directories above them are looked up in :attr:`at` and
+        :attr:`under`; so, it takes no longer with more jobs in the
+        queue.
+
+        The caller must hold :attr:`cond`.
+
+        :param tuple job:
+            A job waiting in the queue.
+        :rtype: bool
+
+        """
+        seq = job[1]
+
+        def ahead(index, p):
+            # the jobs in the index are in the order they were put.
+            seqs = index.get(p)
+            return bool(seqs) and seqs[0] < seq
+
+        for p in job[3]:
+            if ahead(self.at, p) or ahead(self.under, p):
+                return True
+            for parent in parents(p):
+                if ahead(self.at, parent):
+                    return True
+
+        return False
+
+
+    def index(self, seq, paths):
+        """Adds the job `seq` about `paths` to :attr:`at` and :attr:`under`.
+
+        The caller must hold :attr:`cond`.
+
+        :param int seq:
+            Sequence no. of the job.
+        :param tuple paths:
+            Normalized paths the job is about.
+
+        """
+        for p in paths:
+            self.at.setdefault(p, []).append(seq)
+            for parent in parents(p):
+                self.under.setdefault(parent, []).append(seq)
+
+
+    def unindex(self, seq, paths):
+        """Removes the job `seq` about `paths` from :attr:`at` and :attr:`under`.
+
+        The caller must hold :attr:`cond`.
+
+        :param int seq:
+            Sequence no. of the job.
+        :param tuple paths:
+            Normalized paths the job is about.
+
+        """
+        def remove(index, p):
+            index[p].remove(seq)
+            if not index[p]:
+                del index[p]
+
+        for p in paths:
+            remove(self.at, p)
+            for parent in parents(p):
+                remove(self.under, parent)
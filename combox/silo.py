@@ -18,17 +18,76 @@
 #   along with Combox (see COPYING).  If not, see
 #   <http://www.gnu.org/licenses/>.
 
-import pickledb
+import json
+import os
+import sqlite3
 
+from contextlib import contextmanager
 from os import path
-from threading import Lock
+from threading import Lock, Timer
 
-from combox.file import hash_file
+from combox.file import file_stat, get_digest, hash_digest
+from combox.hashcache import CACHE_SIZE, HashCache
+from combox.log import log_i
+
+
+MAX_DIRTY = 1000
+"""Default maximum no. of changes to the silo that are not committed yet.
+
+"""
 
 
 class ComboxSilo(object):
     """Helps keep track of files in combox directory.
 
+    The information is stored in a SQLite database, `silo.sqlite`,
+    under the silo directory. If a `silo.db` created by an older
+    version of combox is found there, its contents are moved to the
+    SQLite database the first time the silo is opened.
+
+    A copy of the whole DB is kept in memory; it is what is read from.
+    Changes are written to both. The copy is re-loaded from the DB
+    only when some other :class:`ComboxSilo` object or process has
+    changed it (see :meth:`reload`). So, a single :class:`ComboxSilo`
+    object should be shared by the :class:`.ComboxDirMonitor` and all
+    the :class:`.NodeDirMonitor` objects.
+
+    Along with the hash of each file, the size, modification time
+    and inode number of the file, when it was hashed, are stored; if
+    they have not changed since, the file is not hashed again to find
+    whether it is stale (see :meth:`unchanged`). If the optional
+    `silo_paranoid` key in `config` is `True`, files are always
+    hashed.
+
+    Files are hashed with the digest algorithm given by the optional
+    `digest` key in `config` (see :func:`~combox.file.get_digest`).
+    Each hash is tagged with its algorithm (see
+    :func:`~combox.file.hexdigest`), so hashes computed with another
+    algorithm, before it was changed, are still checked correctly
+    (see :meth:`hash_digest`).
+
+    Files are hashed through a :class:`~combox.hashcache.HashCache`,
+    :attr:`hashes`, that holds up to `hash_cache_size` (optional key
+    in `config`) hashes. If the optional `hash_cache_persist` key in
+    `config` is `True`, the cache persists in `hash.cache` under the
+    silo directory (see :meth:`flush`).
+
+    Changes are committed to the DB in groups (see :meth:`writing`
+    and :meth:`batch`); each commit is a single transaction, so the
+    DB on disk is always consistent. How long changes may wait to be
+    committed is set by the optional `silo_flush_interval` (seconds;
+    defaults to `0`, commit right away) and `silo_max_dirty` (no. of
+    changes; defaults to :data:`MAX_DIRTY`) keys in `config`.
+
+    The interval is `0` by default because a transaction that is not
+    committed yet holds SQLite's write lock: until it is committed,
+    other :class:`ComboxSilo` objects -- in another process, or given
+    to monitors that do not share the silo -- neither see its changes
+    nor can write to the DB ("database is locked"). A combox run
+    shares a single silo (see :func:`~combox.cbox.run_cb`), so it can
+    set `silo_flush_interval` safely; housekeeping commits in batches
+    (see :meth:`batch`) either way.
+
     :param dict config:
         A dictionary that contains configuration information about
         combox.
@@ -44,8 +103,14 @@ class ComboxSilo(object):
         """
         self.config = config
 
-        self.silo_path = path.join(config['silo_dir'], 'silo.db')
-        self.db = pickledb.load(self.silo_path, True)
+        self.silo_path = path.join(config['silo_dir'], 'silo.sqlite')
+        # transactions are begun and committed explicitly; see
+        # writing().
+        self.db = sqlite3.connect(self.silo_path, check_same_thread=False,
+                                  isolation_level=None)
+        # file paths are stored and returned as they are; not as
+        # unicode.
+        self.db.text_factory = str
 
         ## things we need for housekeep the node directories
         self.node_dicts = ['file_created', 'file_modified', 'file_moved',
@@ -60,40 +125,353 @@ class ComboxSilo(object):
 
         when :class:`ComboxSilo` object is created.
 
-        """
+        Each dictionary is a table in the DB.
 
-        # created the dicts if not already created.
-        for ndict in self.node_dicts:
-            if not self.db.get(ndict):
-                self.db.dcreate(ndict)
+        """
 
         self.lock = lock
 
+        self.files = {}
+        """Dictionary that maps paths of files tracked by combox to their
+           hashes; the in-memory copy of the `files` table.
+
+        """
+
+        self.stats = {}
+        """Dictionary that maps paths of files tracked by combox to their
+           `(size, mtime_ns, inode)`; see
+           :func:`~combox.file.file_stat`.
+
+        """
+
+        self.nodes = {}
+        """Dictionary that maps the names in :attr:`node_dicts` to the
+           in-memory copy of their tables.
+
+        """
+
+        # PRAGMA data_version of the DB when it was last loaded.
+        self.data_version = None
+
+        self.flush_interval = float(config.get('silo_flush_interval', 0))
+        self.max_dirty = int(config.get('silo_max_dirty', MAX_DIRTY))
+        self.paranoid = bool(config.get('silo_paranoid', False))
+        self.digest = get_digest(config)
+
+        cache_file = None
+        if config.get('hash_cache_persist'):
+            cache_file = path.join(config['silo_dir'], 'hash.cache')
+        self.hashes = HashCache(config.get('hash_cache_size', CACHE_SIZE),
+                                cache_file)
+        """:class:`~combox.hashcache.HashCache` that files are hashed
+           through.
+
+        """
+
+        # no. of changes not committed yet.
+        self.dirty = 0
+        # True if a transaction was begun and not committed yet.
+        self.in_transaction = False
+        # no. of batches (see batch()) that are not done yet.
+        self.batches = 0
+        # commits the changes after flush_interval seconds.
+        self.flush_timer = None
+
+        with self.lock:
+            # readers don't block the writer and vice versa; each
+            # commit is synced to disk.
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=FULL')
+
+            # create the tables if not already created.
+            self.db.execute('CREATE TABLE IF NOT EXISTS files '
+                            '(path TEXT PRIMARY KEY, hash TEXT NOT NULL, '
+                            'size INTEGER, mtime_ns INTEGER, inode INTEGER)')
+            # files table of a DB created before the stats were stored.
+            columns = [row[1] for row in
+                       self.db.execute('PRAGMA table_info(files)')]
+            for column in ['size', 'mtime_ns', 'inode']:
+                if column not in columns:
+                    self.db.execute('ALTER TABLE files ADD COLUMN %s '
+                                    'INTEGER' % column)
+            for ndict in self.node_dicts:
+                self.db.execute('CREATE TABLE IF NOT EXISTS %s '
+                                '(path TEXT PRIMARY KEY, value)' % ndict)
+
+            self.migrate(path.join(config['silo_dir'], 'silo.db'))
+
+        self.reload()
+
+
+    def migrate(self, pickledb_path):
+        """Moves the contents of the pickledb silo at `pickledb_path` to the DB.
+
+        The pickledb silo is renamed to `silo.db.migrated` afterwards,
+        so this is done only once. Nothing is done if there's no
+        pickledb silo at `pickledb_path`.
+
+        The caller must hold :attr:`lock`.
+
+        :param str pickledb_path:
+            Path to the JSON file of the pickledb silo.
+
+        """
+        if not path.exists(pickledb_path):
+            return
+
+        def encode(value):
+            # json gives unicode strings; the DB stores byte strings.
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            return value
+
+        with open(pickledb_path, 'r') as f:
+            content = f.read()
+        old_db = json.loads(content) if content.strip() else {}
+
+        files = []
+        self.db.execute('BEGIN')
+        for key, value in old_db.iteritems():
+            key = encode(key)
+            if key in self.node_dicts:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO %s VALUES (?, ?)' % key,
+                    [(encode(k), encode(v)) for k, v in value.iteritems()])
+            else:
+                files.append((key, encode(value)))
+        self.db.executemany('INSERT OR REPLACE INTO files (path, hash) '
+                            'VALUES (?, ?)', files)
+        self.db.execute('COMMIT')
+
+        os.rename(pickledb_path, '%s.migrated' % pickledb_path)
+        log_i("Moved %d files' info from %s to %s" % (len(files),
+                                                      pickledb_path,
+                                                      self.silo_path))
+
+
+    @contextmanager
+    def writing(self):
+        """Context in which a change is made to the DB; holds :attr:`lock`.
+
+        The change is committed when the context exits, unless it is
+        part of a :meth:`batch` or a `silo_flush_interval` is
+        set. In the latter case, it is committed after
+        `silo_flush_interval` seconds or when there are
+        `silo_max_dirty` changes not committed yet, whichever is
+        first.
+
+        If the change fails half way, it is rolled back (see
+        :meth:`rollback`); the changes made before it are kept.
+
+        """
+        with self.lock:
+            if not self.in_transaction:
+                self.db.execute('BEGIN')
+                self.in_transaction = True
+
+            self.db.execute('SAVEPOINT writing')
+            done = False
+            try:
+                yield
+                done = True
+            finally:
+                if done:
+                    self.db.execute('RELEASE writing')
+                else:
+                    self.rollback()
+
+            self.dirty += 1
+            if self.batches:
+                return
+
+            if not self.flush_interval or self.dirty >= self.max_dirty:
+                self.commit()
+            elif self.flush_timer is None:
+                self.flush_timer = Timer(self.flush_interval, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+
+    @contextmanager
+    def batch(self):
+        """Context in which changes to the DB are committed together.
+
+        All the changes made to the DB, by any thread, while in this
+        context are committed in a single transaction when the
+        context exits. Batches can be nested; the changes are
+        committed when the outermost batch exits.
+
+        """
+        with self.lock:
+            self.batches += 1
+
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batches -= 1
+                if not self.batches:
+                    self.commit()
+
+
+    def commit(self):
+        """Commits the changes made to the DB that are not committed yet.
+
+        The caller must hold :attr:`lock`.
+
+        """
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        if self.in_transaction:
+            self.db.execute('COMMIT')
+            self.in_transaction = False
+            self.dirty = 0
+
+
+    def rollback(self):
+        """Undoes the change made in :meth:`writing` that failed.
+
+        The in-memory copy of the DB, which the change may have
+        altered too, is loaded again by the next :meth:`reload`.
+
+        The caller must hold :attr:`lock`.
+
+        """
+        try:
+            self.db.execute('ROLLBACK TO writing')
+            self.db.execute('RELEASE writing')
+        except sqlite3.Error:
+            # SQLite rolled back the whole transaction already.
+            self.in_transaction = False
+            self.dirty = 0
+
+        self.data_version = None
+
+
+    def flush(self):
+        """Commits the changes made to the DB that are not committed yet.
+
+        The hash cache is saved too, if it persists.
+
+        """
+        with self.lock:
+            self.commit()
+
+        self.hashes.save()
+
 
     def reload(self):
-        """Re-loads the DB from disk.
+        """Re-loads the DB from disk, if it was changed.
+
+        SQLite's `PRAGMA data_version` tells if the DB was changed by
+        another connection since it was last loaded; the changes made
+        through this object don't count.
 
         """
         with self.lock:
-            self.db = pickledb.load(self.silo_path, True)
+            data_version = self.db.execute(
+                'PRAGMA data_version').fetchone()[0]
+            if data_version == self.data_version:
+                return
+
+            self.files = {}
+            self.stats = {}
+            for row in self.db.execute('SELECT path, hash, size, mtime_ns, '
+                                       'inode FROM files'):
+                self.files[row[0]] = row[1]
+                if row[2] is not None:
+                    self.stats[row[0]] = tuple(row[2:])
+            for ndict in self.node_dicts:
+                self.nodes[ndict] = dict(self.db.execute(
+                    'SELECT path, value FROM %s' % ndict))
+            self.data_version = data_version
 
 
-    def update(self, filep):
+    def update(self, filep, fhash=None, fstat=None):
         """Update filep's info in DB.
 
-        Path of `filep` and the hash of its content is written to the
-        DB.
+        Path of `filep`, the hash of its content and its stats are
+        written to the DB.
 
         :param str filep:
             Path to the file under the combox directory.
+        :param str fhash:
+            If not `None`, it is assumed to be filep's hash; for
+            instance, the hash returned by
+            :func:`~combox.crypto.split_and_encrypt`.
+        :param tuple fstat:
+            If not `None`, it is assumed to be filep's stats, as
+            returned by :func:`~combox.file.file_stat`, when `fhash`
+            was computed. If `fhash` is given without `fstat`, no
+            stats are stored and filep is hashed again the next time
+            :meth:`stale` is called on it.
+        :returns: `True`
+        :rtype: bool
+
+        """
+        if not fhash:
+            fhash, fstat = self.hashes.hash_stat(filep, self.digest)
+
+        return self.update_many({filep: fhash}, {filep: fstat})
+
+
+    def update_many(self, fhashes, fstats=None):
+        """Update the info of many files in DB at once.
+
+        All the files are updated in a single transaction.
+
+        :param dict fhashes:
+            Dictionary that maps paths of files under the combox
+            directory to the hash of their content.
+        :param dict fstats:
+            Dictionary that maps paths in `fhashes` to their stats, as
+            returned by :func:`~combox.file.file_stat`, when they were
+            hashed. Files that are not in it are hashed again the next
+            time :meth:`stale` is called on them.
         :returns: `True`
         :rtype: bool
 
+        """
+        if fstats is None:
+            fstats = {}
+
+        rows = []
+        for filep, fhash in fhashes.iteritems():
+            fstat = fstats.get(filep) or (None, None, None)
+            rows.append((filep, fhash) + tuple(fstat))
+
+        self.reload()
+        with self.writing():
+            self.db.executemany('INSERT OR REPLACE INTO files (path, hash, '
+                                'size, mtime_ns, inode) VALUES '
+                                '(?, ?, ?, ?, ?)', rows)
+            self.files.update(fhashes)
+            for filep in fhashes:
+                if fstats.get(filep):
+                    self.stats[filep] = tuple(fstats[filep])
+                    self.hashes.put(filep, fhashes[filep], fstats[filep])
+                else:
+                    self.stats.pop(filep, None)
+
+        return True
+
+
+    def get(self, filep):
+        """Returns the hash of filep's content stored in DB.
+
+        :param str filep:
+            Path to a file under the combox directory.
+        :returns:
+            Hash of filep's content; `None` if filep's info is not in
+            DB.
+        :rtype: str
+
         """
         self.reload()
         with self.lock:
-            fhash = hash_file(filep)
-            return self.db.set(filep, fhash)
+            return self.files.get(filep)
 
 
     def keys(self):
@@ -102,14 +480,12 @@ class ComboxSilo(object):
         :returns:
             List of file paths of files tracked by combox.
         :rtype:
-            `True`
+            list
 
         """
-        # this is why Redis or some other key-value DB should be used
-        # instead of PickleDB
         self.reload()
         with self.lock:
-            return self.db.db.keys()
+            return self.files.keys()
 
 
     def remove(self, filep):
@@ -124,13 +500,47 @@ class ComboxSilo(object):
         :rtype: bool
 
         """
-        try:
-            self.reload()
-            with self.lock:
-                return self.db.rem(filep)
-        except KeyError, e:
-            # means `filep' not present in db.
-            return False
+        self.reload()
+        with self.writing():
+            self.db.execute('DELETE FROM files WHERE path = ?', (filep,))
+            self.stats.pop(filep, None)
+            return self.files.pop(filep, None) is not None
+
+
+    def remove_tree(self, dirp):
+        """Removes the info of the files under `dirp` from DB, in one go.
+
+        The paths under `dirp`, and `dirp` itself, are removed from the
+        node directories' dictionaries too (see :attr:`node_dicts`).
+
+        :param str dirp:
+            Path to a directory under combox directory.
+        :returns:
+            No. of files whose information was removed.
+        :rtype: int
+
+        """
+        prefix = path.join(dirp, '')
+
+        def under(p):
+            return p == dirp or p.startswith(prefix)
+
+        self.reload()
+        with self.writing():
+            files = [(p,) for p in self.files if under(p)]
+            self.db.executemany('DELETE FROM files WHERE path = ?', files)
+            for p, in files:
+                self.stats.pop(p, None)
+                del self.files[p]
+
+            for ndict in self.node_dicts:
+                paths = [(p,) for p in self.nodes[ndict] if under(p)]
+                self.db.executemany('DELETE FROM %s WHERE path = ?' % ndict,
+                                    paths)
+                for p, in paths:
+                    del self.nodes[ndict][p]
+
+            return len(files)
 
 
     def exists(self, filep):
@@ -143,12 +553,7 @@ class ComboxSilo(object):
         :rtype: bool
 
         """
-        self.reload()
-        with self.lock:
-            if self.db.get(filep) is None:
-                return False
-            else:
-                return True
+        return self.get(filep) is not None
 
 
     def stale(self, filep, fhash=None):
@@ -157,7 +562,8 @@ class ComboxSilo(object):
         :param str filep:
             Path to a file under the combox directory.
         :param bool fhash:
-            If not `None`, it is assumed to be filep's hash.
+            If not `None`, it is assumed to be filep's hash, computed
+            with the digest algorithm returned by :meth:`hash_digest`.
         :returns:
             Returns `True`, if filep's hash is outdated; `False` if
             filep's hash is correct; `None` if filep's info is not yet
@@ -166,11 +572,12 @@ class ComboxSilo(object):
 
         """
         if not fhash:
-            fhash = hash_file(filep)
+            if self.unchanged(filep):
+                return False
+            fhash = self.hashes.hash_file(filep,
+                                          digest=self.hash_digest(filep))
 
-        self.reload()
-        with self.lock:
-            fhash_in_db = self.db.get(filep)
+        fhash_in_db = self.get(filep)
 
         if fhash_in_db is None:
             return None
@@ -180,6 +587,62 @@ class ComboxSilo(object):
             return True
 
 
+    def hash_digest(self, filep):
+        """Returns the name of the digest algorithm to hash `filep` with.
+
+        :param str filep:
+            Path to a file under the combox directory.
+        :returns:
+            The algorithm filep's hash in the DB was computed with;
+            the configured algorithm if filep is not tracked yet.
+        :rtype: str
+
+        """
+        fhash = self.get(filep)
+        if fhash is None:
+            return self.digest
+
+        return hash_digest(fhash)
+
+
+    def unchanged(self, filep):
+        """Checks if filep's stats are the same as when it was last hashed.
+
+        :param str filep:
+            Path to a file under the combox directory.
+        :returns:
+            `True` if filep's size, modification time and inode number
+            are the same as the ones stored in the DB; `False`
+            otherwise, or if `silo_paranoid` is set.
+        :rtype: bool
+
+        """
+        if self.paranoid:
+            return False
+
+        self.reload()
+        with self.lock:
+            fstat = self.stats.get(filep)
+
+        try:
+            return fstat is not None and fstat == file_stat(filep)
+        except OSError:
+            return False
+
+
+    def clear(self):
+        """Removes everything from the DB.
+
+        """
+        with self.writing():
+            self.db.execute('DELETE FROM files')
+            self.files.clear()
+            self.stats.clear()
+            for ndict in self.node_dicts:
+                self.db.execute('DELETE FROM %s' % ndict)
+                self.nodes[ndict].clear()
+
+
     def nodedicts(self):
         """Returns :attr:`node_dicts`
 
@@ -187,6 +650,21 @@ class ComboxSilo(object):
         return self.node_dicts
 
 
+    def node_dict(self, type_):
+        """Makes sure the in-memory copy of dictionary `type_` is up to date.
+
+        :param str type_:
+            The name of the dictinary in DB.
+        :raises KeyError:
+            If `type_` is not one of :attr:`node_dicts`.
+
+        """
+        if type_ not in self.node_dicts:
+            raise KeyError(type_)
+
+        self.reload()
+
+
     def node_set(self, type_, file_, num=-1):
         """Update information about the shard of `file_` in dictionary `type_` in the DB.
 
@@ -197,25 +675,21 @@ class ComboxSilo(object):
         :param str file_:
             Path of the file under the combox directory.
         :param int num:
-            Integer associated with the `file_`.
+            Integer associated with the `file_`. If it is `-1`, the
+            integer already associated with `file_` is incremented by
+            one.
 
         """
+        self.node_dict(type_)
 
-        self.reload()
-        with self.lock:
-            if num != -1:
-                self.db.dadd(type_, (file_, num))
-                return
-            try:
-                num = self.db.dget(type_, file_)
-                num += 1
-            except KeyError, e:
-                # I don't think this is the right way to do this. :|
-                #
-                # If we are here it means file_ is not already there,
-                # so:
-                num = 1
-            self.db.dadd(type_, (file_, num))
+        with self.writing():
+            ndict = self.nodes[type_]
+            if num == -1:
+                num = ndict.get(file_, 0) + 1
+
+            self.db.execute('INSERT OR REPLACE INTO %s VALUES (?, ?)'
+                            % type_, (file_, num))
+            ndict[file_] = num
 
 
     def node_store_moved_info(self, src_path, dest_path):
@@ -228,9 +702,13 @@ class ComboxSilo(object):
             The destination path of the file being moved.
 
         """
-        self.reload()
-        with self.lock:
-            self.db.dadd('file_moved_info', (src_path, dest_path))
+        self.node_dict('file_moved_info')
+
+        with self.writing():
+            ndict = self.nodes['file_moved_info']
+            self.db.execute('INSERT OR REPLACE INTO file_moved_info '
+                            'VALUES (?, ?)', (src_path, dest_path))
+            ndict[src_path] = dest_path
 
 
     def node_get(self, type_, file_):
@@ -248,13 +726,31 @@ class ComboxSilo(object):
         :rtype: int
 
         """
-        self.reload()
+        self.node_dict(type_)
+
         with self.lock:
-            try:
-                return self.db.dget(type_, file_)
-            except KeyError, e:
-                # file_ info not there under type_ dict.
-                return None
+            return self.nodes[type_].get(file_)
+
+
+    def node_files(self, type_, num):
+        """Returns the files whose number in the `type_` dictionary in DB is at least `num`.
+
+        :param str type_:
+            The name of the dictinary in DB. It must be one of the
+            following values: `file_created`, `file_modified`,
+            `file_moved`, `file_deleted`.
+        :param int num:
+            The least number.
+        :returns:
+            Paths of files under the combox directory.
+        :rtype: list
+
+        """
+        self.node_dict(type_)
+
+        with self.lock:
+            return [file_ for file_, n in self.nodes[type_].iteritems()
+                    if n >= num]
 
 
     def node_rem(self, type_, file_):
@@ -266,13 +762,19 @@ class ComboxSilo(object):
             `file_moved`, `file_deleted`.
         :param str file_:
             Path of the file under the combox directory.
+        :returns:
+            The information that was removed; `None` if there was
+            none.
 
         """
-        self.reload()
-        with self.lock:
-            try:
-                return self.db.dpop(type_, file_)
-            except KeyError, e:
+        self.node_dict(type_)
+
+        with self.writing():
+            ndict = self.nodes[type_]
+            if file_ not in ndict:
                 # means file_'s info was already removed.
-                # do nothing
-                pass
+                return None
+
+            self.db.execute('DELETE FROM %s WHERE path = ?' % type_,
+                            (file_,))
+            return ndict.pop(file_)
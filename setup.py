@@ -40,7 +40,8 @@ config = {
     'author': 'combox contributors',
     'author_email': 'sravik@bgsu.edu',
     'install_requires': ['watchdog==0.10.7', 'PyYAML==5.4.1', 'pycrypto',
-                         'simplejson', 'pickledb'],
+                         'simplejson'],
+    'extras_require': {'blake2b': ['pyblake2'], 'xxhash': ['xxhash']},
     'tests_require': ['nose', 'mock'],
     'test_suite': 'nose.collector',
     'packages': find_packages(exclude=['tests']),
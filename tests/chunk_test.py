@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+import random
+
+from cStringIO import StringIO
+from nose.tools import *
+from os import path
+
+from combox.chunk import *
+
+
+class TestChunk(object):
+    """
+    Class that tests the chunk.py module.
+    """
+
+    @classmethod
+    def setup_class(self):
+        """Set things up."""
+
+        # the same data on every run, so that the chunks are the same.
+        rand = random.Random(42)
+        self.DATA = ''.join(chr(rand.getrandbits(8))
+                            for i in xrange(262144))
+        self.AVG_SIZE = 4096
+
+
+    def test_storagemode(self):
+        """Tests the storage_mode and chunk_size functions."""
+        assert_equal('shards', storage_mode({}))
+        assert_equal('chunks', storage_mode({'storage_mode': 'chunks'}))
+        assert_raises(ValueError, storage_mode, {'storage_mode': 'foo'})
+
+        assert_equal(CHUNK_SIZE, chunk_size({}))
+        assert_equal(4096, chunk_size({'chunk_size': '4096'}))
+        assert_raises(ValueError, chunk_size, {'chunk_size': 1000})
+        assert_raises(ValueError, chunk_size, {'chunk_size': WINDOW})
+
+
+    def test_chunkranges(self):
+        """Tests the chunk_ranges function."""
+        ranges = list(chunk_ranges(self.DATA, self.AVG_SIZE))
+
+        # the chunks cover the data.
+        assert_equal(0, ranges[0][0])
+        assert_equal(len(self.DATA), ranges[-1][1])
+        for (start, end), (next_start, next_end) in zip(ranges, ranges[1:]):
+            assert_equal(end, next_start)
+
+        for start, end in ranges[:-1]:
+            assert self.AVG_SIZE / 2 <= end - start <= self.AVG_SIZE * 8
+        assert 0 < len(ranges) < len(self.DATA) / (self.AVG_SIZE / 2)
+
+        assert_equal([], list(chunk_ranges('', self.AVG_SIZE)))
+        assert_equal([(0, 10)], list(chunk_ranges('0123456789')))
+
+
+    def test_chunkranges_shift(self):
+        """Tests if chunk_ranges cuts data into the same chunks after an insertion."""
+        def chunks(data):
+            return [data[start:end] for start, end in
+                    chunk_ranges(data, self.AVG_SIZE)]
+
+        middle = len(self.DATA) / 2
+        data = self.DATA[:middle] + 'lorem ipsum' + self.DATA[middle:]
+
+        old_chunks = chunks(self.DATA)
+        new_chunks = chunks(data)
+        assert_equal(''.join(new_chunks), data)
+        # only the chunk holding the insertion is cut anew.
+        assert_equal(1, len(set(old_chunks) - set(new_chunks)))
+        assert_equal(2, len(set(new_chunks) - set(old_chunks)))
+        assert_equal(old_chunks[0], new_chunks[0])
+        assert_equal(old_chunks[-1], new_chunks[-1])
+
+
+    def test_cutchunks(self):
+        """Tests if cut_chunks cuts a file into the same chunks as chunk_ranges."""
+        chunks = [self.DATA[start:end] for start, end in
+                  chunk_ranges(self.DATA, self.AVG_SIZE)]
+        assert_equal(chunks, list(cut_chunks(StringIO(self.DATA),
+                                             len(self.DATA), self.AVG_SIZE)))
+
+        # reading starts at the current position.
+        data = StringIO(self.DATA)
+        data.seek(1000)
+        assert_equal(self.DATA[1000:], ''.join(cut_chunks(
+            data, len(self.DATA) - 1000, self.AVG_SIZE)))
+
+        assert_equal([], list(cut_chunks(StringIO(''), 0)))
+        assert_raises(IOError, list, cut_chunks(StringIO(self.DATA),
+                                                len(self.DATA) + 1,
+                                                self.AVG_SIZE))
+
+
+    def test_chunkid(self):
+        """Tests the chunk_id and chunk_basename functions."""
+        cid = chunk_id(self.DATA, 'topsecret')
+        assert_equal(64, len(cid))
+        assert_equal(cid, chunk_id(buffer(self.DATA), 'topsecret'))
+        assert cid != chunk_id(self.DATA, 'bottomsecret')
+
+        assert_equal(path.join(CHUNK_DIR, cid[:2], cid), chunk_basename(cid))
+
+
+    def test_chunkp(self):
+        """Tests the chunkp function."""
+        assert chunkp(path.join('node', CHUNK_DIR))
+        assert chunkp(path.join('node', CHUNK_DIR, 'ab', 'abc.shard0'))
+        assert not chunkp(path.join('node', 'lorem.txt.shard0'))
+        assert not chunkp(path.join('node', '%s.txt' % CHUNK_DIR))
+
+
+    def test_manifest(self):
+        """Tests the pack_manifest and unpack_manifest functions."""
+        chunks = [(chunk_id(self.DATA[start:end], 'topsecret'), end - start)
+                  for start, end in chunk_ranges(self.DATA, self.AVG_SIZE)]
+
+        manifest = pack_manifest(chunks)
+        assert_equal(MANIFEST_ENTRY.size * len(chunks), len(manifest))
+        assert_equal(chunks, unpack_manifest(manifest))
+        assert_equal([], unpack_manifest(pack_manifest([])))
+        assert_raises(ValueError, unpack_manifest, manifest[:-1])
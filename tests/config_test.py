@@ -18,12 +18,17 @@
 #   along with Combox (see COPYING).  If not, see
 #   <http://www.gnu.org/licenses/>.
 
+import os
 import yaml
 
+import combox.config
+
+from multiprocessing import Pool
 from nose.tools import *
 from os import path, remove, rmdir
 
-from combox.config import (config_cb, get_secret, get_stdin)
+from combox.config import (config_cb, get_secret, get_stdin,
+                           get_salt, SALT_SIZE)
 from tests.utils import (get_input_func, rm_nodedirs,
                          get_config, rm_configdir)
 
@@ -57,6 +62,29 @@ class TestConfig(object):
             raise AssertionError("Error in configuration file:", exc)
 
 
+    def test_get_salt(self):
+        """Tests the get_salt function."""
+        config = get_config()
+        salt = get_salt(config)
+
+        assert_equal(SALT_SIZE, len(salt))
+        # the salt is stored; it's the same the next time.
+        assert_equal(salt, get_salt(config))
+        assert path.isfile(path.join(config['silo_dir'], 'kdf.salt'))
+        # it is not read again.
+        assert_equal(salt, combox.config._salts[path.join(config['silo_dir'],
+                                                           'kdf.salt')])
+
+        # many processes asking for the salt at once get the same salt.
+        config['silo_dir'] = path.join(config['silo_dir'], 'salt')
+        os.mkdir(config['silo_dir'])
+        pool = Pool(4)
+        salts = pool.map(get_salt, [config] * 8)
+        pool.close()
+        pool.join()
+        assert_equal([get_salt(config)] * 8, salts)
+
+
     @classmethod
     def teardown_class(self):
         """Tear everything down."""
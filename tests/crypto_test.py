@@ -18,20 +18,32 @@
 #   along with Combox (see COPYING).  If not, see
 #   <http://www.gnu.org/licenses/>.
 
+import base64
+import copy
+import mock
 import yaml
 
+from Crypto.Cipher import AES
 from filecmp import cmp
 from glob import glob
 from nose.tools import *
 from os import path, remove
 from shutil import copyfile
 
-from combox.config import get_nodedirs
+from combox.chunk import cut_chunks
+from combox.config import get_nodedirs, get_salt, SALT_SIZE
 from combox.crypto import *
 from combox.file import *
 from tests.utils import get_config, rm_nodedirs, rm_configdir
 
 
+def legacy_encrypt(data, secret):
+    """Encrypt `data` the way combox did before binary shards."""
+    aes = AES.new(pad(secret))
+
+    return base64.b64encode(aes.encrypt(pad(str(data))))
+
+
 class TestCrypto(object):
     """
     Class that tests the crypto.py module.
@@ -63,7 +75,14 @@ class TestCrypto(object):
         # decrypt
         f_content_decrypted = decrypt(f_cipher, self.config['topsecret'])
 
-        assert f_content == f_content_decrypted
+        assert f_content == str(f_content_decrypted)
+
+        # encrypting a buffer gives the same cipher.
+        for size in [0, 1, BLOCK_SIZE, len(f_content)]:
+            assert_equal(encrypt(f_content[:size],
+                                 self.config['topsecret']),
+                         encrypt(buffer(f_content, 0, size),
+                                 self.config['topsecret']))
 
 
     def test_split_encryption(self):
@@ -119,6 +138,316 @@ class TestCrypto(object):
         assert cmp(self.TEST_FILE, self.TEST_FILE_COPY, False)
 
 
+    def test_split_and_encrypt_stream(self):
+        """
+        Tests if split_and_encrypt creates the same shards when it streams the file from disk.
+        """
+        nodes = get_nodedirs(self.config)
+        f_basename = relative_path(self.TEST_FILE, self.config)
+
+        fhash = split_and_encrypt(self.TEST_FILE, self.config,
+                                  read_file(self.TEST_FILE))
+        ciphered_shards = read_shards(nodes, f_basename)
+        assert_equal(hash_file(self.TEST_FILE), fhash)
+
+        fhash = split_and_encrypt(self.TEST_FILE, self.config)
+        assert_equal(ciphered_shards, read_shards(nodes, f_basename))
+        assert_equal(hash_file(self.TEST_FILE), fhash)
+
+
+    def test_split_and_encrypt_ioerror(self):
+        """
+        Tests if split_and_encrypt raises IOError when a node directory is missing.
+        """
+        config = copy.deepcopy(self.config)
+        node = sorted(config['nodes_info'].keys())[-1]
+        config['nodes_info'][node]['path'] = path.join(
+            config['nodes_info'][node]['path'], 'gone')
+
+        assert_raises(IOError, split_and_encrypt, self.TEST_FILE, config)
+        assert_raises(IOError, split_and_encrypt, self.TEST_FILE, config,
+                      read_file(self.TEST_FILE))
+
+
+    def test_encrypt_chunks(self):
+        """
+        Tests if encrypt_chunks gives the same cipher as encrypt.
+        """
+        secret = self.config['topsecret']
+        data = read_file(self.TEST_FILE)
+
+        for size in [0, 1, BLOCK_SIZE, 3 * BLOCK_SIZE + 1, len(data)]:
+            # odd chunk sizes too, to check the leftover bytes of a
+            # chunk are carried over to the next one.
+            for chunk_size in [100, 3 * BLOCK_SIZE, CHUNK_SIZE]:
+                chunks = [data[i:min(i + chunk_size, size)]
+                          for i in range(0, size, chunk_size)]
+                cipher = ''.join(encrypt_chunks(chunks, secret))
+                assert_equal(encrypt(data[:size], secret),
+                             shard_header(size) + cipher)
+
+
+    def test_decrypt_chunks(self):
+        """
+        Tests if decrypt_chunks gives the same data as decrypt.
+        """
+        secret = self.config['topsecret']
+        data = read_file(self.TEST_FILE)
+
+        for size in [0, 1, BLOCK_SIZE, 3 * BLOCK_SIZE + 1, len(data)]:
+            cipher = encrypt(data[:size], secret)
+            for chunk_size in [100, 4 * BLOCK_SIZE, len(cipher) + 1]:
+                chunks = [cipher[i:i + chunk_size]
+                          for i in range(0, len(cipher), chunk_size)]
+                assert_equal(str(decrypt(cipher, secret)),
+                             glue_data(decrypt_chunks(chunks, secret)))
+
+        # data that looks like padding in the middle of the shard.
+        cipher = legacy_encrypt('%s%s' % (PAD_CHAR * 200, 'x'), secret)
+        chunks = [cipher[i:i + 128] for i in range(0, len(cipher), 128)]
+        assert_equal(decrypt(cipher, secret),
+                     glue_data(decrypt_chunks(chunks, secret)))
+
+
+    def test_shard_format(self):
+        """
+        Tests the binary shard format and the reading of legacy base64 shards.
+        """
+        secret = self.config['topsecret']
+        data = read_file(self.TEST_FILE)
+
+        salt = get_salt(self.config)
+        cipher = encrypt(data, secret, 1, 2, salt)
+        assert cipher.startswith(SHARD_MAGIC)
+        assert_equal({'version': SHARD_VERSION, 'length': len(data),
+                      'shard_no': 1, 'shards': 2, 'salt': salt, 'flags': 0,
+                      'header_size': SHARD_HEADER.size}, shard_info(cipher))
+        # no base64 overhead.
+        assert_equal(SHARD_HEADER.size + len(pad(data)), len(cipher))
+
+        # version 1 shards, encrypted without a salt.
+        cipher = encrypt(data, secret, 1, 2)
+        assert_equal(1, shard_info(cipher)['version'])
+        assert_equal(None, shard_info(cipher)['salt'])
+
+        # version 3 shards, with flags.
+        cipher = encrypt(data, secret, 1, 2, salt, FLAG_MANIFEST)
+        assert_equal(3, shard_info(cipher)['version'])
+        assert_equal(FLAG_MANIFEST, shard_info(cipher)['flags'])
+        assert_equal(data, str(decrypt(cipher, secret)))
+        assert_equal(data, str(decrypt(cipher, secret)))
+
+        # the length in the header tells where the padding starts.
+        for data_end in [PAD_CHAR, PAD_CHAR * (BLOCK_SIZE + 1)]:
+            cipher = encrypt(data + data_end, secret)
+            assert_equal(data + data_end, str(decrypt(cipher, secret)))
+            chunks = [cipher[i:i + 100] for i in range(0, len(cipher), 100)]
+            assert_equal(data + data_end,
+                         glue_data(decrypt_chunks(chunks, secret)))
+
+        # legacy shards.
+        legacy_cipher = legacy_encrypt(data, secret)
+        assert_equal(None, shard_info(legacy_cipher))
+        assert_equal(data, decrypt(legacy_cipher, secret))
+        chunks = [legacy_cipher[i:i + 4 * BLOCK_SIZE]
+                  for i in range(0, len(legacy_cipher), 4 * BLOCK_SIZE)]
+        assert_equal(data, ''.join(decrypt_chunks(chunks, secret)))
+
+        # a file whose shards are a mix of legacy and binary shards.
+        nodes = get_nodedirs(self.config)
+        f_basename = relative_path(self.TEST_FILE, self.config)
+        f_shards = split_data(data, len(nodes))
+        ciphers = [legacy_encrypt(f_shards[0], secret)]
+        ciphers.extend(encrypt_shards(f_shards, secret)[1:])
+        write_shards(ciphers, nodes, f_basename)
+        assert_equal(data, decrypt_and_glue(self.TEST_FILE, self.config,
+                                            write=False))
+        decrypt_and_glue(self.TEST_FILE, self.config)
+        assert cmp(self.TEST_FILE, self.TEST_FILE_COPY, False)
+
+
+    def test_get_cipher(self):
+        """
+        Tests that the key is derived from the salt once and cached.
+        """
+        secret = self.config['topsecret']
+        salt = get_salt(self.config)
+        assert_equal(salt, get_salt(self.config))
+        assert_equal(SALT_SIZE, len(salt))
+
+        assert get_cipher(secret, salt) is get_cipher(secret, salt)
+        assert get_cipher(secret, salt) is not get_cipher(secret)
+
+        # the shards written by split_and_encrypt carry the salt.
+        split_and_encrypt(self.TEST_FILE, self.config)
+        f_basename = relative_path(self.TEST_FILE, self.config)
+        for f_shard in shard_paths(get_nodedirs(self.config), f_basename):
+            head = read_file(f_shard)[:SHARD_HEADER.size]
+            assert_equal(salt, shard_info(head)['salt'])
+
+        decrypt_and_glue(self.TEST_FILE, self.config)
+        assert cmp(self.TEST_FILE, self.TEST_FILE_COPY, False)
+
+
+    def test_decrypt_and_glue_stream(self):
+        """
+        Tests if decrypt_and_glue leaves no temporary files behind in the combox directory.
+        """
+        split_and_encrypt(self.TEST_FILE, self.config)
+
+        # only hashed.
+        os.remove(self.TEST_FILE)
+        assert_equal(hash_file(self.TEST_FILE_COPY, digest='md5'),
+                     decrypt_and_glue(self.TEST_FILE, self.config,
+                                      hash_only=True, digest='md5'))
+        assert not path.exists(self.TEST_FILE)
+
+        fhash = decrypt_and_glue(self.TEST_FILE, self.config)
+
+        assert_equal(hash_file(self.TEST_FILE_COPY), fhash)
+        assert cmp(self.TEST_FILE, self.TEST_FILE_COPY, False)
+        tmp_glob = path.join(path.dirname(self.TEST_FILE), '.#*~')
+        assert_equal([], glob(tmp_glob))
+
+
+    def test_store_chunks(self):
+        """
+        Tests the chunks storage mode.
+        """
+        config = dict(self.config, storage_mode='chunks', chunk_size=16384)
+        nodes = get_nodedirs(config)
+        chunk_glob = path.join(nodes[0], CHUNK_DIR, '*', '*.shard*')
+
+        fhash = split_and_encrypt(self.TEST_FILE, config)
+        assert_equal(hash_file(self.TEST_FILE_COPY), fhash)
+        f_chunks = read_manifest(self.TEST_FILE, config)
+        assert len(f_chunks) > 1
+        assert_equal(path.getsize(self.TEST_FILE),
+                     sum([length for cid, length in f_chunks]))
+        assert_equal(len(set(f_chunks)), len(glob(chunk_glob)))
+
+        assert_equal(read_file(self.TEST_FILE_COPY),
+                     decrypt_and_glue(self.TEST_FILE, config, write=False))
+        assert_equal(fhash, decrypt_and_glue(self.TEST_FILE, config,
+                                             hash_only=True))
+        # the hash is known already.
+        assert_equal('known', decrypt_and_glue(self.TEST_FILE, config,
+                                               fhash='known'))
+        assert_equal(fhash, decrypt_and_glue(self.TEST_FILE, config))
+        assert cmp(self.TEST_FILE, self.TEST_FILE_COPY, False)
+
+        # a byte inserted in the middle of the file changes only the
+        # chunks around it.
+        data = read_file(self.TEST_FILE_COPY)
+        edited = '%s.edited' % self.TEST_FILE
+        middle = len(data) / 2
+        write_file(edited, data[:middle] + 'x' + data[middle:])
+        stored = len(glob(chunk_glob))
+        split_and_encrypt(edited, config)
+        edited_chunks = read_manifest(edited, config)
+        new_chunks = set(edited_chunks) - set(f_chunks)
+        assert 0 < len(new_chunks) <= 2
+        assert_equal(stored + len(new_chunks), len(glob(chunk_glob)))
+        assert_equal(hash_file(edited),
+                     decrypt_and_glue(edited, config))
+
+        # the chunks that are no longer used are swept.
+        rm_shards(edited, config)
+        remove(edited)
+        assert_equal(0, sweep_chunks(config))
+        assert_equal(len(new_chunks) * len(nodes), sweep_chunks(config, 0))
+        assert_equal(stored, len(glob(chunk_glob)))
+        assert_equal(fhash, decrypt_and_glue(self.TEST_FILE, config))
+
+        # a chunk that did not arrive yet.
+        assert_equal([], missing_chunks(self.TEST_FILE, config))
+        c_shard = glob(chunk_glob)[0]
+        c_content = read_file(c_shard)
+        remove(c_shard)
+        assert_equal([path.basename(c_shard).partition('.shard')[0]],
+                     missing_chunks(self.TEST_FILE, config))
+        write_file(c_shard, c_content)
+        assert_equal([], missing_chunks(self.TEST_FILE, config))
+
+        # shards are not a manifest; no chunk is used.
+        split_and_encrypt(self.TEST_FILE, self.config)
+        assert_equal(None, read_manifest(self.TEST_FILE, self.config))
+        assert_equal(stored * len(nodes), sweep_chunks(config, 0))
+        assert_equal([], glob(chunk_glob))
+
+
+    def test_store_chunks_append(self):
+        """
+        Tests if store_chunks stores only the bytes appended to a file.
+        """
+        config = dict(self.config, storage_mode='chunks', chunk_size=4096)
+        log = path.join(config['combox_dir'], 'lorem.log')
+        data = read_file(self.TEST_FILE_COPY)[:65536]
+        write_file(log, data)
+
+        fhash = split_and_encrypt(log, config)
+        f_chunks = read_manifest(log, config)
+
+        # appended to.
+        write_file(log, data + 'lorem ipsum')
+        new_fhash = split_and_encrypt(log, config, fhash=fhash)
+        assert_equal(hash_file(log), new_fhash)
+        new_chunks = read_manifest(log, config)
+        assert_equal(f_chunks[:-1], new_chunks[:len(f_chunks) - 1])
+        assert_equal(data + 'lorem ipsum',
+                     decrypt_and_glue(log, config, write=False))
+
+        # the same chunks as if the file was cut all over again.
+        assert_equal(new_fhash, split_and_encrypt(log, config))
+        assert_equal(new_chunks, read_manifest(log, config))
+
+        # not an append; the hash of the start of the file differs.
+        write_file(log, 'ipsum' + data + 'lorem ipsum dolor')
+        assert_equal(hash_file(log),
+                     split_and_encrypt(log, config, fhash=new_fhash))
+        assert_equal(read_file(log),
+                     decrypt_and_glue(log, config, write=False))
+
+        # edited in the middle; the chunks before the edit are kept
+        # and the file is cut only from the first chunk that changed.
+        content = read_file(log)
+        fhash = hash_file(log)
+        f_chunks = read_manifest(log, config)
+        middle = len(content) / 2
+        kept = 0
+        for cid, length in f_chunks[:-1]:
+            if kept + length > middle:
+                break
+            kept += length
+        write_file(log, content[:middle] + 'x' + content[middle:])
+        with mock.patch('combox.crypto.cut_chunks',
+                        wraps=cut_chunks) as cut:
+            new_fhash = split_and_encrypt(log, config, fhash=fhash)
+        assert kept > 0
+        assert_equal(len(content) + 1 - kept, cut.call_args[0][1])
+        assert_equal(hash_file(log), new_fhash)
+        assert_equal(read_file(log),
+                     decrypt_and_glue(log, config, write=False))
+
+        ## the same chunks as if the file was cut all over again.
+        new_chunks = read_manifest(log, config)
+        split_and_encrypt(log, config)
+        assert_equal(new_chunks, read_manifest(log, config))
+
+        # the hash is computed with the configured algorithm, not the
+        # one of the old hash; the unchanged chunks are kept.
+        config['digest'] = 'md5'
+        fhash = hash_file(log)
+        old_chunks = read_manifest(log, config)
+        write_file(log, read_file(log) + 'sit amet')
+        assert_equal(hash_file(log, digest='md5'),
+                     split_and_encrypt(log, config, fhash=fhash))
+        assert_equal(old_chunks[:-1], read_manifest(log, config)[:-1])
+
+        rm_shards(log, config)
+        remove(log)
+
+
     @classmethod
     def teardown_class(self):
         """Purge the mess created by this test"""
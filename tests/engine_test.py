@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+import mock
+
+from nose.tools import *
+from os import path, remove
+from threading import Lock
+
+from combox.engine import *
+from combox.file import hash_file, no_of_shards, rm_shards, write_file
+from combox.silo import ComboxSilo
+from tests.utils import get_config, rm_nodedirs, rm_configdir, purge
+
+
+class TestEngine(object):
+    """
+    Class that tests the engine.py module.
+    """
+
+    @classmethod
+    def setup_class(self):
+        """Set things up."""
+
+        self.config = get_config()
+        self.config['housekeep_workers'] = 2
+        self.silo = ComboxSilo(self.config, Lock())
+
+        FILES_DIR = self.config['combox_dir']
+        self.FILES = [path.join(FILES_DIR, f) for f in
+                      ['lorem.txt', 'ipsum.txt', 'the-red-star.jpg']]
+        self.NEW_FILE = path.join(FILES_DIR, 'dolor.txt')
+
+
+    def test_housekeepworkers(self):
+        """Tests the housekeep_workers function."""
+        assert_equal(2, housekeep_workers(self.config))
+        assert_equal(3, housekeep_workers({'housekeep_workers': '3'}))
+        assert housekeep_workers({}) >= 1
+
+
+    def test_shardfiles(self):
+        """Tests the shard_files function."""
+        nodes = len(self.config['nodes_info'])
+
+        # new files.
+        files = [(f, None) for f in self.FILES]
+        assert_equal(len(self.FILES), shard_files(files, self.config,
+                                                  self.silo))
+        for f in self.FILES:
+            assert_equal(nodes, no_of_shards(f, self.config))
+            assert_equal(hash_file(f), self.silo.get(f))
+            assert self.silo.unchanged(f)
+
+        # files that were not modified are not sharded again; nor
+        # hashed, their hashes are in the silo's cache.
+        files = [(f, self.silo.get(f)) for f in self.FILES]
+        with mock.patch('combox.engine.run_jobs',
+                        wraps=run_jobs) as run_jobs_:
+            assert_equal(0, shard_files(files, self.config, self.silo))
+        assert_equal([], run_jobs_.call_args[0][1])
+
+        # a modified file.
+        write_file(self.NEW_FILE, 'dolor sit amet')
+        self.silo.update(self.NEW_FILE)
+        write_file(self.NEW_FILE, 'dolor sit amet, consectetur')
+        files = [(self.NEW_FILE, self.silo.get(self.NEW_FILE))]
+        assert_equal(1, shard_files(files, self.config, self.silo))
+        assert_equal(hash_file(self.NEW_FILE),
+                     self.silo.get(self.NEW_FILE))
+
+        # a file that no longer exists is skipped.
+        missing = path.join(self.config['combox_dir'], 'missing.txt')
+        assert_equal(0, shard_files([(missing, None)], self.config,
+                                    self.silo))
+        assert_equal(None, self.silo.get(missing))
+
+
+    def test_gluefiles(self):
+        """Tests the glue_files function."""
+        FILES_DIR = self.config['combox_dir']
+        files = []
+        for i in range(3):
+            f = path.join(FILES_DIR, 'amet-%d.txt' % i)
+            write_file(f, 'lorem ipsum dolor sit amet %d' % i)
+            files.append(f)
+        self.FILES.extend(files)
+
+        fhashes = dict((f, hash_file(f)) for f in files)
+        shard_files([(f, None) for f in files], self.config, self.silo)
+
+        # the files were created on another computer.
+        for f in files:
+            remove(f)
+            self.silo.remove(f)
+            self.silo.node_set('file_created', f, 2)
+
+        assert_equal(len(files), glue_files(files, self.config,
+                                            self.silo))
+        for f in files:
+            assert_equal(fhashes[f], hash_file(f))
+            assert_equal(fhashes[f], self.silo.get(f))
+            assert self.silo.unchanged(f)
+            assert_equal(None, self.silo.node_get('file_created', f))
+
+        # shards that no longer exist.
+        missing = path.join(FILES_DIR, 'missing.txt')
+        assert_equal(0, glue_files([missing], self.config, self.silo))
+        assert not path.exists(missing)
+
+
+    @classmethod
+    def teardown_class(self):
+        """Purge the mess created by this test."""
+        for f in self.FILES + [self.NEW_FILE]:
+            rm_shards(f, self.config)
+        purge(self.FILES[3:] + [self.NEW_FILE])
+        rm_nodedirs(self.config)
+        rm_configdir()
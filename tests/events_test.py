@@ -18,6 +18,7 @@
 #   along with Combox (see COPYING).  If not, see
 #   <http://www.gnu.org/licenses/>.
 
+import mock
 import os
 import time
 import yaml
@@ -25,12 +26,15 @@ import yaml
 from filecmp import cmp
 from glob import glob
 from os import path, remove
-from shutil import copyfile
+from shutil import copyfile, rmtree
 from threading import Lock
 
 from nose.tools import *
+from watchdog.events import (FileCreatedEvent, FileDeletedEvent,
+                             FileMovedEvent)
 from watchdog.observers import Observer
 
+from combox.chunk import CHUNK_DIR
 from combox.config import get_nodedirs
 from combox.crypto import (decrypt_and_glue, split_and_encrypt,
                            encrypt_shards)
@@ -39,8 +43,8 @@ from combox.file import (relative_path, purge_dir, hash_file,
                          read_file, write_file, move_shards,
                          rm_shards, mk_nodedir, rm_nodedir,
                          move_nodedir, node_paths, rm_path,
-                         split_data, write_shards)
-
+                         split_data, write_chunks, write_shards)
+from combox.locks import PathLocks
 from combox.silo import ComboxSilo
 from tests.utils import (get_config, shardedp, dirp, renamedp,
                          path_deletedp, rm_nodedirs, rm_configdir,
@@ -57,7 +61,7 @@ class TestEvents(object):
         """Set things up."""
 
         self.silo_lock = Lock()
-        self.monitor_lock = Lock()
+        self.path_locks = PathLocks()
         self.config = get_config()
         self.silo = ComboxSilo(self.config, self.silo_lock)
 
@@ -79,7 +83,7 @@ class TestEvents(object):
         Tests the ComboxDirMonitor class.
         """
 
-        event_handler = ComboxDirMonitor(self.config, self.silo_lock, self.monitor_lock)
+        event_handler = ComboxDirMonitor(self.config, self.silo_lock, self.path_locks)
         observer = Observer()
         observer.schedule(event_handler, self.FILES_DIR, recursive=True)
         observer.start()
@@ -171,7 +175,7 @@ class TestEvents(object):
         shardedp(self.lorem_file_copy)
         ## check if the lorem_file_copy's info is stored in silo
         silo = ComboxSilo(self.config, self.silo_lock)
-        lorem_file_copy_hash = silo.db.get(self.lorem_file_copy)
+        lorem_file_copy_hash = silo.get(self.lorem_file_copy)
 
         self.ipsum_file = path.join(self.FILES_DIR, 'ipsum.txt')
         ipsum_content = read_file(self.ipsum_file)
@@ -183,7 +187,7 @@ class TestEvents(object):
         time.sleep(2)
         ## check if the lorem_file_copy's info is updated in silo
         silo = ComboxSilo(self.config, self.silo_lock)
-        assert lorem_file_copy_hash != silo.db.get(self.lorem_file_copy)
+        assert lorem_file_copy_hash != silo.get(self.lorem_file_copy)
 
 
         # decrypt_and_glue will decrypt the file shards, glues them and
@@ -213,7 +217,7 @@ class TestEvents(object):
         # test file deletion and addition
         os.rename(self.lorem, self.lorem_moved)
 
-        cdm = ComboxDirMonitor(self.config, self.silo_lock, self.monitor_lock)
+        cdm = ComboxDirMonitor(self.config, self.silo_lock, self.path_locks)
         cdm.housekeep()
 
         silo = ComboxSilo(self.config, self.silo_lock)
@@ -230,7 +234,7 @@ class TestEvents(object):
         copyfile(self.lorem, self.lorem_ipsum)
         assert path.exists(self.lorem_ipsum)
 
-        cdm = ComboxDirMonitor(self.config, self.silo_lock, self.monitor_lock)
+        cdm = ComboxDirMonitor(self.config, self.silo_lock, self.path_locks)
         cdm.housekeep()
 
         silo = ComboxSilo(self.config, self.silo_lock)
@@ -248,16 +252,85 @@ class TestEvents(object):
         assert not silo.stale(self.lorem_ipsum)
 
 
+    def test_CDM_stats(self):
+        """Tests if ComboxDirMonitor stores the stats of the files it shards."""
+        cdm = ComboxDirMonitor(self.config, self.silo_lock, self.path_locks)
+
+        lcopy = "%s.stats" % self.lorem
+        copyfile(self.lorem, lcopy)
+        cdm.created(FileCreatedEvent(lcopy))
+        shardedp(lcopy)
+        ## the file is not hashed again.
+        silo = ComboxSilo(self.config, self.silo_lock)
+        assert silo.unchanged(lcopy)
+
+        write_file(lcopy, "%s\n%s" % (read_file(lcopy),
+                                      read_file(self.ipsum)))
+        cdm.reshard(lcopy)
+        silo = ComboxSilo(self.config, self.silo_lock)
+        assert silo.unchanged(lcopy)
+        assert_equal(hash_file(lcopy), silo.get(lcopy))
+
+        ## not sharded again while it is unchanged.
+        with mock.patch('combox.events.stat_hash') as stat_hash:
+            cdm.reshard(lcopy)
+        assert not stat_hash.called
+
+        self.purge_list.append(lcopy)
+
+
+    def test_CDM_tmpmoved(self):
+        """Tests if ComboxDirMonitor treats a tmp file renamed into place as a modification."""
+        cdm = ComboxDirMonitor(self.config, self.silo_lock, self.path_locks)
+        tmp = path.join(self.FILES_DIR, '.#lorem.txt.0a1b2c3d~')
+
+        with mock.patch.object(cdm.jobs, 'put') as put, \
+             mock.patch.object(cdm.debouncer, 'schedule') as schedule:
+            cdm.on_moved(FileMovedEvent(tmp, self.lorem))
+            assert not put.called
+            assert_equal(self.lorem, schedule.call_args[0][0])
+
+            schedule.reset_mock()
+            cdm.on_moved(FileMovedEvent(tmp, '%s~' % self.lorem))
+            assert not put.called
+            assert not schedule.called
+
+            cdm.on_deleted(FileDeletedEvent(tmp))
+            assert not put.called
+
+            # not a tmp file.
+            cdm.on_moved(FileMovedEvent(self.lorem, self.lorem_moved))
+            assert_equal('move', put.call_args[0][0])
+
+            # a tracked tmp file.
+            put.reset_mock()
+            with mock.patch.object(cdm.silo, 'exists', return_value=True):
+                cdm.on_moved(FileMovedEvent(tmp, self.lorem))
+                assert_equal('move', put.call_args[0][0])
+                cdm.on_deleted(FileDeletedEvent(tmp))
+                assert_equal('delete', put.call_args[0][0])
+
+
     def test_NDM_numnodes(self):
         """Tests whether the NodeDirMonitor's num_nodes variable has the
         right value.
 
         """
         nmonitor = NodeDirMonitor(self.config, self.silo_lock,
-                                  self.monitor_lock)
+                                  self.path_locks)
         assert_equal(2, nmonitor.num_nodes)
 
 
+    def test_NDM_silo(self):
+        """Tests whether the monitors share the silo given to them."""
+        nmonitor_0 = NodeDirMonitor(self.config, self.silo_lock,
+                                    self.path_locks, self.silo)
+        nmonitor_1 = NodeDirMonitor(self.config, self.silo_lock,
+                                    self.path_locks, self.silo)
+        assert nmonitor_0.silo is self.silo
+        assert nmonitor_1.silo is self.silo
+
+
     def test_NDM_oncreated(self):
         """Testing on_created method in NodeDirMonitor"""
         nodes =  get_nodedirs(self.config)
@@ -270,7 +343,7 @@ class TestEvents(object):
         # monitor them.
         for node in nodes:
             nmonitor = NodeDirMonitor(self.config, self.silo_lock,
-                                      self.monitor_lock)
+                                      self.path_locks)
             observer = Observer()
             observer.schedule(nmonitor, node, recursive=True)
             observer.start()
@@ -332,7 +405,7 @@ class TestEvents(object):
         # monitor them.
         for node in nodes:
             nmonitor = NodeDirMonitor(self.config, self.silo_lock,
-                                      self.monitor_lock)
+                                      self.path_locks)
             observer = Observer()
             observer.schedule(nmonitor, node, recursive=True)
             observer.start()
@@ -354,7 +427,7 @@ class TestEvents(object):
         shardedp(self.lorem_file_copy)
 
         self.silo.reload()
-        lorem_file_copy_hash = self.silo.db.get(self.lorem_file_copy)
+        lorem_file_copy_hash = self.silo.get(self.lorem_file_copy)
 
         self.ipsum_file = path.join(self.FILES_DIR, 'ipsum.txt')
         ipsum_content = read_file(self.ipsum_file)
@@ -367,7 +440,7 @@ class TestEvents(object):
 
         ## check if the lorem_file_copy's info is updated in silo
         self.silo.reload()
-        assert lorem_file_copy_hash != self.silo.db.get(self.lorem_file_copy)
+        assert lorem_file_copy_hash != self.silo.get(self.lorem_file_copy)
         assert_equal(None, self.silo.node_get('file_modified',
                                               self.lorem_file_copy))
 
@@ -391,7 +464,7 @@ class TestEvents(object):
         # monitor them.
         for node in nodes:
             nmonitor = NodeDirMonitor(self.config, self.silo_lock,
-                                      self.monitor_lock)
+                                      self.path_locks)
             observer = Observer()
             observer.schedule(nmonitor, node, recursive=True)
             observer.start()
@@ -434,6 +507,53 @@ class TestEvents(object):
             observers[i].join()
 
 
+    def test_NDM_ondeleted_tree(self):
+        """Tests if NodeDirMonitor deletes a directory tree removed from the node directories in one go."""
+        nodes = get_nodedirs(self.config)
+
+        observers = []
+        for node in nodes:
+            nmonitor = NodeDirMonitor(self.config, self.silo_lock,
+                                      self.path_locks)
+            observer = Observer()
+            observer.schedule(nmonitor, node, recursive=True)
+            observer.start()
+            observers.append(observer)
+
+        FOO_DIR = path.join(self.FILES_DIR, 'foo')
+        BAR_DIR = path.join(FOO_DIR, 'bar')
+        foo_guide = path.join(FOO_DIR, 'foo.guide')
+        bar_guide = path.join(BAR_DIR, 'bar.guide')
+
+        mk_nodedir(FOO_DIR, self.config)
+        time.sleep(1)
+        mk_nodedir(BAR_DIR, self.config)
+        time.sleep(1)
+        for guide in (foo_guide, bar_guide):
+            split_and_encrypt(guide, self.config,
+                              read_file(self.TEST_FILE))
+        time.sleep(2)
+        assert path.exists(foo_guide)
+        assert path.exists(bar_guide)
+
+        # Test - removal of the `foo' tree in all the node directories.
+        for foo_node_dir in node_paths(FOO_DIR, self.config, False):
+            rmtree(foo_node_dir)
+        time.sleep(4)
+        assert not path.exists(FOO_DIR)
+
+        silo = ComboxSilo(self.config, self.silo_lock)
+        assert not silo.exists(foo_guide)
+        assert not silo.exists(bar_guide)
+        assert_equal(None, silo.node_get('file_deleted', foo_guide))
+
+        self.purge_list.append(FOO_DIR)
+
+        for observer in observers:
+            observer.stop()
+            observer.join()
+
+
     def test_GoogleDrive_file_modify(self):
         """Simulates Google Drive client's file modification behavior and
         checks if combox is interpreting it properly.
@@ -449,7 +569,7 @@ class TestEvents(object):
         # monitor them.
         for node in nodes:
             nmonitor = NodeDirMonitor(self.config, self.silo_lock,
-                                      self.monitor_lock)
+                                      self.path_locks)
             observer = Observer()
             observer.schedule(nmonitor, node, recursive=True)
             observer.start()
@@ -467,7 +587,7 @@ class TestEvents(object):
         self.silo.update(self.lorem_copy)
         shardedp(self.lorem_copy)
 
-        lorem_copy_hash = self.silo.db.get(self.lorem_copy)
+        lorem_copy_hash = self.silo.get(self.lorem_copy)
 
         ipsum_content = read_file(self.ipsum)
         lorem_copy_content = "%s\n%s" % (lorem_content, ipsum_content)
@@ -515,7 +635,7 @@ class TestEvents(object):
         assert lorem_copy_content == read_file(self.lorem_copy)
 
         ## check if the lorem_copy's info is updated in silo
-        assert lorem_copy_hash != self.silo.db.get(self.lorem_copy)
+        assert lorem_copy_hash != self.silo.get(self.lorem_copy)
         assert_equal(None, self.silo.node_get('file_modified',
                                                   self.lorem_copy))
 
@@ -533,7 +653,7 @@ class TestEvents(object):
         """
 
         event_handler = NodeDirMonitor(self.config, self.silo_lock,
-                                       self.monitor_lock)
+                                       self.path_locks)
         observer = Observer()
         observer.schedule(event_handler, self.NODE_DIR, recursive=True)
         observer.start()
@@ -583,7 +703,7 @@ class TestEvents(object):
         shardedp(self.lorem_file_copy)
 
         silo = ComboxSilo(self.config, self.silo_lock)
-        lorem_file_copy_hash = silo.db.get(self.lorem_file_copy)
+        lorem_file_copy_hash = silo.get(self.lorem_file_copy)
 
         self.ipsum_file = path.join(self.FILES_DIR, 'ipsum.txt')
         ipsum_content = read_file(self.ipsum_file)
@@ -596,7 +716,7 @@ class TestEvents(object):
         silo = ComboxSilo(self.config, self.silo_lock)
 
         assert lorem_copy_content == read_file(self.lorem_file_copy)
-        assert lorem_file_copy_hash != silo.db.get(self.lorem_file_copy)
+        assert lorem_file_copy_hash != silo.get(self.lorem_file_copy)
 
         self.purge_list.append(self.lorem_file_copy)
 
@@ -617,7 +737,7 @@ class TestEvents(object):
         # monitor them.
         for node in nodes:
             nmonitor = NodeDirMonitor(self.config, self.silo_lock,
-                                      self.monitor_lock)
+                                      self.path_locks)
             observer = Observer()
             observer.schedule(nmonitor, node, recursive=True)
             observer.start()
@@ -626,7 +746,7 @@ class TestEvents(object):
             observers.append(observer)
 
         # event_handler = NodeDirMonitor(self.config, self.silo_lock,
-        #                                self.monitor_lock)
+        #                                self.path_locks)
         # observer = Observer()
         # observer.schedule(event_handler, self.NODE_DIR, recursive=True)
         # observer.start()
@@ -700,7 +820,7 @@ class TestEvents(object):
         silo.update(testf2)
 
         ndm = NodeDirMonitor(self.config, self.silo_lock,
-                             self.monitor_lock)
+                             self.path_locks)
         ndm.housekeep()
 
         assert not path.exists(testf1)
@@ -726,7 +846,7 @@ class TestEvents(object):
         remove(node_paths(lorem_c, self.config, True)[0])
 
         ndm = NodeDirMonitor(self.config, self.silo_lock,
-                             self.monitor_lock)
+                             self.path_locks)
         ndm.housekeep()
 
         assert path.exists(hmutant)
@@ -754,7 +874,7 @@ class TestEvents(object):
         silo.update(testf2)
 
         ndm = NodeDirMonitor(self.config, self.silo_lock,
-                             self.monitor_lock)
+                             self.path_locks)
         ndm.housekeep()
 
         assert not path.exists(testf1)
@@ -771,7 +891,7 @@ class TestEvents(object):
                           hmutant_content)
 
         ndm = NodeDirMonitor(self.config, self.silo_lock,
-                             self.monitor_lock)
+                             self.path_locks)
         ndm.housekeep()
 
         assert path.exists(hmutant)
@@ -791,7 +911,7 @@ class TestEvents(object):
         shardedp(lcopy)
 
         silo = ComboxSilo(self.config, self.silo_lock)
-        lcopy_hash = silo.db.get(lcopy)
+        lcopy_hash = silo.get(lcopy)
 
         ipsum_content = read_file(self.ipsum)
         lcopy_content = "%s\n%s" % (lcopy_content, ipsum_content)
@@ -800,34 +920,112 @@ class TestEvents(object):
                           lcopy_content)
 
         ndm = NodeDirMonitor(self.config, self.silo_lock,
-                             self.monitor_lock)
+                             self.path_locks)
         ndm.housekeep()
 
         ## check if the lorem_file_copy's info is updated in silo
         silo = ComboxSilo(self.config, self.silo_lock)
 
         assert lcopy_content == read_file(lcopy)
-        assert hash_file(lcopy, lcopy_content) == silo.db.get(lcopy)
+        assert hash_file(lcopy, lcopy_content) == silo.get(lcopy)
 
         self.purge_list.append(lcopy)
 
 
+    def test_NDM_chunks_awaited(self):
+        """Testing if NodeDirMonitor glues a file whose chunks arrive after its manifest"""
+        config = dict(self.config, storage_mode='chunks', chunk_size=16384)
+        nodes = get_nodedirs(self.config)
+
+        # store the file and hold back its manifest and one of its
+        # chunks.
+        the_guide = path.join(self.FILES_DIR, 'the.chunked.guide')
+        guide_content = read_file(self.TEST_FILE)
+        split_and_encrypt(the_guide, config, guide_content)
+
+        manifest = {}
+        for shard in node_paths(the_guide, self.config, True):
+            manifest[shard] = read_file(shard)
+            remove(shard)
+        c_shard = glob(path.join(nodes[0], CHUNK_DIR, '*', '*.shard*'))[0]
+        c_content = read_file(c_shard)
+        remove(c_shard)
+
+        observers = []
+        for node in nodes:
+            nmonitor = NodeDirMonitor(self.config, self.silo_lock,
+                                      self.path_locks)
+            observer = Observer()
+            observer.schedule(nmonitor, node, recursive=True)
+            observer.start()
+
+            observers.append(observer)
+
+        # the manifest arrives; the file cannot be glued yet. The
+        # shards are written the way split_and_encrypt writes them, so
+        # that they're not read half written.
+        for shard, content in manifest.items():
+            write_chunks(shard, [content], atomic=True)
+        time.sleep(2)
+        assert not path.exists(the_guide)
+
+        # the chunk arrives.
+        write_chunks(c_shard, [c_content], atomic=True)
+        time.sleep(3)
+        assert path.exists(the_guide)
+        assert guide_content == read_file(the_guide)
+        assert self.silo.exists(the_guide)
+        assert_equal(None, self.silo.node_get('file_created', the_guide))
+
+        self.purge_list.append(the_guide)
+
+        for observer in observers:
+            observer.stop()
+            observer.join()
+
+
     def test_NDM_shardp(self):
         """Testing shardp method in NodeDirMonitor class"""
         shard = 'some.shard0'
         not_shard = 'some.extension'
         ndm = NodeDirMonitor(self.config, self.silo_lock,
-                             self.monitor_lock)
+                             self.path_locks)
 
         assert_equal(True, ndm.shardp(shard))
         assert_equal(False, ndm.shardp(not_shard))
 
+        # shards of chunks.
+        chunk_shard = path.join('node', CHUNK_DIR, 'ab', 'abc.shard0')
+        assert_equal(False, ndm.shardp(chunk_shard))
+
+
+    def test_NDM_remotehash(self):
+        """Testing remote_hash method in NodeDirMonitor class"""
+        remote = path.join(self.FILES_DIR, 'remote.txt')
+        ndm = NodeDirMonitor(self.config, self.silo_lock,
+                             self.path_locks)
+
+        split_and_encrypt(remote, self.config, 'dolor')
+        assert_equal(None, ndm.remote_hash(remote, 'sha512', True))
+        assert_equal(hash_file(remote, 'dolor'),
+                     ndm.remote_hash(remote, 'sha512'))
+        assert not path.exists(remote)
+
+        # cached, for the algorithm it was computed with.
+        assert_equal(hash_file(remote, 'dolor'),
+                     ndm.remote_hash(remote, 'sha512', True))
+        assert_equal(None, ndm.remote_hash(remote, 'md5', True))
+
+        # the shards were modified.
+        split_and_encrypt(remote, self.config, 'dolor sit amet')
+        assert_equal(None, ndm.remote_hash(remote, 'sha512', True))
+
 
     def teardown(self):
         """Cleans up things after each test in this class"""
 
         purge_nodedirs(self.config)
-        self.silo.db.deldb()
+        self.silo.clear()
         purge(self.purge_list)
 
 
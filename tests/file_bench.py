@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmark for :func:`combox.file.read_file` and :func:`combox.file.glue_data`.
+
+Times both functions on files of 1 MiB, 4 MiB, ... up to a maximum
+size (default: 1024 MiB) and prints the time taken per MiB, which
+must stay roughly the same as the size grows.
+
+Usage::
+
+    python -m tests.file_bench [MAX_SIZE_MiB]
+
+"""
+
+import os
+import sys
+import time
+
+from os import path
+from tempfile import mkdtemp
+
+from combox.file import read_file, glue_data, split_data, purge_dir
+
+
+MiB = 1048576
+
+
+def bench(func, *args):
+    """Returns the time in seconds `func` takes to run with `args`."""
+    start = time.time()
+    func(*args)
+
+    return time.time() - start
+
+
+def write_data(filename, size):
+    """Writes `size` bytes of random-ish data to `filename`."""
+    block = os.urandom(MiB)
+
+    with open(filename, 'wb') as f:
+        for i in range(size / MiB):
+            f.write(block)
+
+
+def main(max_size_MiB=1024):
+    """Runs the benchmark for sizes from 1 MiB up to `max_size_MiB`."""
+    tmp_dir = mkdtemp()
+    data_file = path.join(tmp_dir, 'data')
+
+    print '%10s %15s %15s' % ('size (MiB)', 'read_file', 'glue_data')
+    print '%10s %15s %15s' % ('', '(ms per MiB)', '(ms per MiB)')
+
+    size_MiB = 1
+    try:
+        while size_MiB <= max_size_MiB:
+            write_data(data_file, size_MiB * MiB)
+
+            read_time = bench(read_file, data_file)
+
+            # many parts, like a file glued from lots of shards.
+            parts = split_data(read_file(data_file), 64)
+            glue_time = bench(glue_data, parts)
+            del parts
+
+            print '%10d %15.3f %15.3f' % (size_MiB,
+                                          read_time * 1000 / size_MiB,
+                                          glue_time * 1000 / size_MiB)
+            size_MiB *= 4
+    finally:
+        purge_dir(tmp_dir)
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -20,7 +20,7 @@
 
 import yaml
 
-from hashlib import sha512
+from hashlib import md5, sha512
 from glob import glob
 from nose.tools import *
 from os import path, remove
@@ -61,6 +61,21 @@ class TestFile(object):
 
         assert f_content == f_content_glued
 
+        # the parts are views into f_content, not copies.
+        for f_part in f_parts:
+            assert isinstance(f_part, buffer)
+
+
+    def test_shardranges(self):
+        """Tests the shard_ranges function."""
+        assert_equal([(0, 3), (3, 6), (6, 10)], shard_ranges(10, 3))
+        assert_equal([(0, 1), (1, 2)], shard_ranges(2, 2))
+        assert_equal([(0, 0), (0, 1)], shard_ranges(1, 2))
+
+        # a file that is smaller than the no. of shards.
+        assert_equal(['', '', 'ab'],
+                     [str(part) for part in split_data('ab', 3)])
+
 
     def test_shards(self):
         """Split file into N shards, write them to disk, glue them together
@@ -91,6 +106,17 @@ class TestFile(object):
         assert f_content == f_content_glued
 
 
+    def test_nodemap(self):
+        """Tests the node_map and node_pool functions."""
+        nodes = get_nodedirs(self.config)
+        assert_equal([path.basename(node) for node in nodes],
+                     node_map(path.basename, nodes))
+        assert_equal([], node_map(path.basename, []))
+
+        # the pool is reused.
+        assert node_pool(len(nodes)) is node_pool(len(nodes))
+
+
     def test_hashing(self):
         """
         Tests the hashing function - hash_file
@@ -102,6 +128,66 @@ class TestFile(object):
         assert fhash_0 == sha512(fcontent).hexdigest()
         assert fhash_1 == sha512(fcontent).hexdigest()
 
+        # other digest algorithms.
+        md5_hash = 'md5:%s' % md5(fcontent).hexdigest()
+        assert_equal(md5_hash, hash_file(self.TEST_FILE, digest='md5'))
+        assert_equal(md5_hash, hash_file(self.TEST_FILE, fcontent, 'md5'))
+        assert_equal('md5', hash_digest(md5_hash))
+        assert_equal('sha512', hash_digest(fhash_0))
+        assert_raises(ValueError, hash_file, self.TEST_FILE, None, 'foo')
+
+        # the file is stat-ed before it is hashed.
+        fstats = []
+        def hash_(filename, digest):
+            fstats.append(file_stat(filename))
+            return hash_file(filename, digest=digest)
+        assert_equal((fhash_0, file_stat(self.TEST_FILE)),
+                     stat_hash(self.TEST_FILE))
+        fhash, fstat = stat_hash(self.TEST_FILE, hash_, digest='md5')
+        assert_equal((md5_hash, fstats[0]), (fhash, fstat))
+
+
+    def test_getdigest(self):
+        """Tests the get_digest function."""
+        assert_equal('sha512', get_digest({}))
+        assert_equal('md5', get_digest({'digest': 'md5'}))
+        assert_raises(ValueError, get_digest, {'digest': 'foo'})
+
+
+    def test_readrange(self):
+        """Tests the read_range function."""
+        fcontent = read_file(self.TEST_FILE)
+
+        chunks = list(read_range(self.TEST_FILE, 10, len(fcontent), 1000))
+        assert_equal(fcontent[10:], ''.join(chunks))
+        assert_equal(1000, len(chunks[0]))
+        assert_equal([], list(read_range(self.TEST_FILE, 10, 10, 1000)))
+
+        # the file is shorter than asked for.
+        assert_raises(IOError, list, read_range(self.TEST_FILE, 0,
+                                                len(fcontent) + 1, 1000))
+
+
+    def test_writechunks(self):
+        """Tests the write_chunks function."""
+        lorem = path.join(self.config['combox_dir'], 'lorem.chunks')
+        directory = path.dirname(lorem)
+
+        write_chunks(lorem, ['lorem', ' ', 'ipsum'], atomic=True)
+        assert_equal('lorem ipsum', read_file(lorem))
+        assert_equal([], glob(path.join(directory, '.#*~')))
+
+        # the chunks fail midway; lorem is untouched and the temporary
+        # file is removed.
+        def chunks():
+            yield 'dolor'
+            raise ValueError('no more chunks')
+        assert_raises(ValueError, write_chunks, lorem, chunks(), True)
+        assert_equal('lorem ipsum', read_file(lorem))
+        assert_equal([], glob(path.join(directory, '.#*~')))
+
+        remove(lorem)
+
 
     def test_relativepath(self):
         """
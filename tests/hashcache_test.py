@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+from nose.tools import *
+from os import path, remove, utime
+
+from combox.file import file_stat, hash_file, read_file, write_file
+from combox.hashcache import *
+from tests.utils import get_config, rm_nodedirs, rm_configdir, purge
+
+
+class TestHashCache(object):
+    """
+    Class that tests the hashcache.py module.
+    """
+
+    @classmethod
+    def setup_class(self):
+        """Set things up."""
+
+        self.config = get_config()
+        FILES_DIR = self.config['combox_dir']
+        self.LOREM = path.join(FILES_DIR, 'lorem.txt')
+        self.IPSUM = path.join(FILES_DIR, 'ipsum.txt')
+        self.DOLOR = path.join(FILES_DIR, 'dolor.txt')
+        self.CACHE_FILE = path.join(self.config['silo_dir'], 'hash.cache')
+
+
+    def test_hashfile(self):
+        """Tests the hash_file method of HashCache class."""
+        cache = HashCache()
+        lorem_hash = hash_file(self.LOREM)
+
+        assert_equal(None, cache.get(self.LOREM))
+        assert_equal(lorem_hash, cache.hash_file(self.LOREM))
+        assert_equal(lorem_hash, cache.get(self.LOREM))
+
+        # content is hashed but not cached.
+        assert_equal(hash_file(self.IPSUM),
+                     cache.hash_file(self.IPSUM, read_file(self.IPSUM)))
+        assert_equal(None, cache.get(self.IPSUM))
+
+        # the file was modified.
+        write_file(self.DOLOR, 'dolor')
+        utime(self.DOLOR, (1000000000, 1000000000))
+        dolor_hash = cache.hash_file(self.DOLOR)
+        write_file(self.DOLOR, 'dolor sit amet')
+        utime(self.DOLOR, (1000000000, 1000000000))
+        assert_equal(None, cache.get(self.DOLOR))
+        assert dolor_hash != cache.hash_file(self.DOLOR)
+        assert_equal(hash_file(self.DOLOR), cache.get(self.DOLOR))
+
+        # the stats are returned along with the hash.
+        assert_equal((hash_file(self.DOLOR), file_stat(self.DOLOR)),
+                     cache.hash_stat(self.DOLOR))
+
+
+    def test_lru(self):
+        """Tests if HashCache evicts the least recently used hash."""
+        cache = HashCache(2)
+
+        cache.put(self.LOREM, 'lorem')
+        cache.put(self.IPSUM, 'ipsum')
+        assert_equal('lorem', cache.get(self.LOREM))
+
+        write_file(self.DOLOR, 'dolor')
+        cache.put(self.DOLOR, 'dolor')
+        assert_equal(None, cache.get(self.IPSUM))
+        assert_equal('lorem', cache.get(self.LOREM))
+        assert_equal('dolor', cache.get(self.DOLOR))
+        assert_equal(2, len(cache.hashes))
+
+
+    def test_persistence(self):
+        """Tests if HashCache persists in cache_file."""
+        cache = HashCache(cache_file=self.CACHE_FILE)
+        lorem_hash = cache.hash_file(self.LOREM)
+        cache.put(self.IPSUM, 'ipsum', file_stat(self.IPSUM))
+        cache.save()
+
+        cache = HashCache(1, self.CACHE_FILE)
+        # only the most recently used hash is loaded.
+        assert_equal('ipsum', cache.get(self.IPSUM))
+        assert_equal(None, cache.get(self.LOREM))
+
+        cache = HashCache(cache_file=self.CACHE_FILE)
+        assert_equal(lorem_hash, cache.get(self.LOREM))
+
+        # a cache file that cannot be read is ignored.
+        write_file(self.CACHE_FILE, 'lorem ipsum')
+        cache = HashCache(cache_file=self.CACHE_FILE)
+        assert_equal(0, len(cache.hashes))
+        remove(self.CACHE_FILE)
+
+
+    @classmethod
+    def teardown_class(self):
+        """Purge the mess created by this test."""
+        purge([self.DOLOR])
+        rm_nodedirs(self.config)
+        rm_configdir()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+import time
+
+from nose.tools import *
+from os import path
+from threading import Thread
+
+from combox.locks import *
+from tests.utils import get_config, rm_nodedirs, rm_configdir
+
+
+class TestLocks(object):
+    """
+    Class that tests the locks.py module.
+    """
+
+    @classmethod
+    def setup_class(self):
+        """Set things up."""
+
+        self.config = get_config()
+        self.FOO_DIR = path.join(self.config['combox_dir'], 'foo')
+        self.BAR = path.join(self.FOO_DIR, 'bar.txt')
+        self.BAZ = path.join(self.config['combox_dir'], 'baz.txt')
+
+
+    def held_by_other(self, locks, p):
+        """Returns `True` if another thread is made to wait by `locks` to hold `p`."""
+        events = []
+
+        def hold():
+            with locks.hold(p):
+                events.append(p)
+
+        t = Thread(target=hold)
+        t.start()
+        t.join(0.2)
+        waited = not events
+
+        return waited, t
+
+
+    def test_related(self):
+        """Tests the related function."""
+        assert related(self.FOO_DIR, self.FOO_DIR)
+        assert related(self.FOO_DIR, self.BAR)
+        assert related(self.BAR, self.FOO_DIR)
+        assert not related(self.BAR, self.BAZ)
+        assert not related(self.FOO_DIR, '%s.txt' % self.FOO_DIR)
+
+
+    def test_hold(self):
+        """Tests if PathLocks only makes operations on related paths wait."""
+        locks = PathLocks()
+
+        with locks.hold(self.BAR):
+            # unrelated path.
+            waited, t = self.held_by_other(locks, self.BAZ)
+            assert not waited
+
+            # same path and parent directory.
+            waited, t = self.held_by_other(locks, self.BAR)
+            assert waited
+            waited, u = self.held_by_other(locks, self.FOO_DIR)
+            assert waited
+
+            # reentrant.
+            with locks.hold(self.FOO_DIR, self.BAR):
+                pass
+
+        t.join(1)
+        u.join(1)
+        assert not t.is_alive()
+        assert not u.is_alive()
+        assert_equal(locks.held, {})
+
+
+    @classmethod
+    def teardown_class(self):
+        """Purge the mess created by this test."""
+        rm_nodedirs(self.config)
+        rm_configdir()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2016 Dr. Robert C. Green II.
+#
+#    This file is part of Combox.
+#
+#   Combox is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Combox is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with Combox (see COPYING).  If not, see
+#   <http://www.gnu.org/licenses/>.
+
+import time
+
+from nose.tools import *
+from os import path, remove
+from threading import Lock, active_count
+
+from combox.file import write_file
+from combox.scheduler import *
+from tests.utils import get_config, rm_nodedirs, rm_configdir
+
+
+class TestScheduler(object):
+    """
+    Class that tests the scheduler.py module.
+    """
+
+    @classmethod
+    def setup_class(self):
+        """Set things up."""
+
+        self.config = get_config()
+        self.LOREM = path.join(self.config['combox_dir'], 'lorem.txt')
+        self.DOLOR = path.join(self.config['combox_dir'], 'dolor.txt')
+
+
+    def wait(self, scheduler, timeout=5):
+        """Waits for the jobs of `scheduler` to be done."""
+        end = time.time() + timeout
+        while scheduler.pending() and time.time() < end:
+            time.sleep(0.05)
+
+
+    def test_quietperiod(self):
+        """Tests the quiet_period function."""
+        assert_equal(QUIET_PERIOD, quiet_period(self.LOREM))
+        assert_equal(QUIET_PERIOD, quiet_period(self.DOLOR))
+
+
+    def test_debouncer(self):
+        """Tests if Debouncer collapses the jobs scheduled for a path."""
+        debouncer = Debouncer()
+        calls = []
+
+        for i in range(5):
+            debouncer.schedule(self.LOREM, 0.2, calls.append, i)
+        assert_equal(1, debouncer.pending())
+        self.wait(debouncer)
+        # only the last one is run.
+        assert_equal([4], calls)
+
+        # jobs of files that are gone are dropped.
+        debouncer.schedule(self.DOLOR, 0.1, calls.append, 'dolor')
+        self.wait(debouncer)
+        assert_equal([4], calls)
+
+        debouncer.stop()
+
+
+    def test_debouncer_stable(self):
+        """Tests if Debouncer waits for a file that is still being written."""
+        debouncer = Debouncer()
+        calls = []
+
+        write_file(self.DOLOR, 'dolor')
+        start = time.time()
+        debouncer.schedule(self.DOLOR, 0.3, calls.append, 'dolor')
+        time.sleep(0.2)
+        # not scheduled again; the file is modified.
+        write_file(self.DOLOR, 'dolor sit amet')
+        self.wait(debouncer)
+
+        assert_equal(1, len(calls))
+        assert time.time() - start >= 0.6
+
+        # a job that fails does not stop the debouncer.
+        debouncer.schedule(self.DOLOR, 0, lambda: 1 / 0)
+        debouncer.schedule(self.LOREM, 0, calls.append, 'lorem')
+        self.wait(debouncer)
+        assert_equal('lorem', calls[-1])
+
+        debouncer.stop()
+        remove(self.DOLOR)
+
+
+    def test_delayedscheduler(self):
+        """Tests if DelayedScheduler runs the jobs when due, unless cancelled."""
+        delayed = DelayedScheduler()
+        calls = []
+        threads = active_count()
+
+        for i in range(100):
+            delayed.schedule(i, 0.3, calls.append, i)
+        delayed.schedule('lorem', 0.1, calls.append, 'lorem')
+        # replaces the job scheduled before.
+        delayed.schedule(0, 0.2, calls.append, 'zero')
+        # a single thread runs all the jobs.
+        assert_equal(threads + 1, active_count())
+
+        assert delayed.cancel(1)
+        assert not delayed.cancel(1)
+        assert_equal(100, delayed.pending())
+
+        self.wait(delayed)
+        assert_equal(['lorem', 'zero'] + range(2, 100), calls)
+
+        delayed.stop()
+
+
+    def test_jobqueue(self):
+        """Tests if JobQueue runs the urgent jobs first and the jobs of a path in order."""
+        jobs = JobQueue(1)
+        calls = []
+        gate = Lock()
+        gate.acquire()
+
+        # keeps the worker busy until the rest of the jobs are put.
+        jobs.put('shard', [self.DOLOR], gate.acquire)
+        jobs.put('shard', [self.LOREM], calls.append, 'shard lorem')
+        jobs.put('delete', [self.LOREM], calls.append, 'delete lorem')
+        jobs.put('delete', [self.DOLOR], calls.append, 'delete dolor')
+        jobs.put('directory', [self.config['combox_dir']], calls.append,
+                 'directory')
+        assert_equal(5, jobs.pending())
+
+        gate.release()
+        self.wait(jobs)
+        # the delete job of lorem waits for its shard job and the
+        # directory job waits for all the jobs put before it.
+        assert_equal(['delete dolor', 'shard lorem', 'delete lorem',
+                      'directory'], calls)
+
+        jobs.put('glue', [self.LOREM], lambda: 1 / 0)
+        self.wait(jobs)
+        # the jobs done are not looked at again.
+        assert_equal({}, jobs.at)
+        assert_equal({}, jobs.under)
+
+        metrics = jobs.metrics()
+        assert_equal(0, metrics['depth'])
+        # the first job may be taken before the others are put.
+        assert 4 <= metrics['max_depth'] <= 5
+        assert_equal(6, metrics['put'])
+        assert_equal(5, metrics['done'])
+        assert_equal(1, metrics['failed'])
+        assert metrics['wait_time'] > 0
+
+        jobs.stop()
+
+
+    def test_jobqueue_related(self):
+        """Tests if JobQueue runs the jobs of a directory and the paths under it in order."""
+        jobs = JobQueue(2)
+        calls = []
+        gate = Lock()
+        gate.acquire()
+        directory = path.dirname(self.LOREM)
+
+        # the directory job waits for the job under it, and the jobs
+        # put after it wait for it; the unrelated job does not wait.
+        jobs.put('shard', [self.LOREM], gate.acquire)
+        jobs.put('directory', [directory], calls.append, 'directory')
+        jobs.put('delete', [self.DOLOR], calls.append, 'delete dolor')
+        jobs.put('shard', ['/elsewhere/lorem'], calls.append, 'elsewhere')
+        time.sleep(0.2)
+        assert_equal(['elsewhere'], calls)
+
+        gate.release()
+        self.wait(jobs)
+        assert_equal(['elsewhere', 'directory', 'delete dolor'], calls)
+
+        assert_equal(['/a/b', '/a', '/'], list(parents('/a/b/c')))
+        assert_equal(['a'], list(parents('a/b')))
+
+        jobs.stop()
+
+
+    def test_jobqueue_size(self):
+        """Tests if JobQueue.put waits while the queue is full."""
+        jobs = job_queue({'queue_workers': 2, 'queue_size': 1})
+        assert_equal(2, jobs.workers)
+        assert_equal(1, jobs.size)
+
+        start = time.time()
+        for i in range(3):
+            jobs.put('shard', [self.LOREM], time.sleep, 0.2)
+        # the third job waited for the first one to be done.
+        assert time.time() - start >= 0.2
+        self.wait(jobs)
+
+        jobs.stop()
+
+
+    @classmethod
+    def teardown_class(self):
+        """Purge the mess created by this test."""
+        rm_nodedirs(self.config)
+        rm_configdir()
@@ -18,10 +18,12 @@
 #   along with Combox (see COPYING).  If not, see
 #   <http://www.gnu.org/licenses/>.
 
+import json
+import time
 import yaml
 
 from shutil import copyfile
-from os import path, remove
+from os import path, remove, stat, utime
 from threading import Lock
 
 from combox.silo import ComboxSilo
@@ -58,12 +60,12 @@ class TestSilo(object):
         # Test - update
         csilo.update(self.LOREM)
         lorem_content = read_file(self.LOREM)
-        lorem_hash = csilo.db.get(self.LOREM)
+        lorem_hash = csilo.get(self.LOREM)
         assert lorem_hash
 
         csilo.update(self.IPSUM)
         ipsum_content = read_file(self.IPSUM)
-        ipsum_hash = csilo.db.get(self.IPSUM)
+        ipsum_hash = csilo.get(self.IPSUM)
         assert ipsum_hash
 
         lorem_ipsum_content = "%s\n%s" % (lorem_content,
@@ -71,7 +73,7 @@ class TestSilo(object):
         write_file(self.LOREM_IPSUM, lorem_ipsum_content)
 
         csilo.update(self.LOREM_IPSUM)
-        lorem_ipsum_hash = csilo.db.get(self.LOREM_IPSUM)
+        lorem_ipsum_hash = csilo.get(self.LOREM_IPSUM)
         assert lorem_ipsum_hash
 
         assert lorem_ipsum_hash != lorem_hash
@@ -87,10 +89,15 @@ class TestSilo(object):
         csilo.update(self.LOREM_IPSUM)
         assert csilo.stale(self.LOREM_IPSUM) is False
 
-        lorem_ipsum_hash_new = csilo.db.get(self.LOREM_IPSUM)
+        lorem_ipsum_hash_new = csilo.get(self.LOREM_IPSUM)
         assert lorem_ipsum_hash_new
         assert lorem_ipsum_hash_new != lorem_ipsum_hash
 
+        # Test - update with a precomputed hash
+        csilo.update(self.LOREM_IPSUM, lorem_ipsum_hash)
+        assert_equal(lorem_ipsum_hash, csilo.get(self.LOREM_IPSUM))
+        assert csilo.stale(self.LOREM_IPSUM)
+
         # Test - remove
         remove(self.LOREM_IPSUM)
         csilo.remove(self.LOREM_IPSUM)
@@ -99,18 +106,273 @@ class TestSilo(object):
         assert not csilo.exists(self.LOREM_IPSUM)
 
 
+    def test_csilo_update_many(self):
+        """Tests the update_many and get methods in ComboxSilo class."""
+        csilo = ComboxSilo(self.config, self.silo_lock)
+        fhashes = {self.LOREM: hash_file(self.LOREM),
+                   self.IPSUM: hash_file(self.IPSUM)}
+
+        assert csilo.update_many(fhashes)
+        for filep, fhash in fhashes.iteritems():
+            assert_equal(fhash, csilo.get(filep))
+            assert csilo.stale(filep) is False
+
+        # it was written to disk.
+        csilo = ComboxSilo(self.config, self.silo_lock)
+        assert_equal(fhashes[self.LOREM], csilo.get(self.LOREM))
+
+        csilo.remove(self.LOREM)
+        csilo.remove(self.IPSUM)
+        assert_equal(None, csilo.get(self.LOREM))
+
+
+    def test_csilo_remove_tree(self):
+        """Tests the remove_tree method in ComboxSilo class."""
+        csilo = ComboxSilo(self.config, self.silo_lock)
+        foo_dir = path.join(self.FILES_DIR, 'foo')
+        bar = path.join(foo_dir, 'bar', 'bar.txt')
+        baz = path.join(foo_dir, 'baz.txt')
+        foobar = path.join(self.FILES_DIR, 'foobar.txt')
+
+        csilo.update_many({bar: 'bar', baz: 'baz', foobar: 'foobar'})
+        csilo.node_set('file_deleted', bar)
+        csilo.node_set('file_deleted', foo_dir)
+        csilo.node_set('file_deleted', foobar)
+
+        assert_equal(2, csilo.remove_tree(foo_dir))
+        assert not csilo.exists(bar)
+        assert not csilo.exists(baz)
+        assert_equal(None, csilo.node_get('file_deleted', bar))
+        assert_equal(None, csilo.node_get('file_deleted', foo_dir))
+
+        # it was written to disk; paths that only start like foo_dir
+        # are left alone.
+        csilo = ComboxSilo(self.config, self.silo_lock)
+        assert not csilo.exists(baz)
+        assert_equal('foobar', csilo.get(foobar))
+        assert_equal(1, csilo.node_get('file_deleted', foobar))
+
+        csilo.remove(foobar)
+        csilo.node_rem('file_deleted', foobar)
+
+
+    def test_csilo_reload(self):
+        """Tests if ComboxSilo re-loads the DB only when it was changed elsewhere.
+        """
+        csilo_0 = ComboxSilo(self.config, self.silo_lock)
+        csilo_1 = ComboxSilo(self.config, self.silo_lock)
+
+        lorem_hash = hash_file(self.LOREM)
+        csilo_0.update(self.LOREM, lorem_hash)
+        files = csilo_0.files
+        csilo_0.reload()
+        # not re-loaded; its own change.
+        assert files is csilo_0.files
+        assert_equal(lorem_hash, csilo_0.files[self.LOREM])
+
+        # the other object sees the change.
+        assert_equal(lorem_hash, csilo_1.get(self.LOREM))
+        csilo_1.node_set('file_created', self.LOREM)
+        assert_equal(1, csilo_0.node_get('file_created', self.LOREM))
+
+        csilo_1.remove(self.LOREM)
+        assert not csilo_0.exists(self.LOREM)
+
+
+    def test_csilo_batch(self):
+        """Tests if ComboxSilo commits the changes made in a batch together.
+        """
+        csilo_0 = ComboxSilo(self.config, self.silo_lock)
+        csilo_1 = ComboxSilo(self.config, self.silo_lock)
+
+        with csilo_0.batch():
+            csilo_0.update(self.LOREM)
+            with csilo_0.batch():
+                csilo_0.node_set('file_created', self.IPSUM)
+            # not committed yet; only this object sees the changes.
+            assert csilo_0.exists(self.LOREM)
+            assert_equal(2, csilo_0.dirty)
+            assert not csilo_1.exists(self.LOREM)
+
+        assert_equal(0, csilo_0.dirty)
+        assert csilo_1.exists(self.LOREM)
+        assert_equal(1, csilo_1.node_get('file_created', self.IPSUM))
+
+
+    def test_csilo_flush_interval(self):
+        """Tests if ComboxSilo commits changes after silo_flush_interval or silo_max_dirty.
+        """
+        config = dict(self.config)
+        config['silo_flush_interval'] = 0.5
+        config['silo_max_dirty'] = 3
+        csilo_0 = ComboxSilo(config, self.silo_lock)
+        csilo_1 = ComboxSilo(self.config, self.silo_lock)
+
+        csilo_0.update(self.LOREM)
+        assert not csilo_1.exists(self.LOREM)
+        time.sleep(1)
+        assert csilo_1.exists(self.LOREM)
+
+        csilo_0.node_set('file_created', self.LOREM)
+        csilo_0.node_set('file_created', self.IPSUM)
+        assert_equal(None, csilo_1.node_get('file_created', self.IPSUM))
+        csilo_0.remove(self.LOREM)
+        # silo_max_dirty changes.
+        assert not csilo_1.exists(self.LOREM)
+        assert_equal(1, csilo_1.node_get('file_created', self.IPSUM))
+
+        csilo_0.update(self.IPSUM)
+        csilo_0.flush()
+        assert csilo_1.exists(self.IPSUM)
+
+
+    def test_csilo_rollback(self):
+        """Tests if ComboxSilo rolls back a change that fails half way.
+        """
+        config = dict(self.config)
+        config['silo_flush_interval'] = 60
+        csilo = ComboxSilo(config, self.silo_lock)
+
+        csilo.update(self.LOREM)
+        def fail():
+            with csilo.writing():
+                csilo.db.execute('DELETE FROM files')
+                csilo.files.clear()
+                raise ValueError('failed half way')
+        assert_raises(ValueError, fail)
+
+        # the change before it is kept and the lock is released.
+        assert csilo.exists(self.LOREM)
+        csilo.update(self.IPSUM)
+        csilo.flush()
+        assert ComboxSilo(self.config, self.silo_lock).exists(self.LOREM)
+        assert ComboxSilo(self.config, self.silo_lock).exists(self.IPSUM)
+
+
+    def test_csilo_unchanged(self):
+        """Tests the unchanged method and if stale skips rehashing unchanged files."""
+        csilo = ComboxSilo(self.config, self.silo_lock)
+        write_file(self.LOREM_IPSUM, 'lorem ipsum')
+        mtime = stat(self.LOREM_IPSUM).st_mtime // 1
+
+        utime(self.LOREM_IPSUM, (mtime, mtime))
+        assert not csilo.unchanged(self.LOREM_IPSUM)
+        csilo.update(self.LOREM_IPSUM)
+        assert csilo.unchanged(self.LOREM_IPSUM)
+        assert csilo.stale(self.LOREM_IPSUM) is False
+
+        # the stats were written to disk.
+        csilo = ComboxSilo(self.config, self.silo_lock)
+        assert csilo.unchanged(self.LOREM_IPSUM)
+
+        # same size and mtime; it's not rehashed...
+        write_file(self.LOREM_IPSUM, 'ipsum lorem')
+        utime(self.LOREM_IPSUM, (mtime, mtime))
+        assert csilo.stale(self.LOREM_IPSUM) is False
+
+        # ...unless the silo is paranoid.
+        config = dict(self.config, silo_paranoid=True)
+        paranoid_silo = ComboxSilo(config, self.silo_lock)
+        assert not paranoid_silo.unchanged(self.LOREM_IPSUM)
+        assert paranoid_silo.stale(self.LOREM_IPSUM)
+
+        write_file(self.LOREM_IPSUM, 'lorem ipsum dolor')
+        assert not csilo.unchanged(self.LOREM_IPSUM)
+        assert csilo.stale(self.LOREM_IPSUM)
+
+        # no stats are stored with a precomputed hash.
+        csilo.update(self.LOREM_IPSUM, hash_file(self.LOREM_IPSUM))
+        assert not csilo.unchanged(self.LOREM_IPSUM)
+
+        remove(self.LOREM_IPSUM)
+        assert not csilo.unchanged(self.LOREM_IPSUM)
+        csilo.remove(self.LOREM_IPSUM)
+
+
+    def test_csilo_hash_cache(self):
+        """Tests if ComboxSilo hashes files through its hash cache."""
+        config = dict(self.config, hash_cache_persist=True)
+        csilo = ComboxSilo(config, self.silo_lock)
+        csilo.update(self.LOREM)
+        assert_equal(hash_file(self.LOREM), csilo.hashes.get(self.LOREM))
+
+        # the cache is saved when the silo is flushed.
+        csilo.flush()
+        csilo = ComboxSilo(config, self.silo_lock)
+        assert_equal(hash_file(self.LOREM), csilo.hashes.get(self.LOREM))
+
+        csilo.remove(self.LOREM)
+        remove(path.join(self.config['silo_dir'], 'hash.cache'))
+
+
+    def test_csilo_digest(self):
+        """Tests ComboxSilo with another digest algorithm."""
+        csilo = ComboxSilo(self.config, self.silo_lock)
+        csilo.update(self.LOREM)
+        lorem_hash = csilo.get(self.LOREM)
+
+        config = dict(self.config, digest='md5', silo_paranoid=True)
+        csilo = ComboxSilo(config, self.silo_lock)
+        csilo.update(self.IPSUM)
+        ipsum_hash = csilo.get(self.IPSUM)
+        assert_equal(hash_file(self.IPSUM, digest='md5'), ipsum_hash)
+        assert_equal('md5', csilo.hash_digest(self.IPSUM))
+
+        # hashes computed with the older algorithm are still checked
+        # with it.
+        assert_equal('sha512', csilo.hash_digest(self.LOREM))
+        assert csilo.stale(self.LOREM) is False
+        assert csilo.stale(self.IPSUM) is False
+        assert_equal(lorem_hash, csilo.get(self.LOREM))
+
+        csilo.remove(self.LOREM)
+        csilo.remove(self.IPSUM)
+        assert_raises(ValueError, ComboxSilo, dict(self.config, digest='foo'),
+                      self.silo_lock)
+
+
+    def test_csilo_migrate(self):
+        """Tests if ComboxSilo moves the contents of an old pickledb silo to the DB.
+        """
+        csilo = ComboxSilo(self.config, self.silo_lock)
+        lorem_hash = hash_file(self.LOREM)
+
+        pickledb_path = path.join(self.config['silo_dir'], 'silo.db')
+        old_db = {self.LOREM: lorem_hash,
+                  'file_created': {self.IPSUM: 1},
+                  'file_modified': {}, 'file_moved': {},
+                  'file_deleted': {self.LOREM: 2},
+                  'file_moved_info': {self.IPSUM: self.LOREM_IPSUM}}
+        write_file(pickledb_path, json.dumps(old_db))
+
+        csilo = ComboxSilo(self.config, self.silo_lock)
+        assert_equal(lorem_hash, csilo.get(self.LOREM))
+        assert_equal([self.LOREM], csilo.keys())
+        assert_equal(1, csilo.node_get('file_created', self.IPSUM))
+        assert_equal(2, csilo.node_get('file_deleted', self.LOREM))
+        assert_equal(self.LOREM_IPSUM,
+                     csilo.node_get('file_moved_info', self.IPSUM))
+
+        # it's done only once.
+        assert not path.exists(pickledb_path)
+        assert path.exists('%s.migrated' % pickledb_path)
+        remove('%s.migrated' % pickledb_path)
+
+
     def test_csilo_node_dicts(self):
         """Tests ComboxSilo class, if the dictinaries need for housekeeping
         node directories are created.
 
         """
         silo = ComboxSilo(self.config, self.silo_lock)
-        keys = silo.db.db.keys()
 
         node_dicts = ['file_created', 'file_modified', 'file_moved',
                       'file_deleted', 'file_moved_info']
+        assert_equal(node_dicts, silo.nodedicts())
         for ndict in node_dicts:
-            assert ndict in keys
+            assert_equal(None, silo.node_get(ndict, self.LOREM))
+
+        assert_raises(KeyError, silo.node_get, 'file_foo', self.LOREM)
 
 
     def test_csilo_nodset_create(self):
@@ -127,13 +389,16 @@ class TestSilo(object):
         silo.node_set('file_created', self.IPSUM)
         silo.node_set('file_created', self.IPSUM)
 
-        dict_file_created = silo.db.get('file_created')
-        assert_equal(3, dict_file_created[self.LOREM])
-        assert_equal(4, dict_file_created[self.IPSUM])
+        assert_equal(3, silo.node_get('file_created', self.LOREM))
+        assert_equal(4, silo.node_get('file_created', self.IPSUM))
 
         silo.node_set('file_created', self.LOREM, 15)
-        dict_file_created = silo.db.get('file_created')
-        assert_equal(15, dict_file_created[self.LOREM])
+        assert_equal(15, silo.node_get('file_created', self.LOREM))
+
+        assert_equal([self.LOREM], silo.node_files('file_created', 5))
+        assert_equal(sorted([self.LOREM, self.IPSUM]),
+                     sorted(silo.node_files('file_created', 4)))
+        assert_equal([], silo.node_files('file_modified', 1))
 
 
     def test_csilo_nodset_modified(self):
@@ -150,13 +415,11 @@ class TestSilo(object):
         silo.node_set('file_modified', self.IPSUM)
         silo.node_set('file_modified', self.IPSUM)
 
-        dict_file_modified = silo.db.get('file_modified')
-        assert_equal(3, dict_file_modified[self.LOREM])
-        assert_equal(4, dict_file_modified[self.IPSUM])
+        assert_equal(3, silo.node_get('file_modified', self.LOREM))
+        assert_equal(4, silo.node_get('file_modified', self.IPSUM))
 
         silo.node_set('file_modified', self.LOREM, 15)
-        dict_file_modified = silo.db.get('file_modified')
-        assert_equal(15, dict_file_modified[self.LOREM])
+        assert_equal(15, silo.node_get('file_modified', self.LOREM))
 
 
     def test_csilo_nodset_moved(self):
@@ -173,13 +436,11 @@ class TestSilo(object):
         silo.node_set('file_moved', self.IPSUM)
         silo.node_set('file_moved', self.IPSUM)
 
-        dict_file_moved = silo.db.get('file_moved')
-        assert_equal(3, dict_file_moved[self.LOREM])
-        assert_equal(4, dict_file_moved[self.IPSUM])
+        assert_equal(3, silo.node_get('file_moved', self.LOREM))
+        assert_equal(4, silo.node_get('file_moved', self.IPSUM))
 
         silo.node_set('file_moved', self.LOREM, 15)
-        dict_file_moved = silo.db.get('file_moved')
-        assert_equal(15, dict_file_moved[self.LOREM])
+        assert_equal(15, silo.node_get('file_moved', self.LOREM))
 
     def test_csilo_nodset_file_deleted(self):
         """Tests node_set method in ComboxSilo class, when type is 'file_deleted'.
@@ -195,13 +456,11 @@ class TestSilo(object):
         silo.node_set('file_deleted', self.IPSUM)
         silo.node_set('file_deleted', self.IPSUM)
 
-        dict_file_deleted = silo.db.get('file_deleted')
-        assert_equal(3, dict_file_deleted[self.LOREM])
-        assert_equal(4, dict_file_deleted[self.IPSUM])
+        assert_equal(3, silo.node_get('file_deleted', self.LOREM))
+        assert_equal(4, silo.node_get('file_deleted', self.IPSUM))
 
         silo.node_set('file_deleted', self.LOREM, 15)
-        dict_file_deleted = silo.db.get('file_deleted')
-        assert_equal(15, dict_file_deleted[self.LOREM])
+        assert_equal(15, silo.node_get('file_deleted', self.LOREM))
 
 
     def test_csilo_node_store_moved_info(self):
@@ -246,7 +505,7 @@ class TestSilo(object):
         """Cleans up things after each test in this class"""
 
         silo = ComboxSilo(self.config, self.silo_lock)
-        silo.db.deldb()
+        silo.clear()
 
 
     @classmethod